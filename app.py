@@ -3,9 +3,16 @@ import os
 from openai import OpenAI
 from datetime import datetime
 import json
+import time
 
 from characters import CHARACTERS
-from utils import count_tokens, format_cost, save_chat_history, load_chat_history, get_character_avatar
+from context_budget import fit_messages
+from memory import ConversationMemory
+from pricing import USAGE_STAGE_LABELS, UsageTracker, usage_cost
+from session_store import SessionStore
+from telemetry import StageLatency
+from utils import (cached_prompt_tokens, count_tokens, save_chat_history, load_chat_history,
+                   get_avatar_cache_stats, get_avatar_src, get_chat_avatar, stream_chat_completion)
 
 # 尝试导入MCP搜索模块（向后兼容：如果导入失败，禁用MCP功能）
 try:
@@ -147,14 +154,26 @@ def load_css():
     """, unsafe_allow_html=True)
 
 def init_session_state():
-    if 'messages' not in st.session_state:
-        st.session_state.messages = []
+    if 'chat_store' not in st.session_state:
+        # 消息和搜索历史有条数上限（SESSION_MAX_MESSAGES / SESSION_MAX_SEARCHES），搜索结果全文引用共享缓存
+        st.session_state.chat_store = SessionStore()
+        st.session_state.messages = st.session_state.chat_store.messages
+        st.session_state.search_history = st.session_state.chat_store.search_history
     if 'current_character' not in st.session_state:
         st.session_state.current_character = None
     if 'total_tokens' not in st.session_state:
         st.session_state.total_tokens = 0
     if 'total_cost' not in st.session_state:
         st.session_state.total_cost = 0.0
+    if 'usage' not in st.session_state:
+        st.session_state.usage = UsageTracker()  # 按阶段（主回复、搜索决策、总结、记忆摘要等）汇总的用量和费用
+    if 'ttft_history' not in st.session_state:
+        st.session_state.ttft_history = []  # 每轮回复的首字延迟（秒）
+    if 'prompt_tokens' not in st.session_state:
+        st.session_state.prompt_tokens = 0  # 主回复的输入token累计
+        st.session_state.cached_tokens = 0  # 其中命中服务端提示词前缀缓存的部分
+    if 'enable_streaming' not in st.session_state:
+        st.session_state.enable_streaming = True
     
     # 每次检查时都重新读取环境变量，确保使用最新的 API key
     api_key = os.getenv('OPENAI_API_KEY')
@@ -188,16 +207,23 @@ def init_session_state():
         st.session_state.mcp_manager = MCPChatManager(st.session_state.client)
     if 'enable_mcp_search' not in st.session_state:
         st.session_state.enable_mcp_search = MCP_AVAILABLE  # 默认启用（如果可用）
-    if 'search_history' not in st.session_state:
-        st.session_state.search_history = []  # 记录搜索历史
+    if 'enable_speculative' not in st.session_state:
+        st.session_state.enable_speculative = False  # 推测执行默认关闭
+    if 'stage_latency' not in st.session_state:
+        st.session_state.stage_latency = StageLatency()  # 本会话各阶段耗时，用于p50/p95
+        st.session_state.last_trace = None  # 最近一轮的阶段时间线
+    if 'speculation_history' not in st.session_state:
+        st.session_state.speculation_history = []  # 每轮推测执行的命中/节省/额外花费
+    if 'memory' not in st.session_state:
+        st.session_state.memory = ConversationMemory()  # 早期对话的滚动摘要
 
 def switch_character(character_name):
     if st.session_state.current_character != character_name:
         st.session_state.current_character = character_name
-        st.session_state.messages = []
+        st.session_state.chat_store.clear_messages()
+        st.session_state.memory = ConversationMemory()
 
-def get_system_prompt(character_name):
-    character = CHARACTERS[character_name]
+def build_system_prompt(character):
     return f"""你现在要扮演{character['name']}。
 
 角色背景：
@@ -219,94 +245,291 @@ def get_system_prompt(character_name):
 7. 可以讲述相关的故事、经历或见解，使对话更加生动有趣
 8. 展现角色的专业知识和独特视角"""
 
+# 系统提示词在启动时为每个角色生成一次，每轮复用同一字符串，使请求前缀逐字节一致以命中服务端前缀缓存
+SYSTEM_PROMPTS = {char_id: build_system_prompt(info) for char_id, info in CHARACTERS.items()}
+
+def get_system_prompt(character_name):
+    return SYSTEM_PROMPTS[character_name]
+
+def build_plain_messages(user_message):
+    """在token预算内构建不带MCP增强的消息列表（早期对话以记忆摘要代替）"""
+    memory_summary, history = st.session_state.memory.recent_history(st.session_state.messages)
+    messages, _ = fit_messages(
+        get_system_prompt(st.session_state.current_character),
+        history,
+        user_message,
+        model="gpt-4o-ca",
+        max_tokens=2000,
+        memory_summary=memory_summary
+    )
+    return messages
+
+def update_memory():
+    """回复显示后在后台把新过期的对话折叠进记忆摘要"""
+    st.session_state.memory.update_async(
+        st.session_state.client,
+        st.session_state.messages,
+        CHARACTERS[st.session_state.current_character]
+    )
+
+def record_chat_turn(user_message, result):
+    """将一轮对话的回复、消耗和搜索记录写入会话状态，本轮合计（含辅助调用）写回result的turn_tokens/turn_cost"""
+    turn_usage = UsageTracker()
+    if result['tokens_used']:
+        prompt_tokens = result.get('prompt_tokens', 0)
+        turn_usage.record("main", result.get('model', 'gpt-4o-ca'), prompt_tokens,
+                          result['tokens_used'] - prompt_tokens, result.get('cached_tokens', 0),
+                          cost=result['cost'])
+    # 搜索决策、网页提炼、总结、被取消的推测请求等辅助调用同样产生了花费
+    if result.get('usage') is not None:
+        turn_usage.merge(result['usage'])
+    # 后台记忆摘要调用的用量
+    turn_usage.merge(st.session_state.memory.pop_unbilled_usage())
+    st.session_state.usage.merge(turn_usage)
+    st.session_state.total_tokens = st.session_state.usage.total_tokens
+    st.session_state.total_cost = st.session_state.usage.total_cost
+    result['turn_tokens'] = turn_usage.total_tokens
+    result['turn_cost'] = turn_usage.total_cost
+    if 'speculation' in result:
+        st.session_state.speculation_history.append(result['speculation'])
+    if result.get('ttft') is not None:
+        st.session_state.ttft_history.append(result['ttft'])
+    if result.get('trace') is not None:
+        st.session_state.stage_latency.add_trace(result['trace'])
+        st.session_state.last_trace = result['trace']
+    st.session_state.prompt_tokens += result.get('prompt_tokens', 0)
+    st.session_state.cached_tokens += result.get('cached_tokens', 0)
+    
+    # 超出消息上限时丢弃已压缩进记忆摘要的最早消息
+    st.session_state.chat_store.add_turn(user_message, result['response'], st.session_state.memory)
+    
+    # 记录搜索历史
+    if result.get('search_performed'):
+        st.session_state.chat_store.add_search(
+            result['search_query'],
+            user_message,
+            result['search_summary'],
+            result.get('search_source'),
+            result.get('search_results', [])
+        )
+
 def chat_with_character(user_message):
-    """对话函数 - 支持MCP搜索增强（向后兼容）"""
+    """
+    对话函数 - 支持MCP搜索增强，返回结果字典（字段同chat_with_character_stream，不含stream）
+    调用失败时result['error']为错误信息
+    """
     character = CHARACTERS[st.session_state.current_character]
     
     # 如果MCP可用且启用，使用MCP增强对话
     if MCP_AVAILABLE and st.session_state.enable_mcp_search and 'mcp_manager' in st.session_state:
+        memory_summary, history = st.session_state.memory.recent_history(st.session_state.messages)
         result = st.session_state.mcp_manager.chat_with_mcp(
             user_message=user_message,
             character=character,
             system_prompt=get_system_prompt(st.session_state.current_character),
-            conversation_history=st.session_state.messages,
+            conversation_history=history,
             enable_search=True,
             model="gpt-4o-ca",
             temperature=0.8,
-            max_tokens=2000
+            max_tokens=2000,
+            speculative=st.session_state.enable_speculative,
+            memory_summary=memory_summary
         )
         
         # 更新会话状态
         if result['response']:
-            st.session_state.total_tokens += result['tokens_used']
-            st.session_state.total_cost += result['cost']
-            
-            st.session_state.messages.append({
-                "role": "user", 
-                "content": user_message
-            })
-            st.session_state.messages.append({
-                "role": "assistant", 
-                "content": result['response']
-            })
-            
-            # 记录搜索历史
-            if result['search_performed']:
-                st.session_state.search_history.append({
-                    'query': result['search_query'],
-                    'summary': result['search_summary'],
-                    'user_question': user_message,
-                    'results': result.get('search_results', [])
-                })
-        
-        return (result['response'], 
-                result['tokens_used'], 
-                result['cost'],
-                result['search_performed'],
-                result['search_query'],
-                result.get('search_results', []))
+            record_chat_turn(user_message, result)
+        return result
     
     # 降级方案：使用原始对话逻辑（不使用MCP）
-    else:
-        messages = [
-            {"role": "system", "content": get_system_prompt(st.session_state.current_character)}
-        ]
-        
-        for msg in st.session_state.messages:
-            messages.append({"role": msg["role"], "content": msg["content"]})
+    result = {
+        "response": "",
+        "model": "gpt-4o-ca",
+        "tokens_used": 0,
+        "cost": 0.0,
+        "ttft": None,
+        "search_performed": False,
+        "search_query": "",
+        "search_summary": "",
+        "search_results": []
+    }
+    messages = build_plain_messages(user_message)
+    
+    try:
+        start_time = time.perf_counter()
+        response = st.session_state.client.chat.completions.create(
+            model="gpt-4o-ca",
+            messages=messages,
+            temperature=0.8,
+            max_tokens=2000
+        )
+        latency = time.perf_counter() - start_time
         
-        messages.append({"role": "user", "content": user_message})
+        result['response'] = response.choices[0].message.content
+        result['tokens_used'] = response.usage.total_tokens
+        result['prompt_tokens'] = response.usage.prompt_tokens
+        result['cached_tokens'] = cached_prompt_tokens(response.usage)
+        result['cost'] = usage_cost("gpt-4o-ca", result['prompt_tokens'], response.usage.completion_tokens,
+                                    result['cached_tokens'])
+        result['ttft'] = latency
+        record_chat_turn(user_message, result)
         
-        try:
-            response = st.session_state.client.chat.completions.create(
-                model="gpt-4o-ca",
-                messages=messages,
-                temperature=0.8,
-                max_tokens=2000
+    except Exception as e:
+        result['error'] = str(e)
+    
+    return result
+
+def _record_when_done(user_message, result, deltas):
+    """透传流式片段，流结束后把本轮对话写入会话状态"""
+    yield from deltas
+    if result['response'] and 'error' not in result:
+        record_chat_turn(user_message, result)
+
+def chat_with_character_stream(user_message):
+    """
+    流式对话函数 - 返回结果字典，result['stream']逐段产出回复文本
+    流耗尽后result中的tokens_used/cost/ttft被填充，并自动记录本轮对话
+    """
+    character = CHARACTERS[st.session_state.current_character]
+    
+    if MCP_AVAILABLE and st.session_state.enable_mcp_search and 'mcp_manager' in st.session_state:
+        memory_summary, history = st.session_state.memory.recent_history(st.session_state.messages)
+        result = st.session_state.mcp_manager.chat_with_mcp(
+            user_message=user_message,
+            character=character,
+            system_prompt=get_system_prompt(st.session_state.current_character),
+            conversation_history=history,
+            enable_search=True,
+            model="gpt-4o-ca",
+            temperature=0.8,
+            max_tokens=2000,
+            stream=True,
+            speculative=st.session_state.enable_speculative,
+            memory_summary=memory_summary
+        )
+    else:
+        result = {
+            "response": "",
+            "tokens_used": 0,
+            "cost": 0.0,
+            "ttft": None,
+            "search_performed": False,
+            "search_query": "",
+            "search_summary": "",
+            "search_results": []
+        }
+        result['stream'] = stream_chat_completion(
+            st.session_state.client,
+            result,
+            model="gpt-4o-ca",
+            messages=build_plain_messages(user_message),
+            temperature=0.8,
+            max_tokens=2000
+        )
+    
+    result['stream'] = _record_when_done(user_message, result, result['stream'])
+    return result
+
+def render_stream(deltas):
+    """在当前聊天气泡中逐段渲染流式回复，返回完整文本"""
+    placeholder = st.empty()
+    placeholder.markdown("▌")
+    text = ""
+    for delta in deltas:
+        text += delta
+        placeholder.markdown(text + "▌")
+    placeholder.markdown(text)
+    return text
+
+def timed_avatar(character_id, character_info, variant):
+    """
+    获取角色头像并累计本次渲染的头像处理耗时
+    启用静态文件服务时返回缩略图URL，否则为内嵌的base64 data URL
+    """
+    start_time = time.perf_counter()
+    if variant == "chat":
+        avatar_url = get_chat_avatar(character_id, character_info)
+    else:
+        avatar_url = get_avatar_src(
+            character_id,
+            character_info,
+            variant,
+            static_serving=st.get_option("server.enableStaticServing")
+        )
+    st.session_state.rerun_avatar_time += time.perf_counter() - start_time
+    return avatar_url
+
+def count_avatar_payload(avatar_url, uses=1):
+    """累计本次渲染内嵌到页面中的头像数据量"""
+    if avatar_url.startswith("data:"):
+        st.session_state.rerun_avatar_bytes += len(avatar_url) * uses
+
+def format_timeline(trace, width=24):
+    """把一轮的阶段时间线画成文本甘特图（每行一个阶段：起点、耗时和关键属性）"""
+    total = max(trace.duration, 1e-6)
+    lines = []
+    for span in trace.timeline():
+        offset = min(width - 1, int(span['start'] / total * width))
+        length = max(1, min(width - offset, round(span['duration'] / total * width)))
+        bar = " " * offset + "█" * length + " " * (width - offset - length)
+        details = []
+        if 'hit' in span:
+            details.append("命中" if span['hit'] else "未命中")
+        if span.get('bytes'):
+            details.append(f"{span['bytes'] / 1024:.1f}KB")
+        if span.get('tokens'):
+            details.append(f"{span['tokens']} tokens")
+        if span.get('error'):
+            details.append(span['error'])
+        lines.append(f"{span['stage']:<12} |{bar}| {span['start']:6.2f}s +{span['duration']:5.2f}s "
+                     f"{' '.join(details)}")
+    return "\n".join(lines)
+
+def render_debug_panel():
+    """侧边栏底部的性能调试信息"""
+    with st.sidebar:
+        with st.expander("🛠️ 性能调试"):
+            avatar_stats = get_avatar_cache_stats()
+            st.caption(f"🖼️ 本次渲染头像耗时：{st.session_state.rerun_avatar_time * 1000:.1f} ms，"
+                       f"内嵌数据 {st.session_state.rerun_avatar_bytes / 1024:.1f} KB")
+            st.caption(
+                f"头像缓存：命中 {avatar_stats['hits']} 次 / 处理 {avatar_stats['misses']} 次，"
+                f"单次处理平均 {avatar_stats['avg_load_time'] * 1000:.1f} ms，"
+                f"累计节省约 {avatar_stats['time_saved'] * 1000:.0f} ms"
             )
-            
-            assistant_message = response.choices[0].message.content
-            tokens_used = response.usage.total_tokens
-            
-            prompt_tokens = response.usage.prompt_tokens
-            completion_tokens = response.usage.completion_tokens
-            cost = (prompt_tokens * 0.000005 + completion_tokens * 0.000015)
-            
-            st.session_state.total_tokens += tokens_used
-            st.session_state.total_cost += cost
-            
-            st.session_state.messages.append({"role": "user", "content": user_message})
-            st.session_state.messages.append({"role": "assistant", "content": assistant_message})
-            
-            return assistant_message, tokens_used, cost, False, "", []
-            
-        except Exception as e:
-            st.error(f"API调用失败: {str(e)}")
-            return None, 0, 0.0, False, "", []
+
+            if st.session_state.last_trace is not None:
+                trace = st.session_state.last_trace
+                st.caption(f"⏱️ 最近一轮时间线（共 {trace.duration:.2f}s）")
+                st.code(format_timeline(trace), language=None)
+                latency_lines = [
+                    f"{stage:<12} {stats['count']:>4}次  p50 {stats['p50']:6.2f}s  p95 {stats['p95']:6.2f}s"
+                    for stage, stats in sorted(st.session_state.stage_latency.summary().items())
+                ]
+                st.caption("📈 本会话各阶段耗时")
+                st.code("\n".join(latency_lines), language=None)
+
+            store_report = st.session_state.chat_store.memory_report()
+            st.caption(
+                f"💾 会话记录：{store_report['messages']}/{store_report['max_messages']} 条消息"
+                f"（{store_report['message_bytes'] / 1024:.1f} KB，已移出 {store_report['archived_messages']} 条），"
+                f"{store_report['searches']}/{store_report['max_searches']} 条搜索历史"
+                f"（{store_report['search_bytes'] / 1024:.1f} KB）"
+            )
+
+            if MCP_AVAILABLE and 'mcp_manager' in st.session_state:
+                search_engine = st.session_state.mcp_manager.search_engine
+                for name, stats in search_engine.strategy_stats.snapshot().items():
+                    st.caption(
+                        f"🌐 搜索策略 {name}：成功 {stats['successes']}/{stats['attempts']} 次，"
+                        f"平均 {stats['avg_latency']:.2f}s"
+                    )
 
 def main():
     init_session_state()
     load_css()
+    st.session_state.rerun_avatar_time = 0.0
+    st.session_state.rerun_avatar_bytes = 0
     
     with st.sidebar:
         st.title("🎭 角色选择")
@@ -315,7 +538,8 @@ def main():
             with st.container():
                 col1, col2 = st.columns([1, 4])
                 with col1:
-                    avatar_url = get_character_avatar(char_id, char_info)
+                    avatar_url = timed_avatar(char_id, char_info, "sidebar")
+                    count_avatar_payload(avatar_url)
                     st.markdown(
                         f'<img src="{avatar_url}" class="sidebar-avatar" />',
                         unsafe_allow_html=True
@@ -348,23 +572,31 @@ def main():
                 help="AI会自动判断是否需要搜索网络资料来增强回答"
             )
             
+            st.session_state.enable_speculative = st.checkbox(
+                "推测执行（更快，可能略增费用）",
+                value=st.session_state.enable_speculative,
+                help="在AI判断是否需要搜索的同时先开始生成回复；无需搜索时直接使用，需要搜索时取消"
+            )
+            
             # 显示搜索历史
             if st.session_state.search_history:
-                with st.expander(f"📋 搜索历史 ({len(st.session_state.search_history)})"):
-                    for i, search in enumerate(reversed(st.session_state.search_history[-5:])):
-                        st.caption(f"**Q{len(st.session_state.search_history)-i}:** {search['user_question'][:40]}...")
-                        st.caption(f"🔍 关键词: {search['query']}")
+                total_searches = st.session_state.chat_store.total_searches
+                recent_searches = list(st.session_state.search_history)[-5:]
+                with st.expander(f"📋 搜索历史 ({total_searches})"):
+                    for i, search in enumerate(reversed(recent_searches)):
+                        st.caption(f"**Q{total_searches-i}:** {search.user_question[:40]}...")
+                        st.caption(f"🔍 关键词: {search.query}")
                         # 直接显示搜索结果，不使用嵌套expander
                         with st.container():
-                            st.markdown(f"**摘要：** {search['summary'][:150]}...")
-                            if search.get('results'):
+                            st.markdown(f"**摘要：** {search.summary[:150]}...")
+                            if search.sources:
                                 st.markdown("**来源：**")
-                                for j, res in enumerate(search['results'][:3]):
-                                    st.markdown(f"  {j+1}. [{res['title']}]({res['url']})")
-                        if i < min(4, len(st.session_state.search_history)-1):
+                                for j, (title, url) in enumerate(search.sources):
+                                    st.markdown(f"  {j+1}. [{title}]({url})")
+                        if i < len(recent_searches)-1:
                             st.divider()
         else:
-            st.info("💡 提示：安装搜索依赖可启用MCP增强\n```\npip install duckduckgo-search beautifulsoup4 requests\n```")
+            st.info("💡 提示：安装搜索依赖可启用MCP增强\n```\npip install ddgs requests\n```")
         
         st.divider()
         
@@ -375,23 +607,110 @@ def main():
         with col2:
             st.metric("预估费用", f"${st.session_state.total_cost:.6f}")
         
+        if st.session_state.ttft_history:
+            ttft_history = st.session_state.ttft_history
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("⚡ 首字延迟", f"{ttft_history[-1]:.2f}s",
+                         help="最近一轮从发送请求到收到第一个字的时间")
+            with col2:
+                st.metric("平均首字延迟", f"{sum(ttft_history) / len(ttft_history):.2f}s")
+        
+        if st.session_state.prompt_tokens:
+            st.caption(
+                f"🧊 提示词前缀缓存：{st.session_state.cached_tokens:,}/{st.session_state.prompt_tokens:,} "
+                f"输入tokens命中（{st.session_state.cached_tokens / st.session_state.prompt_tokens:.0%}）"
+            )
+        
+        st.session_state.enable_streaming = st.checkbox(
+            "流式输出回复",
+            value=st.session_state.enable_streaming,
+            help="逐字显示角色回复，无需等待完整回复生成"
+        )
+        
         # MCP搜索统计
         if MCP_AVAILABLE and st.session_state.search_history:
-            search_count = len(st.session_state.search_history)
+            search_count = st.session_state.chat_store.total_searches
             st.metric("🔍 MCP搜索次数", f"{search_count}", 
                      help="本次会话中AI触发网络搜索的次数")
         
+        memory_summary, summarized_count = st.session_state.memory.snapshot()
+        archived_messages = st.session_state.chat_store.archived_messages
+        if memory_summary:
+            archived_note = f"（其中 {archived_messages} 条原文已移出会话）" if archived_messages else ""
+            st.caption(f"🧠 记忆摘要：已将 {summarized_count + archived_messages} 条早期消息"
+                       f"压缩为 {len(memory_summary)} 字{archived_note}")
+        
+        if st.session_state.speculation_history:
+            speculation_history = st.session_state.speculation_history
+            used = [sp for sp in speculation_history if sp['used']]
+            st.caption(
+                f"⚡ 推测执行：命中 {len(used)}/{len(speculation_history)} 次，"
+                f"共节省 {sum(sp['saved_latency'] for sp in used):.1f}s，"
+                f"额外花费 ${sum(sp['wasted_cost'] for sp in speculation_history):.6f}"
+            )
+        
+        stage_usage = st.session_state.usage.stages()
+        if stage_usage:
+            breakdown = "，".join(
+                f"{USAGE_STAGE_LABELS.get(stage, stage)} ${stats['cost']:.6f}（{stats['calls']}次）"
+                for stage, stats in sorted(stage_usage.items(), key=lambda item: -item[1]['cost'])
+            )
+            st.caption(f"🧾 费用构成：{breakdown}")
+        
+        if MCP_AVAILABLE and 'mcp_manager' in st.session_state:
+            decision_stats = st.session_state.mcp_manager.search_engine.decision_stats
+            local_decisions = decision_stats['local_skip'] + decision_stats['local_search']
+            total_decisions = local_decisions + decision_stats['llm']
+            if total_decisions:
+                st.caption(
+                    f"🧭 搜索决策：本地判断 {local_decisions}/{total_decisions} 次"
+                    f"（节省 {local_decisions} 次GPT调用）"
+                )
+            
+            cache_stats = st.session_state.mcp_manager.search_cache.stats()
+            if cache_stats['hits'] + cache_stats['misses']:
+                st.caption(
+                    f"📦 搜索缓存：{cache_stats['entries']}/{cache_stats['max_entries']} 条，"
+                    f"命中率 {cache_stats['hit_rate']:.0%}（{cache_stats['hits']} 命中 / "
+                    f"{cache_stats['near_hits']} 相近命中 / {cache_stats['misses']} 未命中）"
+                )
+            
+            page_cache = st.session_state.mcp_manager.search_engine.page_cache
+            if page_cache is not None:
+                page_stats = page_cache.stats()
+                if page_stats['hits'] + page_stats['revalidated'] + page_stats['misses']:
+                    st.caption(
+                        f"🗂️ 网页缓存：{page_stats['entries']} 个网页"
+                        f"（{page_stats['total_bytes'] / 1024 / 1024:.1f}/{page_stats['max_bytes'] / 1024 / 1024:.0f} MB），"
+                        f"命中率 {page_stats['hit_rate']:.0%}（{page_stats['hits']} 命中 / "
+                        f"{page_stats['revalidated']} 304复用 / {page_stats['misses']} 未命中），"
+                        f"节省下载 {page_stats['bytes_saved'] / 1024:.0f} KB"
+                    )
+            
+            knowledge_base = st.session_state.mcp_manager.knowledge_base
+            if knowledge_base is not None:
+                knowledge_stats = knowledge_base.stats()
+                if knowledge_stats['hits'] + knowledge_stats['misses']:
+                    st.caption(
+                        f"📚 本地知识库：{knowledge_stats['characters']} 个角色 / {knowledge_stats['chunks']} 个文本块，"
+                        f"命中 {knowledge_stats['hits']}/{knowledge_stats['hits'] + knowledge_stats['misses']} 次"
+                        f"（命中时跳过网络搜索）"
+                    )
+        
         st.divider()
         
         if st.button("🗑️ 清空对话", use_container_width=True):
-            st.session_state.messages = []
+            st.session_state.chat_store.clear_messages()
+            st.session_state.memory = ConversationMemory()
             st.rerun()
         
         if st.button("💾 保存对话历史", use_container_width=True):
             if st.session_state.messages and st.session_state.current_character:
                 filename = save_chat_history(
                     st.session_state.current_character,
-                    st.session_state.messages
+                    st.session_state.messages.to_list(),
+                    memory=st.session_state.memory.to_dict()
                 )
                 st.success(f"已保存到 {filename}")
     
@@ -411,7 +730,11 @@ def main():
     else:
         character = CHARACTERS[st.session_state.current_character]
         
-        avatar_url = get_character_avatar(st.session_state.current_character, character)
+        avatar_url = timed_avatar(st.session_state.current_character, character, "header")
+        count_avatar_payload(avatar_url)
+        chat_avatar = timed_avatar(st.session_state.current_character, character, "chat")
+        assistant_count = st.session_state.messages.count_role("assistant")
+        count_avatar_payload(chat_avatar, uses=assistant_count + 1)
         
         # MCP状态横幅
         if MCP_AVAILABLE:
@@ -446,7 +769,7 @@ def main():
                     with st.chat_message("user", avatar="👤"):
                         st.markdown(message["content"])
                 else:
-                    with st.chat_message("assistant", avatar=avatar_url):
+                    with st.chat_message("assistant", avatar=chat_avatar):
                         st.markdown(message["content"])
         
         user_input = st.chat_input("输入你的消息...")
@@ -455,38 +778,67 @@ def main():
             with st.chat_message("user", avatar="👤"):
                 st.markdown(user_input)
             
-            with st.chat_message("assistant", avatar=avatar_url):
-                with st.spinner(f"{character['name']}正在思考..."):
-                    # 根据MCP是否可用，解包不同数量的返回值
-                    result = chat_with_character(user_input)
-                    
-                    if MCP_AVAILABLE and len(result) == 6:
-                        response, tokens, cost, searched, search_query, search_results = result
-                    else:
-                        response, tokens, cost = result[:3]
-                        searched, search_query, search_results = False, "", []
+            with st.chat_message("assistant", avatar=chat_avatar):
+                if st.session_state.enable_streaming:
+                    with st.spinner(f"{character['name']}正在思考..."):
+                        result = chat_with_character_stream(user_input)
+                    render_stream(result['stream'])
+                else:
+                    with st.spinner(f"{character['name']}正在思考..."):
+                        result = chat_with_character(user_input)
+                    if result['response'] and 'error' not in result:
+                        st.markdown(result['response'])
+                
+                if 'error' in result:
+                    st.error(f"API调用失败: {result['error']}")
+                    response = None
+                else:
+                    response = result['response']
+                tokens = result.get('turn_tokens', result['tokens_used'])
+                cost = result.get('turn_cost', result['cost'])
+                searched = result['search_performed']
+                search_query = result['search_query']
+                search_results = result.get('search_results', [])
+                
+                if response:
+                    # 显示搜索信息 - 更加醒目的标记
+                    if searched and search_query:
+                        st.info(f"🔍 **MCP搜索增强已应用** | 搜索关键词：「{search_query}」")
+                        with st.expander("📚 查看搜索来源和摘要"):
+                            st.caption("💡 AI自动判断此问题需要网络搜索来提供更准确的答案")
+                            if search_results:
+                                st.markdown("**📖 参考来源：**")
+                                for i, res in enumerate(search_results[:3]):
+                                    st.markdown(f"{i+1}. [{res['title']}]({res['url']})")
+                                    st.caption(f"   ↳ {res['snippet'][:100]}...")
                     
-                    if response:
-                        st.markdown(response)
-                        
-                        # 显示搜索信息 - 更加醒目的标记
-                        if searched and search_query:
-                            st.info(f"🔍 **MCP搜索增强已应用** | 搜索关键词：「{search_query}」")
-                            with st.expander("📚 查看搜索来源和摘要"):
-                                st.caption("💡 AI自动判断此问题需要网络搜索来提供更准确的答案")
-                                if search_results:
-                                    st.markdown("**📖 参考来源：**")
-                                    for i, res in enumerate(search_results[:3]):
-                                        st.markdown(f"{i+1}. [{res['title']}]({res['url']})")
-                                        st.caption(f"   ↳ {res['snippet'][:100]}...")
-                        
-                        # 显示Token消耗，带搜索标记
-                        if searched:
-                            st.caption(f"💰 本次消耗: {tokens} tokens (${cost:.6f}) | 🔍 使用了搜索增强")
+                    # 显示推测执行效果
+                    speculation = result.get('speculation')
+                    if speculation:
+                        if speculation['used']:
+                            st.caption(f"⚡ 推测执行命中，节省约 {speculation['saved_latency']:.2f}s")
                         else:
-                            st.caption(f"💰 本次消耗: {tokens} tokens (${cost:.6f})")
+                            st.caption(f"⚡ 推测执行已取消，额外花费 ${speculation['wasted_cost']:.6f}")
+                    
+                    # 显示单轮费用上限的处理
+                    budget = result.get('budget')
+                    if budget and budget['action'] == "downgrade":
+                        st.caption(f"💸 预计超出单轮费用上限 ${budget['budget']:.4f}，"
+                                   f"已降级为 {budget['model']}（回复上限 {budget['max_tokens']} tokens）")
+                    elif budget and budget['action'] == "block":
+                        st.caption(f"🛑 预计超出单轮费用上限 ${budget['budget']:.4f}"
+                                   f"（预估最多 ${budget['estimate']['max_cost']:.4f}），回复已拦截")
+                    
+                    # 显示Token消耗，带搜索标记
+                    if searched:
+                        st.caption(f"💰 本次消耗: {tokens} tokens (${cost:.6f}) | 🔍 使用了搜索增强")
+                    else:
+                        st.caption(f"💰 本次消耗: {tokens} tokens (${cost:.6f})")
             
+            update_memory()
             st.rerun()
+    
+    render_debug_panel()
 
 if __name__ == "__main__":
     main()
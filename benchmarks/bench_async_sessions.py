@@ -0,0 +1,142 @@
+"""
+同步与异步MCP对话管线的并发会话基准测试
+在本地启动模拟的OpenAI服务和网页服务，用FakeDDGS代替真实搜索，让N个会话同时对话，
+每轮都走完整管线（GPT决策 → 搜索 → 抓取网页 → 总结 → 生成回复），对比：
+    sync  —— 每个会话一个线程，使用MCPChatManager（与Streamlit每个会话一个脚本线程相同）
+    async —— 所有会话共用一个事件循环，使用AsyncMCPChatManager
+
+用法（在项目根目录运行）:
+    python benchmarks/bench_async_sessions.py --sessions 16 --turns 3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MCP_PAGE_CACHE_DB', '')  # 关闭网页磁盘缓存，每轮都真实抓取
+
+from openai import AsyncOpenAI, OpenAI  # noqa: E402
+
+from http_fetcher import close_shared_async_fetcher  # noqa: E402
+import mcp_search  # noqa: E402
+from mcp_async import AsyncMCPChatManager, AsyncMCPSearchEngine  # noqa: E402
+from mcp_search import MCPChatManager  # noqa: E402
+from search_cache import SearchCache  # noqa: E402
+from search_strategies import StrategyStats  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_services import FakeDDGS, MockOpenAIHandler, PageHandler, start_server  # noqa: E402
+
+
+CHARACTER = {"name": "孙悟空", "source": "《西游记》"}
+SYSTEM_PROMPT = "你是孙悟空，齐天大圣。"
+
+
+def question(session: int, turn: int) -> str:
+    # 本地规则无法判断的问题，每轮都会调用GPT决策并触发一次新的搜索
+    return f"给我讲讲第{session}号洞府第{turn}段往事"
+
+
+def summarize(name, latencies, elapsed, turns):
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(f"{name:<6} 总耗时 {elapsed:6.2f}s   吞吐 {turns / elapsed:6.2f} 轮/秒   "
+          f"单轮延迟 p50 {statistics.median(latencies):5.2f}s  p95 {p95:5.2f}s")
+
+
+def run_sync(base_url, sessions, turns):
+    client = OpenAI(api_key="mock", base_url=base_url)
+    cache = SearchCache(similarity_threshold=None)
+    latencies = []
+
+    def session(index):
+        manager = MCPChatManager(client, search_cache=cache)
+        manager.search_engine.strategy_stats = StrategyStats()
+        history = []
+        for turn in range(turns):
+            start = time.perf_counter()
+            result = manager.chat_with_mcp(question(index, turn), CHARACTER, SYSTEM_PROMPT, history)
+            latencies.append(time.perf_counter() - start)
+            history += [{"role": "user", "content": question(index, turn)},
+                        {"role": "assistant", "content": result['response']}]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        list(executor.map(session, range(sessions)))
+    return latencies, time.perf_counter() - start
+
+
+async def run_async(base_url, sessions, turns):
+    client = AsyncOpenAI(api_key="mock", base_url=base_url)
+    engine = AsyncMCPSearchEngine(client, strategy_stats=StrategyStats())
+    cache = SearchCache(similarity_threshold=None)
+    latencies = []
+
+    async def session(index):
+        manager = AsyncMCPChatManager(client, search_engine=engine, search_cache=cache)
+        history = []
+        for turn in range(turns):
+            start = time.perf_counter()
+            result = await manager.chat_with_mcp(question(index, turn), CHARACTER, SYSTEM_PROMPT, history)
+            latencies.append(time.perf_counter() - start)
+            history += [{"role": "user", "content": question(index, turn)},
+                        {"role": "assistant", "content": result['response']}]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(i) for i in range(sessions)))
+    elapsed = time.perf_counter() - start
+    await close_shared_async_fetcher()
+    await client.close()
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=16, help="同时对话的会话数")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话的对话轮数")
+    parser.add_argument("--llm-ms", type=float, default=200, help="模拟GPT调用的首字延迟（毫秒）")
+    parser.add_argument("--search-ms", type=float, default=300, help="模拟搜索引擎的延迟（毫秒）")
+    parser.add_argument("--page-ms", type=float, default=50, help="模拟网页响应的延迟（毫秒）")
+    parser.add_argument("--verbose", action="store_true", help="显示管线日志")
+    args = parser.parse_args()
+
+    MockOpenAIHandler.latency = args.llm_ms / 1000
+    PageHandler.delay = args.page_ms / 1000
+    FakeDDGS.delay = args.search_ms / 1000
+    llm_server = start_server(MockOpenAIHandler)
+    page_server = start_server(PageHandler)
+    FakeDDGS.page_port = page_server.server_port
+    mcp_search.DDGS = FakeDDGS
+    base_url = f"http://127.0.0.1:{llm_server.server_port}/v1"
+
+    print(f"{args.sessions} 个会话 × {args.turns} 轮，GPT {args.llm_ms:.0f} ms，"
+          f"搜索 {args.search_ms:.0f} ms，网页 {args.page_ms:.0f} ms\n")
+
+    devnull = open(os.devnull, "w")
+    stdout = sys.stdout
+    total_turns = args.sessions * args.turns
+    try:
+        if not args.verbose:
+            sys.stdout = devnull
+        sync_latencies, sync_elapsed = run_sync(base_url, args.sessions, args.turns)
+        sync_threads = threading.active_count()
+        async_latencies, async_elapsed = asyncio.run(run_async(base_url, args.sessions, args.turns))
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+    summarize("sync", sync_latencies, sync_elapsed, total_turns)
+    summarize("async", async_latencies, async_elapsed, total_turns)
+    print(f"\n同步结束时存活线程 {sync_threads} 个；异步吞吐为同步的 {sync_elapsed / async_elapsed:.2f} 倍")
+
+    llm_server.shutdown()
+    page_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
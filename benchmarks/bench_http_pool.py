@@ -0,0 +1,98 @@
+"""
+网页抓取连接池基准测试
+在本地启动一个支持keep-alive的HTTP服务器，每个新连接模拟一次握手延迟（TCP+TLS），
+对比裸 requests.get 与共享连接池 PooledFetcher 抓取同一批网页的耗时和新建连接数
+
+用法（在项目根目录运行）:
+    python benchmarks/bench_http_pool.py --pages 40 --handshake-ms 30
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from http_fetcher import PooledFetcher  # noqa: E402
+
+
+PAGE = ("<html><head><meta charset='utf-8'><title>测试页面</title></head><body>"
+        + "<p>孙悟空，齐天大圣，花果山水帘洞美猴王。</p>" * 200 + "</body></html>").encode('utf-8')
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 启用keep-alive
+    disable_nagle_algorithm = True  # 避免响应头和正文分开发送时触发延迟确认
+    handshake_delay = 0.0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with PageHandler.lock:
+            PageHandler.connections += 1
+        time.sleep(PageHandler.handshake_delay)  # 模拟新连接的握手开销
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(name, fetch_one, urls, workers):
+    PageHandler.connections = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(fetch_one, urls))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<16} 耗时 {elapsed * 1000:8.1f} ms   新建连接 {PageHandler.connections:4d}   "
+          f"平均每页 {elapsed * 1000 / len(urls):6.1f} ms   下载 {sum(sizes) / 1024:.0f} KB")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=40, help="抓取的网页数量")
+    parser.add_argument("--handshake-ms", type=float, default=30, help="每个新连接模拟的握手延迟（毫秒）")
+    parser.add_argument("--workers", type=int, default=6, help="并发抓取线程数（与MCPSearchEngine默认一致）")
+    args = parser.parse_args()
+
+    PageHandler.handshake_delay = args.handshake_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    # 两个主机名指向同一服务器，模拟 baike.baidu.com / zh.wikipedia.org 等重复出现的站点
+    hosts = [f"127.0.0.1:{port}", f"localhost:{port}"]
+    urls = [f"http://{hosts[i % 2]}/page/{i}" for i in range(args.pages)]
+
+    print(f"抓取 {args.pages} 个网页，{args.workers} 线程并发，每次握手 {args.handshake_ms:.0f} ms\n")
+
+    def bare_get(url):
+        return len(requests.get(url, timeout=5).content)
+
+    fetcher = PooledFetcher()
+
+    def pooled_get(url):
+        with fetcher.get(url, timeout=5) as response:
+            return len(response.content)
+
+    bare = run("requests.get", bare_get, urls, args.workers)
+    pooled = run("PooledFetcher", pooled_get, urls, args.workers)
+    print(f"\n连接池节省 {(1 - pooled / bare) * 100:.0f}% 的抓取时间")
+
+    fetcher.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
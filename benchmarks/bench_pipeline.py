@@ -0,0 +1,311 @@
+"""
+对话管线的离线基准测试（不需要API密钥、DuckDuckGo和外网）
+在本地启动模拟的OpenAI服务和网页服务，用FakeDDGS代替真实搜索，运行真实的对话代码路径：
+    mcp        —— MCPChatManager.chat_with_mcp，每个会话一个线程
+    mcp-async  —— AsyncMCPChatManager.chat_with_mcp，所有会话共用一个事件循环
+    app        —— 用Streamlit AppTest驱动 app.py，经 chat_with_character / chat_with_character_stream
+                  完整重跑页面（会话依次执行）
+报告每轮延迟（p50/p95）、各阶段耗时（来自每轮的时间线）、吞吐、每轮的模拟服务调用次数和内存
+（单独再跑一遍并用tracemalloc统计，不影响计时）。--json 保存结果（附带git提交和参数），
+--baseline 与之前保存的结果对比，便于比较不同提交的性能
+
+用法（在项目根目录运行）:
+    python benchmarks/bench_pipeline.py --sessions 8 --turns 3 --json bench.json
+    python benchmarks/bench_pipeline.py --sessions 8 --turns 3 --baseline bench.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# 关闭磁盘缓存、本地知识库和相近搜索词复用，每轮都走完整管线，结果只取决于代码和参数
+os.environ.setdefault('MCP_PAGE_CACHE_DB', '')
+os.environ.setdefault('MCP_KNOWLEDGE_DIR', '')
+os.environ.setdefault('MCP_CACHE_SIMILARITY', '2')
+os.environ.setdefault('MCP_CACHE_DB', '')
+
+from openai import AsyncOpenAI, OpenAI  # noqa: E402
+
+from http_fetcher import close_shared_async_fetcher  # noqa: E402
+import mcp_search  # noqa: E402
+from mcp_async import AsyncMCPChatManager, AsyncMCPSearchEngine  # noqa: E402
+from mcp_search import MCPChatManager  # noqa: E402
+from search_cache import SearchCache, get_shared_cache  # noqa: E402
+from search_strategies import StrategyStats  # noqa: E402
+from telemetry import MetricsSink, StageLatency, percentile  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_async_sessions import CHARACTER, SYSTEM_PROMPT, question  # noqa: E402
+from mock_services import FakeDDGS, MockOpenAIHandler, PageHandler, start_server  # noqa: E402
+
+SCENARIOS = ("mcp", "mcp-async", "app")
+APP_CHARACTER = "wukong"
+
+
+def run_mcp(base_url, sessions, turns, stream):
+    """同步管线：每个会话一个线程，返回 (每轮延迟, 总耗时, 时间线, 仍持有的会话对象)"""
+    client = OpenAI(api_key="mock", base_url=base_url)
+    cache = SearchCache(similarity_threshold=None)
+    metrics = MetricsSink()
+    latencies, traces, managers = [], [], []
+
+    def session(index):
+        manager = MCPChatManager(client, search_cache=cache, metrics=metrics)
+        manager.search_engine.strategy_stats = StrategyStats()
+        managers.append(manager)
+        history = []
+        for turn in range(turns):
+            start = time.perf_counter()
+            result = manager.chat_with_mcp(question(index, turn), CHARACTER, SYSTEM_PROMPT, history, stream=stream)
+            if stream:
+                for _ in result['stream']:
+                    pass
+            latencies.append(time.perf_counter() - start)
+            traces.append(result['trace'])
+            history += [{"role": "user", "content": question(index, turn)},
+                        {"role": "assistant", "content": result['response']}]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        list(executor.map(session, range(sessions)))
+    return latencies, time.perf_counter() - start, traces, (client, cache, managers)
+
+
+def run_mcp_async(base_url, sessions, turns, stream):
+    """异步管线：所有会话共用一个事件循环和搜索引擎"""
+    async def run():
+        client = AsyncOpenAI(api_key="mock", base_url=base_url)
+        engine = AsyncMCPSearchEngine(client, strategy_stats=StrategyStats())
+        cache = SearchCache(similarity_threshold=None)
+        metrics = MetricsSink()
+        latencies, traces, managers = [], [], []
+
+        async def session(index):
+            manager = AsyncMCPChatManager(client, search_engine=engine, search_cache=cache, metrics=metrics)
+            managers.append(manager)
+            history = []
+            for turn in range(turns):
+                start = time.perf_counter()
+                result = await manager.chat_with_mcp(question(index, turn), CHARACTER, SYSTEM_PROMPT, history,
+                                                     stream=stream)
+                if stream:
+                    async for _ in result['stream']:
+                        pass
+                latencies.append(time.perf_counter() - start)
+                traces.append(result['trace'])
+                history += [{"role": "user", "content": question(index, turn)},
+                            {"role": "assistant", "content": result['response']}]
+
+        start = time.perf_counter()
+        await asyncio.gather(*(session(i) for i in range(sessions)))
+        elapsed = time.perf_counter() - start
+        await close_shared_async_fetcher()
+        await client.close()
+        return latencies, elapsed, traces, (cache, managers)
+
+    return asyncio.run(run())
+
+
+def run_app(base_url, sessions, turns, stream):
+    """用AppTest驱动app.py：每个会话一个AppTest（独立的session_state），依次执行"""
+    from streamlit.logger import set_log_level
+    from streamlit.testing.v1 import AppTest
+
+    set_log_level("error")  # AppTest裸运行时每次重跑都会警告缺少ScriptRunContext
+    os.environ['OPENAI_API_KEY'] = "mock"
+    os.environ['OPENAI_BASE_URL'] = base_url
+    get_shared_cache().clear()  # app.py使用进程级共享缓存，清空后重复运行仍然每轮都搜索
+    latencies, traces, apps = [], [], []
+    start = time.perf_counter()
+    for index in range(sessions):
+        app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=120)
+        app.run()
+        app.button(key=f"btn_{APP_CHARACTER}").click().run()
+        app.session_state.enable_streaming = stream
+        apps.append(app)
+        for turn in range(turns):
+            turn_start = time.perf_counter()
+            app.chat_input[0].set_value(question(index, turn)).run()
+            latencies.append(time.perf_counter() - turn_start)
+            if app.exception:
+                raise RuntimeError(f"app.py 运行出错: {app.exception[0].message}")
+            if app.session_state.last_trace is not None:
+                traces.append(app.session_state.last_trace)
+    return latencies, time.perf_counter() - start, traces, apps
+
+
+RUNNERS = {"mcp": run_mcp, "mcp-async": run_mcp_async, "app": run_app}
+
+
+def measure(scenario, base_url, sessions, turns, stream):
+    """计时运行一次，返回结果字典"""
+    MockOpenAIHandler.calls = PageHandler.requests = FakeDDGS.calls = 0
+    latencies, elapsed, traces, _ = RUNNERS[scenario](base_url, sessions, turns, stream)
+    total_turns = len(latencies)
+
+    stages = StageLatency()
+    for trace in traces:
+        stages.add_trace(trace)
+    return {
+        "turns": total_turns,
+        "elapsed": elapsed,
+        "throughput": total_turns / elapsed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "llm_calls_per_turn": MockOpenAIHandler.calls / total_turns,
+        "searches_per_turn": FakeDDGS.calls / total_turns,
+        "page_requests_per_turn": PageHandler.requests / total_turns,
+        "stages": {
+            stage: {"count": stats["count"], "p50": stats["p50"], "p95": stats["p95"],
+                    "per_turn": stats["sum"] / total_turns}
+            for stage, stats in stages.summary().items()
+        }
+    }
+
+
+def measure_memory(scenario, base_url, sessions, turns, stream):
+    """在tracemalloc下再跑一遍：峰值内存，以及跑完后各会话仍持有的内存（会话对象仍存活时）"""
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    _, _, _, alive = RUNNERS[scenario](base_url, sessions, turns, stream)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del alive
+    return {
+        "peak_kb": (peak - baseline) / 1024,
+        "retained_kb_per_session": (current - baseline) / 1024 / sessions
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    def delta(scenario, key, value, stage=None):
+        if not baseline or scenario not in baseline["results"]:
+            return ""
+        old = baseline["results"][scenario]
+        old = old["stages"].get(stage, {}) if stage else {**old, **old.get("memory", {})}
+        if not old.get(key):
+            return ""
+        return f" ({(value - old[key]) / old[key]:+.0%})"
+
+    for scenario, result in report["results"].items():
+        print(f"\n[{scenario}] {result['turns']} 轮，总耗时 {result['elapsed']:.2f}s，"
+              f"吞吐 {result['throughput']:.2f} 轮/秒{delta(scenario, 'throughput', result['throughput'])}")
+        print(f"  单轮延迟 p50 {result['latency_p50']:.3f}s{delta(scenario, 'latency_p50', result['latency_p50'])}"
+              f"  p95 {result['latency_p95']:.3f}s{delta(scenario, 'latency_p95', result['latency_p95'])}")
+        print(f"  每轮调用：GPT {result['llm_calls_per_turn']:.1f} 次，搜索 {result['searches_per_turn']:.1f} 次，"
+              f"网页 {result['page_requests_per_turn']:.1f} 次")
+        if "memory" in result:
+            memory = result["memory"]
+            print(f"  内存：峰值 {memory['peak_kb']:.0f} KB{delta(scenario, 'peak_kb', memory['peak_kb'])}，"
+                  f"每个会话持有 {memory['retained_kb_per_session']:.0f} KB"
+                  f"{delta(scenario, 'retained_kb_per_session', memory['retained_kb_per_session'])}")
+        print(f"  {'阶段':<12}{'次数':>6}{'p50':>9}{'p95':>9}{'每轮合计':>10}")
+        for stage, stats in sorted(result["stages"].items(), key=lambda item: -item[1]["per_turn"]):
+            print(f"  {stage:<12}{stats['count']:>6}{stats['p50']:>8.3f}s{stats['p95']:>8.3f}s"
+                  f"{stats['per_turn']:>9.3f}s{delta(scenario, 'per_turn', stats['per_turn'], stage)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="mcp,mcp-async,app",
+                        help=f"逗号分隔的场景：{', '.join(SCENARIOS)}")
+    parser.add_argument("--sessions", type=int, default=8, help="同时对话的会话数（app场景依次执行）")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话的对话轮数")
+    parser.add_argument("--stream", action="store_true", help="使用流式回复")
+    parser.add_argument("--llm-ms", type=float, default=200, help="模拟GPT调用的首字延迟（毫秒）")
+    parser.add_argument("--token-ms", type=float, default=5, help="模拟流式回复每段之间的间隔（毫秒）")
+    parser.add_argument("--reply-tokens", type=int, default=200, help="模拟主回复的token数")
+    parser.add_argument("--search-ms", type=float, default=300, help="模拟搜索引擎的延迟（毫秒）")
+    parser.add_argument("--page-ms", type=float, default=50, help="模拟网页响应的延迟（毫秒）")
+    parser.add_argument("--no-memory", action="store_true", help="跳过tracemalloc内存统计")
+    parser.add_argument("--json", help="把结果保存为JSON文件")
+    parser.add_argument("--baseline", help="与之前保存的JSON结果对比（括号中为变化比例）")
+    parser.add_argument("--verbose", action="store_true", help="显示管线日志")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+
+    MockOpenAIHandler.latency = args.llm_ms / 1000
+    MockOpenAIHandler.token_delay = args.token_ms / 1000
+    MockOpenAIHandler.reply_tokens = args.reply_tokens
+    PageHandler.delay = args.page_ms / 1000
+    FakeDDGS.delay = args.search_ms / 1000
+    llm_server = start_server(MockOpenAIHandler)
+    page_server = start_server(PageHandler)
+    FakeDDGS.page_port = page_server.server_port
+    mcp_search.DDGS = FakeDDGS
+    base_url = f"http://127.0.0.1:{llm_server.server_port}/v1"
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": {key: value for key, value in vars(args).items() if key not in ("json", "baseline", "verbose")},
+        "results": {}
+    }
+    print(f"提交 {report['commit'] or '未知'}：{args.sessions} 个会话 × {args.turns} 轮，"
+          f"GPT {args.llm_ms:.0f} ms，搜索 {args.search_ms:.0f} ms，网页 {args.page_ms:.0f} ms，"
+          f"回复 {args.reply_tokens} tokens{'（流式）' if args.stream else ''}")
+
+    devnull = open(os.devnull, "w")
+    stdout = sys.stdout
+    try:
+        for scenario in scenarios:
+            if not args.verbose:
+                sys.stdout = devnull
+            try:
+                result = measure(scenario, base_url, args.sessions, args.turns, args.stream)
+                if not args.no_memory:
+                    result["memory"] = measure_memory(scenario, base_url, args.sessions, args.turns, args.stream)
+            except ImportError as e:
+                sys.stdout = stdout
+                print(f"⚠️ 跳过场景 {scenario}: {e}")
+                continue
+            finally:
+                sys.stdout = stdout
+            report["results"][scenario] = result
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        llm_server.shutdown()
+        page_server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("params") != report["params"]:
+            print(f"⚠️ 基准结果（提交 {baseline.get('commit')}）的参数不同，对比仅供参考")
+        print(f"对比基准：提交 {baseline.get('commit')}（{baseline.get('created_at')}）")
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
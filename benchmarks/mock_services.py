@@ -0,0 +1,151 @@
+"""
+基准测试用的本地模拟服务
+- MockOpenAIServer：兼容 /v1/chat/completions 的模拟服务（支持流式、usage、可配置延迟和回复长度）
+- PageServer：返回固定网页的本地HTTP服务（可配置延迟）
+各服务按类属性计数请求次数，基准测试可据此统计每轮的调用数
+- FakeDDGS：不联网的DDGS替身，返回指向PageServer的搜索结果
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def build_page(path: str, paragraphs: int = 40) -> bytes:
+    """生成测试网页：每个路径、每个段落的内容都不同，避免被正文提取和跨网页去重合并"""
+    body = "".join(
+        f"<p>第{i}段（{path}）：孙悟空，齐天大圣，花果山水帘洞美猴王，曾大闹天宫，后保护唐僧西天取经。</p>"
+        for i in range(paragraphs)
+    )
+    return ("<html><head><meta charset='utf-8'><title>测试页面</title></head><body>"
+            "<nav>首页 | 百科 | 登录</nav>" + body + "</body></html>").encode('utf-8')
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 启用keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客户端提前关闭连接（推测回复被取消、抓取超时或已获得足够网页）
+
+
+class MockOpenAIHandler(_QuietHandler):
+    latency = 0.2  # 每次调用的首字延迟（秒）
+    token_delay = 0.005  # 流式输出每段之间的间隔（秒）
+    reply_chunks = 40  # 回复的分段数
+    reply_tokens = 20  # 主回复的token数（按2字符1个token计）
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with MockOpenAIHandler.lock:
+            MockOpenAIHandler.calls += 1
+        time.sleep(self.latency)
+
+        prompt = body['messages'][-1]['content']
+        if body.get('response_format', {}).get('type') == 'json_object':
+            # 搜索决策：用问题本身作为搜索词，保证每轮都是不同的搜索
+            question = prompt.split('用户问题：', 1)[-1].split('\n', 1)[0]
+            content = json.dumps({"need_search": True, "search_query": question, "reason": "模拟决策"},
+                                 ensure_ascii=False)
+        else:
+            content = ("这是模拟的回复内容。" * (self.reply_tokens // 5 + 1))[:self.reply_tokens * 2]
+
+        prompt_tokens = sum(len(m['content']) for m in body['messages']) // 2
+        completion_tokens = len(content) // 2
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+
+        if body.get('stream'):
+            self._stream(body['model'], content, usage)
+        else:
+            self._send_json({
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": body['model'],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": usage
+            })
+
+    def _send_json(self, data):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream(self, model, content, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, chunk_usage=None):
+            chunk = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [], "usage": chunk_usage}
+            if delta is not None:
+                chunk["choices"] = [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        step = max(1, len(content) // self.reply_chunks)
+        for i in range(0, len(content), step):
+            event(content[i:i + step])
+            time.sleep(self.token_delay)
+        event(None, usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class PageHandler(_QuietHandler):
+    delay = 0.05  # 每个网页的响应延迟（秒）
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with PageHandler.lock:
+            PageHandler.requests += 1
+        time.sleep(self.delay)
+        page = build_page(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+
+def start_server(handler) -> ThreadingHTTPServer:
+    """在后台线程中启动服务，返回server（server.server_port为端口）"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.request_queue_size = 256  # 默认积压队列只有5，并发会话多时连接会被拒绝后重试
+    server.server_bind()
+    server.server_activate()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeDDGS:
+    """DDGS替身：等待delay秒后返回max_results条指向PageServer的结果"""
+    delay = 0.3
+    page_port = 0
+    calls = 0
+    lock = threading.Lock()
+
+    def text(self, query, max_results=8, **kwargs):
+        with FakeDDGS.lock:
+            FakeDDGS.calls += 1
+        time.sleep(self.delay)
+        return [
+            {"title": f"{query} - 结果{i}",
+             "href": f"http://127.0.0.1:{self.page_port}/{abs(hash(query))}/{i}",
+             "body": f"{query} 的搜索摘要 {i}"}
+            for i in range(max_results)
+        ]
@@ -0,0 +1,172 @@
+"""
+总结前的本地相关性筛选
+把网页正文切成文本块，用BM25（完全离线）按搜索词和用户问题打分，
+在固定token预算内挑选最相关的块发送给总结模型，代替盲目截取每个网页的前1500字
+"""
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+from token_counter import count_tokens
+
+
+CHUNK_CHARS = 300  # 每个文本块的目标字数
+SUMMARY_TOKEN_BUDGET = 1500  # 一次性总结时发送的资料token预算
+PAGE_TOKEN_BUDGET = 500  # 流水线模式下单个网页发送的资料token预算
+SKIP_SUMMARY_TOKENS = 400  # 相关资料不超过此token数时直接使用原文，不再调用总结
+SKIP_PAGE_TOKENS = 150  # 单个网页的相关资料不超过此token数时直接作为要点，不再调用提炼
+
+WORD_PATTERN = re.compile(r'[一-鿿㐀-䶿]+|[a-z0-9]+')
+SENTENCE_PATTERN = re.compile(r'(?<=[。！？!?；;])')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    切分检索词项：英文/数字按词，中文连续片段拆为字符二元组（单字片段保留单字）
+    与搜索缓存的相似度特征一致，不依赖分词词典
+    """
+    tokens = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if word.isascii() or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def split_chunks(text: str, chunk_chars: int = CHUNK_CHARS) -> List[str]:
+    """按段落切分文本块：短段落合并，超长段落按句子拆开"""
+    pieces = []
+    for paragraph in text.split('\n'):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= chunk_chars:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(s for s in SENTENCE_PATTERN.split(paragraph) if s.strip())
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{piece}" if current else piece
+        while len(current) > chunk_chars * 2:
+            # 没有标点的超长句子按长度硬切
+            chunks.append(current[:chunk_chars])
+            current = current[chunk_chars:]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class BM25:
+    """文本块集合上的BM25打分器"""
+
+    def __init__(self, documents: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        """
+        参数:
+            documents: 已切分词项的文本块列表
+            k1: 词频饱和参数
+            b: 长度归一化参数
+        """
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(doc) for doc in documents]
+        self.lengths = [len(doc) for doc in documents]
+        self.avg_length = (sum(self.lengths) / len(documents)) if documents else 0.0
+        doc_freqs = Counter(term for tf in self.term_freqs for term in tf)
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    def score(self, query_terms: List[str], index: int) -> float:
+        tf = self.term_freqs[index]
+        norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / (self.avg_length or 1))
+        score = 0.0
+        for term in set(query_terms):
+            freq = tf.get(term)
+            if freq:
+                score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+        return score
+
+
+def select_chunks(query: str,
+                  results: List[Dict],
+                  question: str = "",
+                  token_budget: int = SUMMARY_TOKEN_BUDGET,
+                  contents: Optional[List[str]] = None,
+                  model: str = "gpt-4o-mini") -> List[Dict]:
+    """
+    在token预算内挑选与搜索词和用户问题最相关的文本块
+
+    参数:
+        query: 搜索词
+        results: 搜索结果列表
+        question: 用户的原始问题（补充检索词）
+        token_budget: 挑选的文本块总token上限
+        contents: 与results对应的正文（默认使用full_content，可传入去重后的正文）
+        model: 计算token使用的模型
+
+    返回:
+        [{"source": 结果序号, "title", "url", "text", "score", "tokens"}]，按来源和原文顺序排列；
+        有命中检索词的块时只从这些块中挑选，全部未命中时按各来源开头的顺序挑选（score均为0）
+    """
+    contents = contents if contents is not None else [r['full_content'] for r in results]
+    chunks = []
+    for source, (result, content) in enumerate(zip(results, contents)):
+        for position, text in enumerate(split_chunks(content)):
+            chunks.append({"source": source, "position": position, "text": text,
+                           "title": result['title'], "url": result['url']})
+    if not chunks:
+        return []
+
+    query_terms = tokenize(f"{query} {question}")
+    bm25 = BM25([tokenize(chunk['text']) for chunk in chunks])
+    for i, chunk in enumerate(chunks):
+        chunk['score'] = bm25.score(query_terms, i)
+
+    candidates = [c for c in chunks if c['score'] > 0] or chunks
+    return [{key: chunk[key] for key in ('source', 'title', 'url', 'text', 'score', 'tokens')}
+            for chunk in pack_chunks(candidates, token_budget, model)]
+
+
+def pack_chunks(candidates: List[Dict], token_budget: int, model: str = "gpt-4o-mini") -> List[Dict]:
+    """
+    按得分从高到低把文本块装入token预算（得分相同时来源开头的块优先）
+
+    参数:
+        candidates: 带有source/position/text/score的文本块
+        token_budget: 总token上限
+        model: 计算token使用的模型
+
+    返回:
+        选中的文本块（写入tokens字段），按来源和原文顺序排列
+    """
+    selected = []
+    used_tokens = 0
+    for chunk in sorted(candidates, key=lambda c: (-c['score'], c['position'], c['source'])):
+        chunk['tokens'] = count_tokens(chunk['text'], model)
+        if used_tokens + chunk['tokens'] > token_budget:
+            continue
+        selected.append(chunk)
+        used_tokens += chunk['tokens']
+        if token_budget - used_tokens < 20:
+            break
+
+    selected.sort(key=lambda c: (c['source'], c['position']))
+    return selected
+
+
+def format_chunks(chunks: List[Dict]) -> str:
+    """把选中的文本块按来源分组，格式化为资料文本"""
+    sections = []
+    current_source = None
+    for chunk in chunks:
+        if chunk['source'] != current_source:
+            current_source = chunk['source']
+            sections.append(f"【来源 {len(sections) + 1}】{chunk['title']}\n网址：{chunk['url']}\n")
+        sections[-1] += f"\n{chunk['text']}"
+    return "\n\n".join(sections)
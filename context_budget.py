@@ -0,0 +1,160 @@
+"""
+对话上下文的Token预算管理
+保留系统提示词和最近N轮原文，其余历史在预算内从新到旧尽量保留，并保证请求不超过模型上下文窗口
+消息按"静态在前、易变在后"排列（系统提示词 → 记忆摘要 → 历史 → 搜索资料 → 用户消息），
+使逐轮请求的前缀保持逐字节一致，命中服务端的提示词前缀缓存
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+from token_counter import (MESSAGE_OVERHEAD_TOKENS, REPLY_PRIMING_TOKENS, count_message_tokens, count_tokens,
+                           message_tokens)
+
+
+# 模型上下文窗口（token）
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4o-ca": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_LIMIT = 8192
+
+# 每个模型发送的提示词预算（token），控制长对话的费用；可通过环境变量 CHAT_PROMPT_BUDGET 统一覆盖
+PROMPT_BUDGETS = {
+    "gpt-4o-ca": 12000,
+    "gpt-4o": 12000,
+    "gpt-4o-mini": 16000,
+}
+DEFAULT_PROMPT_BUDGET = 6000
+
+# 始终原样保留的最近对话轮数（一轮 = 用户消息 + 角色回复）
+DEFAULT_KEEP_LAST_TURNS = 4
+
+SAFETY_MARGIN_TOKENS = 256  # 本地计数与服务端计数的误差余量
+
+
+def get_context_limit(model: str) -> int:
+    return MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+
+
+def get_prompt_budget(model: str) -> int:
+    env_budget = os.getenv('CHAT_PROMPT_BUDGET')
+    if env_budget:
+        return int(env_budget)
+    return PROMPT_BUDGETS.get(model, DEFAULT_PROMPT_BUDGET)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """从末尾截断文本，使其不超过max_tokens"""
+    if max_tokens <= 0:
+        return ""
+    tokens = count_tokens(text, model)
+    while text and tokens > max_tokens:
+        # 按比例估算保留长度，逐步逼近
+        keep = max(0, int(len(text) * max_tokens / tokens) - 1)
+        text = text[:keep]
+        tokens = count_tokens(text, model)
+    return text
+
+
+def fit_messages(system_prompt: str,
+                 history: List[Dict],
+                 user_message: str,
+                 model: str,
+                 max_tokens: int = 2000,
+                 budget: Optional[int] = None,
+                 keep_last_turns: int = DEFAULT_KEEP_LAST_TURNS,
+                 volatile_context: str = "",
+                 memory_summary: str = "") -> Tuple[List[Dict], Dict]:
+    """
+    在token预算内构建消息列表
+
+    参数:
+        system_prompt: 系统提示词（始终保留）
+        history: 对话历史（按时间顺序）
+        user_message: 本轮用户消息
+        model: 模型名称
+        max_tokens: 回复预留的token数
+        budget: 提示词预算（默认按模型取PROMPT_BUDGETS）
+        keep_last_turns: 始终原样保留的最近轮数（超出上下文窗口时才会被裁剪）
+        volatile_context: 本轮的易变内容（如搜索资料），作为系统消息放在历史之后、用户消息之前，
+                          不破坏前面的缓存前缀；超出上下文窗口时优先截断
+        memory_summary: 早期对话的滚动摘要，作为第二条系统消息放在历史之前
+
+    返回:
+        (messages, stats)，stats包含 prompt_tokens / budget / dropped_messages / truncated
+    """
+    hard_limit = get_context_limit(model) - max_tokens - SAFETY_MARGIN_TOKENS
+    budget = min(budget if budget is not None else get_prompt_budget(model), hard_limit)
+
+    system = {"role": "system", "content": system_prompt}
+    history = [{"role": m["role"], "content": m["content"]} for m in history]
+    user = {"role": "user", "content": user_message}
+    memory = []
+    if memory_summary:
+        memory = [{"role": "system", "content": f"【此前对话摘要】\n{memory_summary}"}]
+    context = [{"role": "system", "content": volatile_context}] if volatile_context else []
+
+    history_tokens = [message_tokens(m, model) for m in history]
+    memory_tokens = sum(message_tokens(m, model) for m in memory)
+    fixed_tokens = (message_tokens(system, model) + memory_tokens +
+                    sum(message_tokens(m, model) for m in context) +
+                    message_tokens(user, model) + REPLY_PRIMING_TOKENS)
+
+    # 最近N轮原样保留，更早的历史在预算内从新到旧保留
+    keep_count = min(len(history), keep_last_turns * 2)
+    start = len(history) - keep_count
+    total = fixed_tokens + sum(history_tokens[start:])
+    while start > 0 and total + history_tokens[start - 1] <= budget:
+        start -= 1
+        total += history_tokens[start]
+
+    # 超出上下文窗口时连最近N轮也要裁剪
+    while start < len(history) and total > hard_limit:
+        total -= history_tokens[start]
+        start += 1
+
+    # 保证历史从用户消息开始，避免孤立的角色回复
+    while start < len(history) and history[start]["role"] != "user":
+        total -= history_tokens[start]
+        start += 1
+
+    truncated = False
+    if total > hard_limit and context:
+        # 仍然放不下：截断本轮的易变内容
+        overflow = total - hard_limit
+        context_tokens = count_tokens(volatile_context, model)
+        volatile_context = truncate_to_tokens(volatile_context, context_tokens - overflow, model)
+        context = [{"role": "system", "content": volatile_context}] if volatile_context else []
+        total = (message_tokens(system, model) + memory_tokens +
+                 sum(message_tokens(m, model) for m in context) +
+                 message_tokens(user, model) + REPLY_PRIMING_TOKENS + sum(history_tokens[start:]))
+        truncated = True
+    if total > hard_limit:
+        # 最后手段：截断用户消息
+        fixed_tokens = (message_tokens(system, model) + memory_tokens +
+                        sum(message_tokens(m, model) for m in context) + REPLY_PRIMING_TOKENS)
+        remaining = hard_limit - fixed_tokens - MESSAGE_OVERHEAD_TOKENS - sum(history_tokens[start:])
+        user = {"role": "user", "content": truncate_to_tokens(user_message, remaining, model)}
+        truncated = True
+
+    messages = [system]
+    messages.extend(memory)
+    messages.extend(history[start:])
+    messages.extend(context)
+    messages.append(user)
+
+    prompt_tokens = count_message_tokens(messages, model)
+    stats = {
+        "prompt_tokens": prompt_tokens,
+        "budget": budget,
+        "dropped_messages": start,
+        "truncated": truncated
+    }
+    if start or truncated:
+        print(f"✂️ 上下文裁剪：丢弃 {start} 条早期消息{'，并截断超长内容' if truncated else ''}"
+              f"（{prompt_tokens}/{budget} tokens）")
+    return messages, stats
@@ -0,0 +1,366 @@
+"""
+流式网页正文提取
+分块读取响应（有字节上限），优先使用声明的字符集，边解码边用增量HTML解析器提取文本，
+按文本块的正文密度（长度、链接占比、标点数量）打分，只保留得分最高的块，
+避免预算被菜单、面包屑、版权声明等模板内容占满
+"""
+import codecs
+import re
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Set
+
+import requests
+
+
+MAX_BYTES = 512 * 1024  # 单个网页最多读取的字节数
+CHUNK_SIZE = 16 * 1024
+SNIFF_BYTES = 4096  # 在开头多少字节内查找 <meta charset>
+DETECT_BYTES = 64 * 1024  # 没有声明字符集时，只对开头这部分做探测
+CANDIDATE_FACTOR = 4  # 收集到 max_length 多少倍的正文候选后停止读取
+
+# 不含正文的标签，整块跳过
+SKIP_TAGS = {'script', 'style', 'nav', 'footer', 'header', 'noscript', 'svg', 'template', 'iframe',
+             'form', 'button', 'select', 'textarea'}
+# 块级标签，前后换行
+BLOCK_TAGS = {
+    'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'td', 'th', 'table', 'section', 'article', 'main',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'dd', 'dt', 'dl', 'title', 'aside',
+}
+# 没有结束标签的元素，不入栈
+VOID_TAGS = {'br', 'hr', 'img', 'meta', 'link', 'input', 'source', 'wbr', 'area', 'base', 'col', 'embed'}
+TITLE_TAGS = {'title', 'h1', 'h2', 'h3'}
+
+# class/id 中出现这些词的容器通常是模板内容，降低得分
+BOILERPLATE_PATTERN = re.compile(
+    r'(nav|menu|breadcrumb|crumb|footer|sidebar|side-bar|comment|share|social|related|recommend|'
+    r'advert|banner|toolbar|login|copyright|catalog|toc|pagination|pager|tags)', re.I)
+PUNCTUATION_CHARS = set('，。；：！？、,.;:!?')
+
+MIN_BLOCK_CHARS = 8  # 短于此长度且不是标题的块视为模板内容
+MAX_LINK_DENSITY = 0.5  # 链接文字占比超过此值的块直接丢弃
+BOILERPLATE_PENALTY = 0.2
+TITLE_BONUS = 40
+MIN_SCORE_RATIO = 0.15  # 得分低于最高分此比例的块不选
+
+CHARSET_HEADER_PATTERN = re.compile(r'charset\s*=\s*["\']?([\w\-:.]+)', re.I)
+META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w\-:.]+)', re.I)
+TEXT_CONTENT_TYPES = ('text/html', 'application/xhtml', 'text/plain', 'application/xml', 'text/xml')
+PARAGRAPH_NORMALIZE_PATTERN = re.compile(r'[\s\W_]+')
+
+
+class TextExtractor(HTMLParser):
+    """增量HTML正文提取器：把页面切成文本块并打分，收集到足够的候选正文后置done标志"""
+
+    def __init__(self, target_length: int):
+        super().__init__(convert_charrefs=True)
+        self.target_length = target_length
+        self.blocks = []  # (文档顺序, 文本, 得分)
+        self.candidate_length = 0
+        self.done = False
+
+        self._stack = []  # (标签, 是否跳过, 是否模板容器)
+        self._skip_depth = 0
+        self._boilerplate_depth = 0
+        self._link_depth = 0
+        self._parts = []
+        self._text_length = 0
+        self._link_length = 0
+        self._block_tag = None
+        self._block_boilerplate = False
+
+    # ---- 标签栈 ----
+
+    def handle_starttag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self._flush()
+            self._block_tag = tag
+        if tag in VOID_TAGS:
+            return
+
+        skip = tag in SKIP_TAGS
+        hints = ' '.join(value for name, value in attrs if name in ('class', 'id') and value)
+        boilerplate = tag == 'aside' or bool(hints and BOILERPLATE_PATTERN.search(hints))
+        self._stack.append((tag, skip, boilerplate))
+        self._skip_depth += skip
+        self._boilerplate_depth += boilerplate
+        self._link_depth += tag == 'a'
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in BLOCK_TAGS:
+            self._flush()
+        if not any(entry[0] == tag for entry in self._stack):
+            return
+        # 容错：未闭合的子元素随父元素一起出栈
+        while self._stack:
+            name, skip, boilerplate = self._stack.pop()
+            self._skip_depth -= skip
+            self._boilerplate_depth -= boilerplate
+            self._link_depth -= name == 'a'
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        if self._skip_depth or self.done:
+            return
+        text = data.strip()
+        if not text:
+            return
+        # 相邻的英文/数字片段之间补空格，避免单词粘连；中文不加空格
+        previous = self._parts[-1] if self._parts else ''
+        if previous[-1:].isascii() and previous[-1:].isalnum() and text[0].isascii() and text[0].isalnum():
+            text = ' ' + text
+        self._parts.append(text)
+        self._text_length += len(text)
+        if self._link_depth:
+            self._link_length += len(text)
+        if self._boilerplate_depth:
+            self._block_boilerplate = True
+
+    # ---- 文本块打分 ----
+
+    def _flush(self):
+        if not self._parts:
+            return
+        text = ''.join(self._parts).strip()
+        length = self._text_length
+        link_density = self._link_length / length if length else 1.0
+        boilerplate = self._block_boilerplate
+        is_title = self._block_tag in TITLE_TAGS
+        self._parts = []
+        self._text_length = 0
+        self._link_length = 0
+        self._block_boilerplate = False
+
+        if link_density > MAX_LINK_DENSITY or (length < MIN_BLOCK_CHARS and not is_title):
+            return
+        punctuation = sum(1 for ch in text if ch in PUNCTUATION_CHARS)
+        score = length * (1 - link_density) + punctuation * 3
+        if is_title:
+            score += TITLE_BONUS
+        if boilerplate:
+            score *= BOILERPLATE_PENALTY
+        self.blocks.append((len(self.blocks), text, score))
+
+        if not boilerplate:
+            self.candidate_length += length
+            if self.candidate_length >= self.target_length * CANDIDATE_FACTOR:
+                self.done = True
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def get_text(self) -> str:
+        """按得分从高到低选取文本块直到填满目标长度，再按原文顺序输出"""
+        self._flush()
+        selected = []
+        seen = set()
+        total = 0
+        ranked = sorted(self.blocks, key=lambda b: b[2], reverse=True)
+        min_score = ranked[0][2] * MIN_SCORE_RATIO if ranked else 0
+        for block in ranked:
+            if block[2] < min_score:
+                break
+            key = normalize_paragraph(block[1])
+            if key in seen:
+                continue
+            seen.add(key)
+            selected.append(block)
+            total += len(block[1])
+            if total >= self.target_length:
+                break
+        selected.sort(key=lambda b: b[0])
+        return '\n'.join(block[1] for block in selected)
+
+
+def normalize_paragraph(text: str) -> str:
+    """段落去重用的规范化：去掉空白和标点，统一小写"""
+    return PARAGRAPH_NORMALIZE_PATTERN.sub('', text).lower()
+
+
+def dedupe_paragraphs(texts: List[str], min_length: int = 8, seen: Optional[Set[str]] = None) -> List[str]:
+    """
+    跨多个网页去掉重复段落（镜像站、转载页面常见），只保留第一次出现的位置
+
+    参数:
+        texts: 各网页的文本（段落以换行分隔）
+        min_length: 规范化后短于此长度的段落不参与去重
+        seen: 已出现过的段落集合（会被更新），逐个网页增量去重时传入同一个集合
+
+    返回:
+        去重后的文本列表，与输入一一对应
+    """
+    seen = set() if seen is None else seen
+    deduped = []
+    for text in texts:
+        kept = []
+        for paragraph in text.split('\n'):
+            key = normalize_paragraph(paragraph)
+            if len(key) >= min_length:
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.append(paragraph)
+        deduped.append('\n'.join(kept))
+    return deduped
+
+
+def normalize_encoding(name: Optional[str]) -> Optional[str]:
+    """校验并规范化字符集名称，gb2312/gbk 统一用超集 gb18030"""
+    if not name:
+        return None
+    try:
+        name = codecs.lookup(name).name
+    except LookupError:
+        return None
+    if name in ('gb2312', 'gbk'):
+        return 'gb18030'
+    return name
+
+
+def declared_encoding(content_type: str, head: bytes) -> Optional[str]:
+    """从Content-Type响应头或页面开头的 <meta charset> 中获取声明的字符集"""
+    match = CHARSET_HEADER_PATTERN.search(content_type or '')
+    if match:
+        encoding = normalize_encoding(match.group(1))
+        if encoding:
+            return encoding
+    match = META_CHARSET_PATTERN.search(head[:SNIFF_BYTES])
+    if match:
+        return normalize_encoding(match.group(1).decode('ascii', 'ignore'))
+    return None
+
+
+def detect_encoding(data: bytes) -> str:
+    """没有声明字符集时的探测：先试UTF-8，再对开头一部分做字符集探测"""
+    sample = data[:DETECT_BYTES]
+    try:
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # 采样末尾被截断的多字节字符不算错误
+        if e.start >= len(sample) - 3:
+            return 'utf-8'
+    try:
+        from charset_normalizer import from_bytes
+        best = from_bytes(sample).best()
+        if best is not None:
+            return normalize_encoding(best.encoding) or 'utf-8'
+    except ImportError:
+        pass
+    return 'utf-8'
+
+
+class PageTextReader:
+    """
+    推送式的网页正文读取器：调用方逐块喂入响应字节，feed返回True时即可停止读取
+    同步（requests）和异步（httpx）抓取共用
+    """
+
+    def __init__(self, content_type: str, max_length: int = 3000, max_bytes: int = MAX_BYTES):
+        """
+        参数:
+            content_type: 响应的Content-Type头
+            max_length: 提取的最大字符数
+            max_bytes: 最多读取的字节数
+        """
+        self.content_type = content_type or ''
+        self.max_length = max_length
+        self.max_bytes = max_bytes
+        self.accepted = not content_type or content_type.lower().startswith(TEXT_CONTENT_TYPES)
+        self.bytes_read = 0
+        # 多读一些再截断，保证截断点落在完整的文本中
+        self._extractor = TextExtractor(target_length=max_length + 1)
+        self._head = b''
+        self._body = None  # 未声明字符集时缓冲的全部字节
+        self._decoder = None
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        喂入一块响应字节
+
+        返回:
+            是否已读到足够内容（达到字节上限或收集到足够正文）
+        """
+        if not self.accepted:
+            return True
+        chunk = chunk[:self.max_bytes - self.bytes_read]
+        self.bytes_read += len(chunk)
+
+        if self._decoder is None and self._body is None:
+            self._head += chunk
+            if len(self._head) < SNIFF_BYTES and self.bytes_read < self.max_bytes:
+                return False
+            self._start()
+        elif self._decoder is not None:
+            # 已声明字符集：边读边解码边解析，文本足够即停止
+            self._extractor.feed(self._decoder.decode(chunk))
+        else:
+            self._body.append(chunk)
+        return self._extractor.done or self.bytes_read >= self.max_bytes
+
+    def _start(self):
+        """开头的字节已读够，确定字符集"""
+        encoding = declared_encoding(self.content_type, self._head)
+        if encoding is None:
+            # 未声明字符集：读取到上限后统一探测、解析
+            self._body = [self._head]
+        else:
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            self._extractor.feed(self._decoder.decode(self._head))
+        self._head = b''
+
+    def finish(self) -> str:
+        """
+        结束读取并返回正文
+
+        返回:
+            网页文本，超过max_length时截断并追加"..."
+        """
+        if not self.accepted:
+            return ""
+        if self._decoder is None and self._body is None:
+            self._start()
+        if self._body is not None:
+            data = b''.join(self._body)
+            self._body = []
+            self._extractor.feed(data.decode(detect_encoding(data), errors='replace'))
+
+        self._extractor.close()
+        text = self._extractor.get_text()
+
+        # 限制长度
+        if len(text) > self.max_length:
+            text = text[:self.max_length] + "..."
+        return text
+
+
+def extract_text_from_response(response: requests.Response,
+                               max_length: int = 3000,
+                               max_bytes: int = MAX_BYTES,
+                               stats: Optional[Dict] = None) -> str:
+    """
+    从流式响应（stream=True）中提取网页文本
+
+    参数:
+        response: requests响应对象（以stream=True发起）
+        max_length: 提取的最大字符数
+        max_bytes: 最多读取的字节数
+        stats: 传入字典时写入 bytes_read（实际读取的字节数）
+
+    返回:
+        网页文本，超过max_length时截断并追加"..."
+    """
+    reader = PageTextReader(response.headers.get('Content-Type', ''), max_length, max_bytes)
+    if reader.accepted:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if reader.feed(chunk):
+                break
+    text = reader.finish()
+    if stats is not None:
+        stats['bytes_read'] = reader.bytes_read
+    return text
@@ -0,0 +1,191 @@
+"""
+共享的网页抓取连接池
+进程内所有MCPSearchEngine共用一个requests.Session：按主机复用keep-alive连接，
+避免每个网页都重新做DNS解析、TCP握手和TLS握手，并限制对同一主机的并发请求数
+异步管线（mcp_async）同一个事件循环内的所有搜索引擎共用一个httpx.AsyncClient
+"""
+import asyncio
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    import httpx  # 异步抓取使用（openai已依赖）
+except ImportError:
+    httpx = None
+
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+}
+
+
+class HostBusyError(TimeoutError):
+    """等待同一主机的并发名额超时（该主机的请求都被占满）"""
+
+
+class PooledFetcher:
+    """带连接池和按主机并发限制的HTTP抓取器（线程安全）"""
+
+    def __init__(self,
+                 pool_connections: int = 32,
+                 pool_maxsize: int = 8,
+                 per_host_limit: int = 4):
+        """
+        参数:
+            pool_connections: 缓存连接池的主机数量
+            pool_maxsize: 每个主机保留的keep-alive连接数
+            per_host_limit: 对同一主机同时进行的请求数上限
+        """
+        self.per_host_limit = per_host_limit
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host_limit)
+                self._host_semaphores[host] = semaphore
+            self.requests_sent += 1
+            return semaphore
+
+    @contextmanager
+    def get(self, url: str, timeout: float = 5, headers: Optional[Dict] = None, stream: bool = False):
+        """
+        发起GET请求（上下文管理器），退出时连接归还连接池
+        等待同一主机的并发名额最多timeout秒，超时抛出HostBusyError，不会拖过调用方的抓取时限
+
+        用法:
+            with fetcher.get(url) as response:
+                text = response.text
+        """
+        semaphore = self._host_semaphore(url)
+        if not semaphore.acquire(timeout=timeout):
+            raise HostBusyError(f"等待主机 {urlsplit(url).netloc} 的并发名额超时（{timeout}秒）")
+        try:
+            response = self.session.get(url, timeout=timeout, headers=headers, stream=stream)
+            try:
+                yield response
+            finally:
+                response.close()
+        finally:
+            semaphore.release()
+
+    def close(self):
+        self.session.close()
+
+
+_shared_fetcher = None
+_shared_fetcher_lock = threading.Lock()
+
+
+def get_shared_fetcher() -> PooledFetcher:
+    """获取进程级共享的抓取器（所有搜索引擎实例共用连接池）"""
+    global _shared_fetcher
+    with _shared_fetcher_lock:
+        if _shared_fetcher is None:
+            _shared_fetcher = PooledFetcher()
+        return _shared_fetcher
+
+
+class AsyncPooledFetcher:
+    """
+    PooledFetcher的异步版本：httpx.AsyncClient连接池 + 按主机并发限制
+    httpx.AsyncClient和asyncio.Semaphore都绑定事件循环，只能在创建它的事件循环中使用
+    """
+
+    def __init__(self,
+                 max_connections: int = 64,
+                 max_keepalive_connections: int = 32,
+                 per_host_limit: int = 4,
+                 timeout: float = 5):
+        """
+        参数:
+            max_connections: 连接池的最大连接数
+            max_keepalive_connections: 保留的keep-alive连接数
+            per_host_limit: 对同一主机同时进行的请求数上限
+            timeout: 默认请求超时（秒）
+        """
+        if httpx is None:
+            raise ImportError("异步抓取需要httpx: pip install httpx")
+        self.per_host_limit = per_host_limit
+        self.client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive_connections)
+        )
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.requests_sent = 0
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        # 只在事件循环线程中调用，不需要加锁
+        host = urlsplit(url).netloc.lower()
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host_limit)
+            self._host_semaphores[host] = semaphore
+        self.requests_sent += 1
+        return semaphore
+
+    @asynccontextmanager
+    async def stream(self, url: str, timeout: float = 5, headers: Optional[Dict] = None):
+        """
+        发起流式GET请求（异步上下文管理器），退出时连接归还连接池
+        等待同一主机的并发名额最多timeout秒，超时抛出HostBusyError
+
+        用法:
+            async with fetcher.stream(url) as response:
+                async for chunk in response.aiter_bytes():
+                    ...
+        """
+        semaphore = self._host_semaphore(url)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise HostBusyError(f"等待主机 {urlsplit(url).netloc} 的并发名额超时（{timeout}秒）") from None
+        try:
+            async with self.client.stream('GET', url, headers=headers, timeout=timeout) as response:
+                yield response
+        finally:
+            semaphore.release()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# 每个事件循环一个异步抓取器，事件循环被回收后自动释放
+_shared_async_fetchers = weakref.WeakKeyDictionary()
+
+
+def get_shared_async_fetcher() -> AsyncPooledFetcher:
+    """获取当前事件循环共享的异步抓取器（同一事件循环内的所有异步搜索引擎共用连接池），需在协程中调用"""
+    loop = asyncio.get_running_loop()
+    fetcher = _shared_async_fetchers.get(loop)
+    if fetcher is None:
+        fetcher = AsyncPooledFetcher()
+        _shared_async_fetchers[loop] = fetcher
+    return fetcher
+
+
+async def close_shared_async_fetcher():
+    """关闭当前事件循环共享的异步抓取器（事件循环结束前调用）"""
+    fetcher = _shared_async_fetchers.pop(asyncio.get_running_loop(), None)
+    if fetcher is not None:
+        await fetcher.aclose()
@@ -6,7 +6,6 @@ echo.
 
 echo 正在安装搜索相关依赖...
 pip install duckduckgo-search>=3.9.0
-pip install bs4
 pip install requests>=2.31.0
 
 echo.
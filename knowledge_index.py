@@ -0,0 +1,212 @@
+"""
+角色本地知识库
+每个角色一个语料目录（knowledge/<角色ID>/ 下的 .txt / .md 文件），切块后建立BM25索引，
+需要搜索时先查本地知识库，命中足够可信时直接使用，跳过网络搜索和网页抓取（离线也可用）
+"""
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from characters import CHARACTERS
+from chunk_select import BM25, format_chunks, pack_chunks, split_chunks, tokenize
+
+
+DEFAULT_KNOWLEDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge")
+CORPUS_EXTENSIONS = ('.txt', '.md')
+KNOWLEDGE_TOKEN_BUDGET = 1000  # 命中时作为资料使用的token预算
+MIN_COVERAGE = 0.6  # 最相关文本块至少覆盖搜索词项的比例（不计角色名）
+
+
+class CharacterIndex:
+    """单个角色语料的BM25索引"""
+
+    def __init__(self, char_id: str, directory: str, signature: Tuple):
+        """
+        参数:
+            char_id: 角色ID
+            directory: 语料目录
+            signature: 语料文件的(路径, 大小, 修改时间)，用于判断是否需要重建
+        """
+        self.char_id = char_id
+        self.signature = signature
+        self.chunks: List[Dict] = []
+        for source, (name, _, _) in enumerate(signature):
+            with open(os.path.join(directory, name), encoding='utf-8', errors='replace') as f:
+                text = f.read()
+            title = os.path.splitext(name)[0]
+            url = f"knowledge/{char_id}/{name}"
+            for position, chunk in enumerate(split_chunks(text)):
+                self.chunks.append({"source": source, "position": position, "text": chunk,
+                                    "title": title, "url": url})
+        self.terms = [tokenize(chunk['text']) for chunk in self.chunks]
+        self.term_sets = [set(terms) for terms in self.terms]
+        self.bm25 = BM25(self.terms)
+
+    def search(self, query: str, question: str = "", exclude_terms=()) -> Tuple[List[Dict], float]:
+        """
+        检索与搜索词和用户问题相关的文本块
+
+        参数:
+            query: 搜索词
+            question: 用户的原始问题（补充检索词）
+            exclude_terms: 不计入覆盖率的词项（角色名等每个文本块都可能出现的词）
+
+        返回:
+            (命中的文本块（带score，按得分从高到低）, 最相关文本块对搜索词项的覆盖率)
+        """
+        query_terms = tokenize(f"{query} {question}")
+        hits = []
+        for i, chunk in enumerate(self.chunks):
+            score = self.bm25.score(query_terms, i)
+            if score > 0:
+                hits.append(dict(chunk, score=score, index=i))
+        if not hits:
+            return [], 0.0
+        hits.sort(key=lambda c: c['score'], reverse=True)
+
+        key_terms = set(tokenize(query)) - set(exclude_terms)
+        if not key_terms:
+            return hits, 1.0
+        coverage = len(key_terms & self.term_sets[hits[0]['index']]) / len(key_terms)
+        return hits, coverage
+
+
+class KnowledgeBase:
+    """所有角色的本地知识库（线程安全），语料文件变化后自动重建对应角色的索引"""
+
+    def __init__(self,
+                 root: str = DEFAULT_KNOWLEDGE_DIR,
+                 min_coverage: float = MIN_COVERAGE,
+                 token_budget: int = KNOWLEDGE_TOKEN_BUDGET):
+        """
+        参数:
+            root: 知识库根目录，每个角色一个子目录
+            min_coverage: 判定为可信命中的最低覆盖率
+            token_budget: 命中时返回资料的token预算
+        """
+        self.root = root
+        self.min_coverage = min_coverage
+        self.token_budget = token_budget
+        self._indexes: Dict[str, CharacterIndex] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def character_id(character: Dict) -> Optional[str]:
+        """根据角色信息字典找到角色ID"""
+        if character.get('id'):
+            return character['id']
+        for char_id, info in CHARACTERS.items():
+            if info is character or info['name'] == character.get('name'):
+                return char_id
+        return None
+
+    def _signature(self, directory: str) -> Tuple:
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith(CORPUS_EXTENSIONS))
+        except OSError:
+            return ()
+        signature = []
+        for name in names:
+            stat = os.stat(os.path.join(directory, name))
+            signature.append((name, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def get_index(self, char_id: str) -> Optional[CharacterIndex]:
+        """获取角色的索引，没有语料时返回None"""
+        directory = os.path.join(self.root, char_id)
+        signature = self._signature(directory)
+        with self._lock:
+            index = self._indexes.get(char_id)
+            if index is not None and index.signature == signature:
+                return index
+            if not signature:
+                self._indexes.pop(char_id, None)
+                return None
+            index = CharacterIndex(char_id, directory, signature)
+            self._indexes[char_id] = index
+            print(f"📚 已建立 {char_id} 的本地知识索引（{len(signature)} 个文件，{len(index.chunks)} 个文本块）")
+            return index
+
+    def lookup(self, character: Dict, query: str, question: str = "") -> Optional[Tuple[str, List[Dict]]]:
+        """
+        查询角色的本地知识库
+
+        参数:
+            character: 角色信息字典
+            query: 搜索词
+            question: 用户的原始问题
+
+        返回:
+            可信命中时返回 (资料文本, 来源列表)，格式与网络搜索的 (总结, 搜索结果) 相同；否则返回None
+        """
+        char_id = self.character_id(character)
+        index = self.get_index(char_id) if char_id else None
+        if index is None:
+            return None
+
+        hits, coverage = index.search(query, question, exclude_terms=tokenize(character.get('name', '')))
+        confident = bool(hits) and coverage >= self.min_coverage
+        with self._lock:
+            if confident:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not confident:
+            if hits:
+                print(f"📚 本地知识库覆盖率 {coverage:.0%}，不足以回答，继续网络搜索")
+            return None
+
+        chunks = pack_chunks(hits, self.token_budget)
+        results = []
+        for source in sorted({c['source'] for c in chunks}):
+            texts = [c['text'] for c in chunks if c['source'] == source]
+            first = next(c for c in chunks if c['source'] == source)
+            results.append({
+                'title': first['title'],
+                'url': first['url'],
+                'snippet': texts[0][:200],
+                'full_content': "\n".join(texts)
+            })
+        print(f"📚 本地知识库命中（覆盖率 {coverage:.0%}，{len(chunks)} 个文本块），跳过网络搜索")
+        return format_chunks(chunks), results
+
+    def stats(self) -> Dict:
+        """返回知识库统计：已索引角色数、文本块数和命中情况"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "characters": len(self._indexes),
+                "chunks": sum(len(index.chunks) for index in self._indexes.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+_shared_knowledge_base = None
+_shared_knowledge_base_lock = threading.Lock()
+
+
+def get_shared_knowledge_base() -> Optional[KnowledgeBase]:
+    """
+    获取进程级共享的本地知识库（所有会话共用）
+    可通过环境变量配置：
+        MCP_KNOWLEDGE_DIR           知识库根目录（默认 knowledge/，设为空字符串关闭）
+        MCP_KNOWLEDGE_MIN_COVERAGE  判定为可信命中的最低覆盖率（默认0.6）
+
+    返回:
+        KnowledgeBase，关闭时返回None
+    """
+    global _shared_knowledge_base
+    root = os.getenv('MCP_KNOWLEDGE_DIR', DEFAULT_KNOWLEDGE_DIR)
+    if not root:
+        return None
+    with _shared_knowledge_base_lock:
+        if _shared_knowledge_base is None:
+            _shared_knowledge_base = KnowledgeBase(
+                root=root,
+                min_coverage=float(os.getenv('MCP_KNOWLEDGE_MIN_COVERAGE', MIN_COVERAGE))
+            )
+        return _shared_knowledge_base
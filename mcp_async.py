@@ -0,0 +1,581 @@
+"""
+MCP搜索增强的异步版本
+基于AsyncOpenAI和httpx.AsyncClient，搜索决策、区域策略、网页抓取和总结都不阻塞事件循环，
+多个会话可以共用一个事件循环；决策、提示词、资料挑选、缓存、预算和结果字段与同步版本（mcp_search）共用同一份实现，
+这里只负责异步I/O和调度。缓存读写（SQLite）、网页正文解析和BM25挑选在线程中执行
+"""
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+
+from utils import astream_chat_completion
+from pricing import UsageTracker
+from http_fetcher import AsyncPooledFetcher, get_shared_async_fetcher
+from html_extract import CHUNK_SIZE, PageTextReader
+from mcp_search import (NO_RESULTS, ChatManagerBase, SearchEngineBase, SpeculativeCompletion, SummaryPipeline)
+from page_cache import PageCache
+from search_strategies import SEARCH_STRATEGIES
+from telemetry import TurnTrace, activate, deactivate, span
+
+
+class AsyncMCPSearchEngine(SearchEngineBase):
+    """MCPSearchEngine的异步版本"""
+
+    def __init__(self,
+                 client: AsyncOpenAI,
+                 fetcher: Optional[AsyncPooledFetcher] = None,
+                 **kwargs):
+        """
+        参数:
+            client: AsyncOpenAI客户端
+            fetcher: 异步网页抓取器（默认使用当前事件循环共享的连接池，所有异步搜索引擎共用）
+            其余参数见SearchEngineBase
+        """
+        super().__init__(client, **kwargs)
+        self._fetcher = fetcher
+
+    @property
+    def fetcher(self) -> AsyncPooledFetcher:
+        # 共享抓取器绑定事件循环，首次抓取时才获取
+        return self._fetcher if self._fetcher is not None else get_shared_async_fetcher()
+
+    async def _complete(self, stage: str, request: Dict, usage: Optional[UsageTracker] = None, **attrs) -> str:
+        """调用小模型，记录阶段耗时和用量，返回回复文本"""
+        with span(stage, model=request["model"], **attrs) as span_attrs:
+            response = await self.client.chat.completions.create(**request)
+            return self._read_reply(stage, request, response, usage, span_attrs)
+
+    # ---- 搜索决策 ----
+
+    async def decide_search_with_llm(self, user_message: str, character: Dict,
+                                     usage: Optional[UsageTracker] = None) -> Dict:
+        """调用GPT判断是否需要搜索（"source": "llm"）"""
+        return self._llm_decision(await self.should_search(user_message, character['name'], usage))
+
+    async def decide_search(self, user_message: str, character: Dict, usage: Optional[UsageTracker] = None) -> Dict:
+        """先用本地规则快速判断，模棱两可时再调用GPT"""
+        decision = self.decide_search_locally(user_message, character)
+        if decision is None:
+            decision = await self.decide_search_with_llm(user_message, character, usage)
+        return decision
+
+    async def should_search(self, user_message: str, character_name: str,
+                            usage: Optional[UsageTracker] = None) -> Dict:
+        """使用GPT判断是否需要进行网络搜索，返回 {"need_search", "search_query", "reason"}"""
+        try:
+            return json.loads(await self._complete("decision", self.decision_request(user_message, character_name),
+                                                   usage))
+        except Exception as e:
+            return self._decision_failed(e)
+
+    # ---- 网页抓取 ----
+
+    async def fetch_webpage_content(self, url: str, max_length: int = 3000) -> str:
+        """抓取网页全文内容（先查网页缓存；流式读取，有字节上限，提取到足够文本即停止）"""
+        with span("fetch", url=url, hit=False, bytes=0) as attrs:
+            cached = await asyncio.to_thread(self._cached_page, url, max_length)
+            if cached and cached["fresh"]:
+                attrs["hit"] = True
+                return cached["text"]
+
+            try:
+                headers = PageCache.conditional_headers(cached)
+                async with self.fetcher.stream(url, timeout=5, headers=headers or None) as response:
+                    attrs["status"] = response.status_code
+                    if response.status_code == 304 and cached:
+                        await asyncio.to_thread(self._mark_revalidated, url, cached)
+                        attrs["hit"] = True
+                        return cached["text"]
+
+                    reader = PageTextReader(response.headers.get('Content-Type', ''), max_length)
+                    if reader.accepted:
+                        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                            # 解码和HTML解析在线程中执行，不阻塞其他会话
+                            if await asyncio.to_thread(reader.feed, chunk):
+                                break
+                    text = await asyncio.to_thread(reader.finish)
+                    attrs["bytes"] = reader.bytes_read
+                    await asyncio.to_thread(self._store_page, url, text, max_length, response.status_code,
+                                            response.headers, reader.bytes_read)
+                    return text
+
+            except Exception as e:
+                print(f"  ⚠️ 无法抓取网页 {url}: {e}")
+                attrs["error"] = type(e).__name__
+                # 重新验证失败时沿用过期的缓存
+                return cached["text"] if cached else ""
+
+    async def fetch_pages(self,
+                          urls: List[str],
+                          first_k: Optional[int] = None,
+                          deadline: Optional[float] = None) -> List[str]:
+        """
+        并发抓取多个网页全文，超时或已获得K个有效网页时取消其余请求
+
+        返回:
+            与urls顺序一致的网页文本列表，失败或被取消的为空字符串
+        """
+        contents = [""] * len(urls)
+        if not urls:
+            return contents
+
+        deadline = self.fetch_deadline if deadline is None else deadline
+        end_time = time.monotonic() + deadline
+        tasks = {asyncio.ensure_future(self.fetch_webpage_content(url)): i for i, url in enumerate(urls)}
+        pending = set(tasks)
+        good_pages = 0
+
+        try:
+            while pending:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    print(f"  ⏱️ 抓取超时（{deadline:.0f}秒），放弃剩余 {len(pending)} 个网页")
+                    break
+
+                done, pending = await asyncio.wait(pending, timeout=remaining,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    contents[tasks[task]] = task.result()
+                    if contents[tasks[task]]:
+                        good_pages += 1
+
+                if first_k and good_pages >= first_k and pending:
+                    print(f"  ⚡ 已获得 {good_pages} 个有效网页，取消剩余 {len(pending)} 个抓取")
+                    break
+        finally:
+            # 与线程池不同，协程可以真正取消，进行中的请求连接会被关闭
+            for task in pending:
+                task.cancel()
+
+        return contents
+
+    # ---- 搜索 ----
+
+    async def find_search_results(self, query: str, max_results: int = 8) -> Tuple[Optional[Dict], List[Dict]]:
+        """
+        按历史表现排序后执行搜索区域策略，取第一个非空结果
+        DDGS没有异步接口，每个策略在线程中执行（asyncio.to_thread会带上当前轮次，span记录到同一条时间线）
+
+        返回:
+            (成功的策略, 原始结果列表)，全部失败时返回 (None, [])
+        """
+        strategies = self.strategy_stats.ordered(SEARCH_STRATEGIES)
+        if self.strategy_mode == "sequential":
+            delay = None
+        else:
+            delay = 0.0 if self.strategy_mode == "concurrent" else self.hedge_delay
+
+        tasks = {}
+        next_index = 0
+        launch_next = True
+        try:
+            while True:
+                if launch_next and next_index < len(strategies):
+                    strategy = strategies[next_index]
+                    self._log_strategy(next_index, strategy)
+                    task = asyncio.ensure_future(asyncio.to_thread(self.run_strategy, strategy, query, max_results))
+                    tasks[task] = strategy
+                    next_index += 1
+                    # concurrent模式连续发起全部策略
+                    launch_next = delay == 0.0
+                    continue
+                if not tasks:
+                    return None, []
+
+                timeout = delay if next_index < len(strategies) else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # hedge_delay内没有结果，追加下一个策略
+                    launch_next = True
+                    continue
+
+                for task in done:
+                    strategy = tasks.pop(task)
+                    try:
+                        search_results = task.result()
+                    except Exception as strategy_error:
+                        print(f"  ❌ 策略 {strategy['name']} 失败: {strategy_error}")
+                        launch_next = True
+                        continue
+                    if search_results:
+                        if tasks:
+                            print(f"  ⚡ 策略 {strategy['name']} 先返回结果，放弃其余 {len(tasks)} 个策略")
+                        return strategy, search_results
+                    print(f"  ❌ 策略 {strategy['name']} 返回空结果")
+                    launch_next = True
+        finally:
+            # 已在线程中执行的DDGS请求无法中断，结束后只记录统计
+            for task in tasks:
+                task.cancel()
+
+    async def search_web(self,
+                         query: str,
+                         max_results: int = 8,
+                         first_k: Optional[int] = None,
+                         deadline: Optional[float] = None) -> List[Dict]:
+        """搜索网络内容并并发抓取网页全文，返回顺序与搜索引擎一致的结果列表"""
+        try:
+            results = []
+            print(f"🔍 开始搜索: {query}")
+
+            strategy, search_results = await self.find_search_results(query, max_results)
+            if search_results:
+                print(f"  📄 并发抓取 {len(search_results)} 个网页...")
+                contents = await self.fetch_pages(
+                    [r.get('href', '') for r in search_results],
+                    first_k=first_k if first_k is not None else self.first_k,
+                    deadline=deadline
+                )
+                results = self.build_results(search_results, contents)
+                print(f"  ✅ 成功！策略 {strategy['name']} 找到 {len(results)} 条结果，已抓取网页全文")
+
+            if not results:
+                print("⚠️ 所有搜索策略都未能找到结果")
+            return results
+
+        except Exception as e:
+            print(f"❌ 搜索失败: {e}")
+            return []
+
+    # ---- 总结 ----
+
+    async def summarize_search_results(self, query: str, results: List[Dict], question: str = "",
+                                       usage: Optional[UsageTracker] = None) -> str:
+        """使用GPT总结搜索结果（使用网页全文中挑选出的相关文本块），相关资料很短时直接返回资料"""
+        if not results:
+            return NO_RESULTS
+
+        material, skip_summary = await asyncio.to_thread(self.select_summary_material, query, results, question)
+        if skip_summary:
+            print("  📎 相关资料较短，直接使用原文，跳过总结调用")
+            return material
+
+        try:
+            summary = await self._complete("summary", self.summary_request(query, material), usage,
+                                           sources=len(results))
+        except Exception as e:
+            return self._summary_failed(results, e)
+        print(f"  📝 总结完成 ({len(summary)} 字)")
+        return summary
+
+    async def summarize_page(self, query: str, result: Dict, content: str,
+                             usage: Optional[UsageTracker] = None) -> str:
+        """提炼单个网页中与搜索词相关的要点（map），失败时返回空字符串"""
+        try:
+            return (await self._complete("map", self.page_request(query, result, content), usage,
+                                         url=result['url'])).strip()
+        except Exception as e:
+            print(f"  ⚠️ 网页要点提炼失败 {result['url']}: {e}")
+            return ""
+
+    async def reduce_summaries(self, query: str, partials: List[Dict], snippets: List[Dict],
+                               usage: Optional[UsageTracker] = None) -> str:
+        """合并各网页要点为最终总结（reduce）；只有一个来源时直接使用其要点"""
+        shortcut = self._reduce_shortcut(partials, snippets)
+        if shortcut is not None:
+            return shortcut
+        try:
+            summary = await self._complete("reduce", self.reduce_request(query, partials, snippets), usage,
+                                           sources=len(partials))
+        except Exception as e:
+            return self._reduce_failed(partials, e)
+        print(f"  📝 合并总结完成 ({len(summary)} 字，{len(partials)} 个来源)")
+        return summary
+
+    async def search_and_summarize(self,
+                                   query: str,
+                                   max_results: int = 8,
+                                   deadline: Optional[float] = None,
+                                   question: str = "",
+                                   usage: Optional[UsageTracker] = None) -> Tuple[str, List[Dict]]:
+        """
+        搜索并总结；pipelined模式下每个网页抓取完成后立即挑选相关文本块并提炼要点，
+        获得enough_pages个相关网页的要点后取消其余任务，再用一次小调用合并
+        question为用户的原始问题，和搜索词一起用于挑选相关文本块；usage记录各阶段小模型调用的用量
+
+        返回:
+            (总结, 搜索结果列表)，无结果时为 ("未找到相关信息", [])
+        """
+        if self.summary_mode != "pipelined":
+            results = await self.search_web(query, max_results=max_results)
+            if not results:
+                return NO_RESULTS, []
+            return await self.summarize_search_results(query, results, question, usage), results
+
+        print(f"🔍 开始搜索: {query}")
+        strategy, search_results = await self.find_search_results(query, max_results)
+        if not search_results:
+            print("⚠️ 所有搜索策略都未能找到结果")
+            return NO_RESULTS, []
+        results = self.build_results(search_results)
+        print(f"  📄 策略 {strategy['name']} 找到 {len(results)} 条结果，流水线抓取并提炼要点...")
+
+        deadline = self.fetch_deadline if deadline is None else deadline
+        end_time = time.monotonic() + deadline
+        pipeline = SummaryPipeline(self, query, results, question)
+        fetches = {asyncio.ensure_future(self.fetch_webpage_content(r['url'])): i for i, r in enumerate(results)}
+        maps = {}
+        pending = set(fetches)
+
+        try:
+            while pending:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    print(f"  ⏱️ 超时（{deadline:.0f}秒），放弃剩余 {len(pending)} 个任务")
+                    break
+
+                done, pending = await asyncio.wait(pending, timeout=remaining,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task in maps:
+                        pipeline.add_notes(maps[task], task.result())
+                        continue
+                    index = fetches[task]
+                    # 去重和BM25挑选在线程中执行
+                    material = await asyncio.to_thread(pipeline.add_page, index, task.result())
+                    if material is not None:
+                        map_task = asyncio.ensure_future(self.summarize_page(query, results[index], material, usage))
+                        maps[map_task] = index
+                        pending.add(map_task)
+
+                if pipeline.enough and pending:
+                    print(f"  ⚡ 已获得 {len(pipeline.partials)} 个相关网页的要点，取消剩余 {len(pending)} 个任务")
+                    break
+                if pipeline.map_budget_used and not any(t in maps for t in pending):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+
+        ordered, snippets = pipeline.reduce_inputs()
+        if not ordered:
+            # 没有提炼出相关要点（全部失败或无关），退回一次性总结
+            return await self.summarize_search_results(query, results, question, usage), results
+        return await self.reduce_summaries(query, ordered, snippets, usage), results
+
+
+class AsyncSpeculativeCompletion:
+    """SpeculativeCompletion的异步版本：在后台任务中预先生成不带搜索增强的回复，可随时取消"""
+
+    def __init__(self, client: AsyncOpenAI, model: str, messages: List[Dict], **kwargs):
+        self.model = model
+        self.messages = messages
+        self.result = {"response": "", "tokens_used": 0, "cost": 0.0, "ttft": None, "latency": 0.0}
+        self._deltas = astream_chat_completion(client, self.result, model=model, messages=messages, **kwargs)
+        self._queue = asyncio.Queue()
+        self._received = []
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            async for delta in self._deltas:
+                self._received.append(delta)
+                self._queue.put_nowait(delta)
+        finally:
+            # 任务被取消时关闭生成器，底层HTTP连接随之断开
+            await self._deltas.aclose()
+            self._queue.put_nowait(None)
+
+    async def cancel(self) -> Dict:
+        """取消推测请求，返回截至取消时已产生的花费估算 {"prompt_tokens", "completion_tokens", "tokens", "cost"}"""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return SpeculativeCompletion.estimate_usage(self.model, self.messages, self._received)
+
+    async def wait(self, result: Dict):
+        """等待推测回复生成完毕，并把回复和用量写入result"""
+        await self._task
+        SpeculativeCompletion.copy_reply(self.result, result)
+
+    async def relay(self, result: Dict):
+        """逐段转发推测回复（异步生成器），结束后把回复和用量写入result"""
+        while True:
+            delta = await self._queue.get()
+            if delta is None:
+                break
+            yield delta
+        await self._task
+        SpeculativeCompletion.copy_reply(self.result, result)
+
+
+async def _single_reply(text: str):
+    """只产出一段文本的异步生成器（回复被拦截时代替流式输出）"""
+    yield text
+
+
+class AsyncMCPChatManager(ChatManagerBase):
+    """MCPChatManager的异步版本，多个会话可以在同一个事件循环中并发对话"""
+
+    def __init__(self, openai_client: AsyncOpenAI, search_engine: Optional[AsyncMCPSearchEngine] = None, **kwargs):
+        """
+        参数:
+            openai_client: AsyncOpenAI客户端
+            search_engine: 异步搜索引擎（默认新建；多个管理器可共用一个）
+            其余参数见ChatManagerBase
+        """
+        super().__init__(openai_client,
+                         search_engine if search_engine is not None else AsyncMCPSearchEngine(openai_client),
+                         **kwargs)
+
+    async def chat_with_mcp(self,
+                            user_message: str,
+                            character: Dict,
+                            system_prompt: str,
+                            conversation_history: List[Dict],
+                            enable_search: bool = True,
+                            model: str = "gpt-4o-ca",
+                            temperature: float = 0.8,
+                            max_tokens: int = 2000,
+                            stream: bool = False,
+                            speculative: bool = False,
+                            memory_summary: str = "") -> Dict:
+        """
+        带MCP搜索增强的对话，参数和返回值与MCPChatManager.chat_with_mcp相同；
+        stream=True时result["stream"]为异步生成器
+        """
+        trace = TurnTrace("chat_with_mcp")
+        token = activate(trace)
+        try:
+            result = await self._chat_with_mcp(user_message, character, system_prompt, conversation_history,
+                                               enable_search, model, temperature, max_tokens, stream,
+                                               speculative, memory_summary)
+        finally:
+            deactivate(token)
+        result['trace'] = trace
+        if 'stream' in result:
+            result['stream'] = self._traced_stream(result, result['stream'], trace)
+        else:
+            self._finish_trace(result, trace)
+        return result
+
+    async def _traced_stream(self, result: Dict, deltas, trace: TurnTrace):
+        """透传流式片段，流结束（或中途关闭）后补记主回复阶段并输出本轮指标"""
+        start = time.perf_counter()
+        try:
+            async for delta in deltas:
+                yield delta
+        finally:
+            trace.add_span("completion", start, time.perf_counter(), model=result['model'], stream=True,
+                           ttft=result.get('ttft'), tokens=result.get('tokens_used', 0))
+            self._finish_trace(result, trace)
+
+    async def _chat_with_mcp(self,
+                             user_message: str,
+                             character: Dict,
+                             system_prompt: str,
+                             conversation_history: List[Dict],
+                             enable_search: bool = True,
+                             model: str = "gpt-4o-ca",
+                             temperature: float = 0.8,
+                             max_tokens: int = 2000,
+                             stream: bool = False,
+                             speculative: bool = False,
+                             memory_summary: str = "") -> Dict:
+        """带MCP搜索增强的对话（在本轮时间线已激活时执行）"""
+        turn_usage = UsageTracker()
+        result = self._new_result(model, turn_usage)
+        speculation = None
+        enhanced_context = ""
+
+        # 1. MCP决策：是否需要搜索
+        if enable_search:
+            decision = self.search_engine.decide_search_locally(user_message, character)
+            if decision is None:
+                if speculative:
+                    speculation_messages = self._build_messages(system_prompt, conversation_history, user_message,
+                                                                model, max_tokens, memory_summary=memory_summary,
+                                                                result=result)
+                    speculation_budget = self._speculation_budget(model, speculation_messages, max_tokens,
+                                                                  turn_usage)
+                    if speculation_budget is not None:
+                        # 推测执行：GPT判断期间先生成不带搜索增强的回复
+                        speculation = AsyncSpeculativeCompletion(self.client, speculation_budget['model'],
+                                                                 speculation_messages, temperature=temperature,
+                                                                 max_tokens=speculation_budget['max_tokens'])
+                decision_start = time.perf_counter()
+                decision = await self.search_engine.decide_search_with_llm(user_message, character, turn_usage)
+                decision_latency = time.perf_counter() - decision_start
+            result['decision_source'] = decision['source']
+
+            if self._needs_search(decision):
+                search_query = decision['search_query']
+                print(f"🔍 MCP触发搜索: {search_query}")
+                if speculation is not None:
+                    self._speculation_cancelled(result, await speculation.cancel(), speculation.model,
+                                                decision_latency, turn_usage)
+                    speculation = None
+
+                found = await self._search(search_query, user_message, character, turn_usage)
+                enhanced_context = self._apply_search(result, search_query, user_message, character, found)
+
+        # GPT判断的花费使推测请求超出上限时取消它，按正常流程检查预算
+        if speculation is not None and not self._speculation_affordable(speculation_budget, speculation.messages,
+                                                                        turn_usage):
+            self._speculation_cancelled(result, await speculation.cancel(), speculation.model, decision_latency,
+                                        turn_usage)
+            speculation = None
+
+        # 推测回复命中：无需搜索，直接使用已在生成中的回复
+        if speculation is not None:
+            self._speculation_used(result, decision_latency, speculation_budget, turn_usage.total_cost)
+            if stream:
+                result['stream'] = speculation.relay(result)
+            else:
+                with span("completion", model=speculation.model, speculative=True) as attrs:
+                    await speculation.wait(result)
+                    attrs["tokens"] = result['tokens_used']
+            return result
+
+        with span("context"):
+            messages = self._build_messages(system_prompt, conversation_history, user_message,
+                                            model, max_tokens, enhanced_context, memory_summary, result)
+
+        # 单轮费用检查：超出上限时降级或拦截
+        limits = self._check_turn_budget(result, model, messages, max_tokens, turn_usage)
+        if limits is None:
+            if stream:
+                result['stream'] = _single_reply(result['response'])
+            return result
+        model, max_tokens = limits
+
+        if stream:
+            result['stream'] = astream_chat_completion(self.client, result, model=model, messages=messages,
+                                                       temperature=temperature, max_tokens=max_tokens)
+            return result
+
+        try:
+            start_time = time.perf_counter()
+            with span("completion", model=model) as attrs:
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                attrs["tokens"] = response.usage.total_tokens
+            self._read_completion(result, model, response, start_time)
+        except Exception as e:
+            self._completion_failed(result, e)
+
+        return result
+
+    async def _search(self, search_query: str, user_message: str, character: Dict,
+                      usage: UsageTracker) -> Tuple[str, List[Dict], str]:
+        """
+        先查角色本地知识库和缓存，都未命中时搜索并总结，返回 (总结, 搜索结果, 来源)
+        知识库（语料变化后需重建索引）和缓存（可能持久化到SQLite）的读写都在线程中执行
+        """
+        found = (await asyncio.to_thread(self._lookup_knowledge, character, search_query, user_message) or
+                 await asyncio.to_thread(self._lookup_cache, search_query))
+        if found is not None:
+            return found
+        search_summary, search_results = await self.search_engine.search_and_summarize(
+            search_query, max_results=8, question=user_message, usage=usage)
+        await asyncio.to_thread(self._remember_search, search_query, search_summary, search_results)
+        return search_summary, search_results, "web"
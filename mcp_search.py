@@ -1,10 +1,20 @@
 """
 MCP (Model Context Protocol) 搜索增强模块
 智能判断并执行网络搜索，为角色对话提供真实背景资料
+
+同步/异步两套管线共用同一份核心逻辑：
+- SearchEngineBase：搜索决策、提示词、资料挑选、网页缓存读写、搜索区域策略的执行与统计
+- SummaryPipeline：流水线总结的进度（网页到达后提炼/直接使用/跳过，何时提前停止）
+- ChatManagerBase：结果字段、推测执行记账、知识库/缓存查询、单轮费用检查、回复用量
+MCPSearchEngine / MCPChatManager（本模块，线程池）和 mcp_async 中的异步版本只负责I/O和并发调度
 """
 import re
 import json
-from typing import List, Dict, Optional
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional, Tuple
 try:
     from ddgs import DDGS  # 新版本的包名
 except ImportError:
@@ -12,34 +22,114 @@ except ImportError:
         from duckduckgo_search import DDGS  # 向后兼容旧版本
     except ImportError:
         raise ImportError("请安装搜索包: pip install ddgs")
-import requests
-from bs4 import BeautifulSoup
 from openai import OpenAI
 
+from utils import cached_prompt_tokens, count_tokens, stream_chat_completion
+from token_counter import count_message_tokens
+from pricing import UsageTracker, apply_turn_budget, get_turn_budget, get_turn_budget_mode, usage_cost
+from context_budget import DEFAULT_KEEP_LAST_TURNS, fit_messages
+from search_cache import SearchCache, get_shared_cache
+from search_classifier import classify_search_need
+from http_fetcher import PooledFetcher, get_shared_fetcher
+from html_extract import dedupe_paragraphs, extract_text_from_response
+from chunk_select import (PAGE_TOKEN_BUDGET, SKIP_PAGE_TOKENS, SKIP_SUMMARY_TOKENS, SUMMARY_TOKEN_BUDGET,
+                          format_chunks, select_chunks)
+from page_cache import PageCache, get_shared_page_cache
+from search_strategies import SEARCH_STRATEGIES, StrategyStats, get_shared_strategy_stats, get_strategy_mode
+from knowledge_index import KnowledgeBase, get_shared_knowledge_base
+from telemetry import MetricsSink, TurnTrace, activate, deactivate, get_shared_metrics, in_current_context, span
 
-class MCPSearchEngine:
-    """MCP搜索引擎 - 智能判断并执行网络搜索"""
-    
-    def __init__(self, client: OpenAI):
-        self.client = client
-        self.ddgs = DDGS()
-        
-    def should_search(self, user_message: str, character_name: str) -> Dict:
+
+IRRELEVANT_MARK = "无关"  # 网页要点提炼时表示网页与主题无关
+MIN_MAP_CHARS = 50  # 去重后少于此字数的网页不再提炼要点
+HELPER_MODEL = "gpt-4o-mini"  # 搜索决策、网页提炼和总结使用的小模型
+NO_RESULTS = "未找到相关信息"
+BLOCKED_REPLY = "抱歉，本轮对话预计费用超出上限，回复已取消。"
+
+
+class SearchEngineBase:
+    """
+    同步/异步搜索引擎共用的部分
+    子类只实现网络请求、模型调用（_complete）和并发调度
+    """
+
+    def __init__(self,
+                 client,
+                 fetch_deadline: float = 12.0,
+                 first_k: Optional[int] = None,
+                 page_cache: Optional[PageCache] = None,
+                 strategy_mode: Optional[str] = None,
+                 hedge_delay: float = 1.0,
+                 strategy_stats: Optional[StrategyStats] = None,
+                 summary_mode: str = "pipelined",
+                 enough_pages: int = 3,
+                 max_map_pages: int = 5):
         """
-        使用GPT判断是否需要进行网络搜索
-        
         参数:
-            user_message: 用户的问题
-            character_name: 当前角色名称
-            
+            client: OpenAI / AsyncOpenAI客户端
+            fetch_deadline: 单次搜索抓取网页的总时限（秒），超时未完成的网页回退为摘要
+            first_k: 抓取到K个有效网页后即停止等待其余网页（None表示等待全部）
+            page_cache: 网页正文缓存（默认使用进程级共享的磁盘缓存）
+            strategy_mode: 搜索区域策略的执行方式（默认读取环境变量 MCP_STRATEGY_MODE，未设置时为sequential）：
+                "sequential" 依次尝试；"concurrent" 同时发起；
+                "hedged" 先发起历史最好的策略，hedge_delay秒内没有结果再追加下一个
+            hedge_delay: hedged模式下追加下一个策略前的等待时间（秒）
+            strategy_stats: 策略成功率/耗时统计（默认使用进程级共享统计）
+            summary_mode: 搜索结果的总结方式：
+                "pipelined" 每个网页抓取完成后立即提炼要点，最后用一次小调用合并；
+                "batch" 等全部网页抓取完成后用一次大调用总结
+            enough_pages: pipelined模式下获得多少个相关网页的要点后提前停止
+            max_map_pages: pipelined模式下最多提炼的网页数
+        """
+        self.client = client
+        self.fetch_deadline = fetch_deadline
+        self.first_k = first_k
+        self.page_cache = page_cache if page_cache is not None else get_shared_page_cache()
+        self.strategy_mode = strategy_mode or get_strategy_mode()
+        self.hedge_delay = hedge_delay
+        self.strategy_stats = strategy_stats if strategy_stats is not None else get_shared_strategy_stats()
+        self.summary_mode = summary_mode
+        self.enough_pages = enough_pages
+        self.max_map_pages = max_map_pages
+        # 搜索决策来源统计：本地判断不搜索 / 本地判断搜索 / GPT判断
+        self.decision_stats = {"local_skip": 0, "local_search": 0, "llm": 0}
+
+    # ---- 搜索决策 ----
+
+    def decide_search_locally(self, user_message: str, character: Dict) -> Optional[Dict]:
+        """
+        仅用本地规则判断是否需要搜索
+
         返回:
-            {
-                "need_search": bool,
-                "search_query": str,
-                "reason": str
-            }
+            明确时返回决策（"source": "local"），模棱两可时返回None
         """
-        decision_prompt = f"""你是一个智能搜索策略助手，负责判断用户的问题是否需要网络搜索，并生成最优搜索词。
+        decision = classify_search_need(user_message, character)
+        if decision is not None:
+            decision['source'] = 'local'
+            self.decision_stats['local_search' if decision['need_search'] else 'local_skip'] += 1
+            self._log_decision(decision)
+        return decision
+
+    def _llm_decision(self, decision: Dict) -> Dict:
+        """记录GPT给出的决策（"source": "llm"）"""
+        decision['source'] = 'llm'
+        self.decision_stats['llm'] += 1
+        self._log_decision(decision)
+        return decision
+
+    def _log_decision(self, decision: Dict):
+        print(f"🧭 搜索决策[{decision['source']}]: "
+              f"{'需要搜索' if decision.get('need_search') else '无需搜索'} - {decision.get('reason', '')}")
+
+    @staticmethod
+    def _decision_failed(error: Exception) -> Dict:
+        print(f"MCP决策失败: {error}")
+        return {"need_search": False, "search_query": "", "reason": "决策失败"}
+
+    @staticmethod
+    def build_decision_prompt(user_message: str, character_name: str) -> str:
+        """构建GPT搜索决策的提示词"""
+        return f"""你是一个智能搜索策略助手，负责判断用户的问题是否需要网络搜索，并生成最优搜索词。
 
 角色：{character_name}
 用户问题：{user_message}
@@ -65,160 +155,200 @@ class MCPSearchEngine:
     "search_query": "精确的搜索关键词组合",
     "reason": "判断理由（为什么需要/不需要搜索）"
 }}"""
-        
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",  # 使用更便宜的模型做判断
-                messages=[{"role": "user", "content": decision_prompt}],
-                temperature=0.3,
-                response_format={"type": "json_object"}
+
+    # ---- 小模型调用的请求参数与回复 ----
+
+    @classmethod
+    def decision_request(cls, user_message: str, character_name: str) -> Dict:
+        return {
+            "model": HELPER_MODEL,  # 使用更便宜的模型做判断
+            "messages": [{"role": "user", "content": cls.build_decision_prompt(user_message, character_name)}],
+            "temperature": 0.3,
+            "response_format": {"type": "json_object"}
+        }
+
+    @classmethod
+    def page_request(cls, query: str, result: Dict, content: str) -> Dict:
+        return {
+            "model": HELPER_MODEL,
+            "messages": [{"role": "user", "content": cls.build_page_prompt(query, result, content)}],
+            "temperature": 0.3,
+            "max_tokens": 300
+        }
+
+    @classmethod
+    def reduce_request(cls, query: str, partials: List[Dict], snippets: List[Dict]) -> Dict:
+        return {
+            "model": HELPER_MODEL,
+            "messages": [{"role": "user", "content": cls.build_reduce_prompt(query, partials, snippets)}],
+            "temperature": 0.3,
+            "max_tokens": 800
+        }
+
+    @classmethod
+    def summary_request(cls, query: str, material: str) -> Dict:
+        return {
+            "model": HELPER_MODEL,
+            "messages": [{"role": "user", "content": cls.build_summary_prompt(query, material)}],
+            "temperature": 0.3,
+            "max_tokens": 1000  # 增加token限制，允许更详细的总结
+        }
+
+    @staticmethod
+    def _read_reply(stage: str, request: Dict, response, usage: Optional[UsageTracker], attrs: Dict) -> str:
+        """把一次小模型调用的用量写入时间线和UsageTracker，返回回复文本"""
+        attrs["tokens"] = response.usage.total_tokens if response.usage else 0
+        if usage is not None:
+            usage.record_usage(stage, request["model"], response.usage)
+        return response.choices[0].message.content
+
+    @staticmethod
+    def _reduce_shortcut(partials: List[Dict], snippets: List[Dict]) -> Optional[str]:
+        """无需合并调用时直接给出总结：没有要点，或只有一个来源"""
+        if not partials:
+            return NO_RESULTS
+        if len(partials) == 1 and not snippets:
+            return partials[0]['notes']
+        return None
+
+    @staticmethod
+    def _reduce_failed(partials: List[Dict], error: Exception) -> str:
+        print(f"合并总结失败: {error}")
+        return "\n\n".join(f"【{p['title']}】\n{p['notes']}" for p in partials)
+
+    @staticmethod
+    def _summary_failed(results: List[Dict], error: Exception) -> str:
+        print(f"总结失败: {error}")
+        # 降级方案：返回前5个结果的全文摘要
+        return "\n\n".join([
+            f"【{r['title']}】\n{r['full_content'][:300]}"
+            for r in results[:5]
+        ])
+
+    # ---- 网页缓存 ----
+
+    def _cached_page(self, url: str, max_length: int) -> Optional[Dict]:
+        return self.page_cache.lookup(url, max_length) if self.page_cache else None
+
+    def _mark_revalidated(self, url: str, cached: Dict):
+        self.page_cache.mark_revalidated(url, cached)
+
+    def _store_page(self, url: str, text: str, max_length: int, status_code: int, headers, download_bytes: int):
+        if self.page_cache and status_code == 200:
+            self.page_cache.store(
+                url, text, max_length,
+                etag=headers.get('ETag'),
+                last_modified=headers.get('Last-Modified'),
+                download_bytes=download_bytes
             )
-            
-            result = json.loads(response.choices[0].message.content)
-            return result
-            
-        except Exception as e:
-            print(f"MCP决策失败: {e}")
-            return {"need_search": False, "search_query": "", "reason": "决策失败"}
-    
-    def fetch_webpage_content(self, url: str, max_length: int = 3000) -> str:
+
+    # ---- 搜索区域策略 ----
+
+    @staticmethod
+    def build_search_params(strategy: Dict, query: str, max_results: int) -> Dict:
+        """把搜索区域策略转换为DDGS.text的参数"""
+        search_params = {
+            'query': query,  # 改为 'query' 而不是 'keywords'
+            'max_results': max_results,
+            'safesearch': strategy['safesearch']
+        }
+        if strategy['region']:
+            search_params['region'] = strategy['region']
+        return search_params
+
+    def run_strategy(self, strategy: Dict, query: str, max_results: int,
+                        ddgs: Optional[DDGS] = None) -> List[Dict]:
         """
-        抓取网页全文内容
-        
+        执行单个搜索区域策略（阻塞，DDGS没有异步接口），并记录成功率和耗时
+        统计在执行完成时记录：策略输掉竞争被放弃后，结束时仍会记录结果
+
         参数:
-            url: 网页URL
-            max_length: 最大字符长度
-            
+            strategy: SEARCH_STRATEGIES中的策略
+            query: 搜索关键词
+            max_results: 最大结果数
+            ddgs: 使用的DDGS实例（并发执行时每个策略各用一个新实例）
+
         返回:
-            网页文本内容
+            搜索引擎返回的原始结果列表
         """
+        search_params = self.build_search_params(strategy, query, max_results)
+        start = time.monotonic()
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-            response = requests.get(url, headers=headers, timeout=5)
-            response.encoding = response.apparent_encoding
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # 移除script和style标签
-            for script in soup(['script', 'style', 'nav', 'footer', 'header']):
-                script.decompose()
-            
-            # 提取文本
-            text = soup.get_text(separator='\n', strip=True)
-            
-            # 清理多余空行
-            lines = [line.strip() for line in text.split('\n') if line.strip()]
-            text = '\n'.join(lines)
-            
-            # 限制长度
-            if len(text) > max_length:
-                text = text[:max_length] + "..."
-                
-            return text
-            
-        except Exception as e:
-            print(f"  ⚠️ 无法抓取网页 {url}: {e}")
-            return ""
-    
-    def search_web(self, query: str, max_results: int = 8) -> List[Dict]:
+            with span("search", strategy=strategy['name']) as attrs:
+                # 注意：新版ddgs包的API可能有变化
+                search_results = (ddgs or DDGS()).text(**search_params)
+                # 将生成器转换为列表
+                search_results_list = list(search_results) if search_results else []
+                attrs["results"] = len(search_results_list)
+        except Exception:
+            self.strategy_stats.record(strategy['name'], False, time.monotonic() - start, error=True)
+            raise
+        self.strategy_stats.record(strategy['name'], bool(search_results_list), time.monotonic() - start)
+        return search_results_list
+
+    @staticmethod
+    def _log_strategy(index: int, strategy: Dict):
+        print(f"  策略 {index+1}: region={strategy['region']}, safesearch={strategy['safesearch']}")
+
+    @staticmethod
+    def build_results(search_results_list: List[Dict], contents: Optional[List[str]] = None) -> List[Dict]:
+        """把搜索引擎的原始结果转换为结果列表，未抓取到全文的使用搜索摘要"""
+        contents = contents or [""] * len(search_results_list)
+        results = []
+        for r, full_content in zip(search_results_list, contents):
+            snippet = r.get('body', '')
+            results.append({
+                'title': r.get('title', ''),
+                'snippet': snippet,
+                'full_content': full_content if full_content else snippet,
+                'url': r.get('href', '')
+            })
+        return results
+
+    # ---- 资料挑选与提示词 ----
+
+    @staticmethod
+    def select_summary_material(query: str, results: List[Dict], question: str = "") -> Tuple[str, bool]:
         """
-        使用DuckDuckGo搜索网络内容并抓取网页全文
-        
-        参数:
-            query: 搜索关键词
-            max_results: 最大结果数（增加到8）
-            
+        挑选发送给总结模型的资料
+        先跨来源去掉重复段落，再用BM25在token预算内挑选与搜索词和用户问题最相关的文本块
+
         返回:
-            搜索结果列表
+            (资料文本, 是否可以直接使用资料而跳过总结调用)
         """
-        try:
-            results = []
-            print(f"🔍 开始搜索: {query}")
-            
-            # 尝试多种搜索策略
-            search_strategies = [
-                {'region': None, 'safesearch': 'moderate'},  # 先不指定region
-                {'region': 'wt-wt', 'safesearch': 'moderate'},  # 全球
-                {'region': 'cn-zh', 'safesearch': 'off'},  # 中国区，关闭安全搜索
-            ]
-            
-            for i, strategy in enumerate(search_strategies):
-                try:
-                    print(f"  策略 {i+1}: region={strategy['region']}, safesearch={strategy['safesearch']}")
-                    
-                    search_params = {
-                        'query': query,  # 改为 'query' 而不是 'keywords'
-                        'max_results': max_results,
-                        'safesearch': strategy['safesearch']
-                    }
-                    if strategy['region']:
-                        search_params['region'] = strategy['region']
-                    
-                    # 注意：新版ddgs包的API可能有变化
-                    search_results = self.ddgs.text(**search_params)
-                    
-                    # 将生成器转换为列表
-                    search_results_list = list(search_results) if search_results else []
-                    
-                    if search_results_list:
-                        for r in search_results_list:
-                            url = r.get('href', '')
-                            title = r.get('title', '')
-                            snippet = r.get('body', '')
-                            
-                            # 尝试抓取网页全文
-                            print(f"  📄 抓取网页: {title[:50]}...")
-                            full_content = self.fetch_webpage_content(url)
-                            
-                            results.append({
-                                'title': title,
-                                'snippet': snippet,
-                                'full_content': full_content if full_content else snippet,
-                                'url': url
-                            })
-                        print(f"  ✅ 成功！找到 {len(results)} 条结果，已抓取网页全文")
-                        break  # 成功就退出
-                    else:
-                        print(f"  ❌ 策略 {i+1} 返回空结果，尝试下一个策略")
-                        
-                except Exception as strategy_error:
-                    print(f"  ❌ 策略 {i+1} 失败: {strategy_error}")
-                    continue
-            
-            if not results:
-                print("⚠️ 所有搜索策略都未能找到结果")
-            
-            return results
-            
-        except Exception as e:
-            print(f"❌ 搜索失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
-    
-    def summarize_search_results(self, query: str, results: List[Dict]) -> str:
+        # 跨来源去掉重复段落（转载、镜像页面），把预算留给不同的信息
+        contents = [r['full_content'] for r in results]
+        deduped = dedupe_paragraphs(contents)
+        removed = sum(len(a) - len(b) for a, b in zip(contents, deduped))
+        if removed:
+            print(f"  🧹 去除重复段落 {removed} 字")
+
+        chunks = select_chunks(query, results, question, SUMMARY_TOKEN_BUDGET, contents=deduped)
+        tokens = sum(c['tokens'] for c in chunks)
+        relevant = any(c['score'] > 0 for c in chunks)
+        print(f"  🎯 挑选 {len(chunks)} 个相关文本块（{tokens} tokens，来自 {len({c['source'] for c in chunks})} 个来源）")
+        return format_chunks(chunks), relevant and tokens <= SKIP_SUMMARY_TOKENS
+
+    @staticmethod
+    def select_page_material(query: str, result: Dict, content: str, question: str = "") -> Tuple[Optional[str], bool]:
         """
-        使用GPT总结搜索结果（使用网页全文）
-        
-        参数:
-            query: 搜索关键词
-            results: 搜索结果列表
-            
+        挑选单个网页中与搜索词和用户问题相关的文本块
+
         返回:
-            总结文本
+            (资料文本, 是否需要调用模型提炼)；网页没有任何文本块命中检索词时资料为None
         """
-        if not results:
-            return "未找到相关信息"
-        
-        # 构建搜索结果文本 - 使用全文内容，增加到前5个结果
-        results_text = "\n\n" + "="*50 + "\n\n".join([
-            f"【来源 {i+1}】{r['title']}\n网址：{r['url']}\n\n内容摘要：\n{r['full_content'][:1500]}"  # 使用全文，每个源最多1500字
-            for i, r in enumerate(results[:5])  # 增加到5个结果
-        ])
-        
-        summary_prompt = f"""你是一个专业的信息提取助手。请仔细阅读以下关于"{query}"的网页内容，提取最有价值的信息。
+        chunks = select_chunks(query, [result], question, PAGE_TOKEN_BUDGET, contents=[content])
+        if not chunks or chunks[0]['score'] <= 0:
+            return None, False
+        material = "\n".join(c['text'] for c in chunks)
+        return material, sum(c['tokens'] for c in chunks) > SKIP_PAGE_TOKENS
+
+    @staticmethod
+    def build_summary_prompt(query: str, material: str) -> str:
+        """构建搜索结果总结的提示词，material为select_summary_material挑选的资料"""
+        results_text = "\n\n" + "="*50 + "\n\n" + material
+
+        return f"""你是一个专业的信息提取助手。请仔细阅读以下关于"{query}"的网页内容，提取最有价值的信息。
 
 {results_text}
 
@@ -234,39 +364,55 @@ class MCPSearchEngine:
 6. **保持中文**：全部使用中文输出
 
 请提供详细的总结："""
-        
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": summary_prompt}],
-                temperature=0.3,
-                max_tokens=1000  # 增加token限制，允许更详细的总结
+
+    @staticmethod
+    def build_page_prompt(query: str, result: Dict, content: str) -> str:
+        """构建单个网页要点提炼（map）的提示词，content为网页中挑选出的相关文本块"""
+        return f"""以下是关于"{query}"的一个网页。
+
+【{result['title']}】
+{content}
+
+请只摘取与"{query}"直接相关的事实（背景、经过、人物、时间、数字、原文细节），
+用不超过150字的中文要点输出，不要添加网页中没有的信息。
+如果网页内容与该主题无关，只输出"{IRRELEVANT_MARK}"。"""
+
+    @staticmethod
+    def build_reduce_prompt(query: str, partials: List[Dict], snippets: List[Dict]) -> str:
+        """构建合并各网页要点（reduce）的提示词"""
+        notes = "\n\n".join(f"【来源 {i+1}】{p['title']}\n{p['notes']}" for i, p in enumerate(partials))
+        if snippets:
+            notes += "\n\n【其他来源的搜索摘要】\n" + "\n".join(
+                f"- {r['title']}：{r['snippet']}" for r in snippets if r['snippet']
             )
-            
-            summary = response.choices[0].message.content
-            print(f"  📝 总结完成 ({len(summary)} 字)")
-            return summary
-            
-        except Exception as e:
-            print(f"总结失败: {e}")
-            # 降级方案：返回前5个结果的全文摘要
-            return "\n\n".join([
-                f"【{r['title']}】\n{r['full_content'][:300]}"
-                for r in results[:5]
-            ])
-    
-    def enhance_context(self, 
-                       user_message: str, 
-                       character_name: str,
-                       search_results_summary: str) -> str:
+        return f"""请把以下关于"{query}"的各来源要点合并为一份总结。
+
+{notes}
+
+要求：
+1. 合并相同信息，保留具体的背景、细节和数据，来源之间矛盾时说明
+2. 只使用以上要点中的信息，不添加推测
+3. 用清晰的段落组织，200-400字，全部使用中文
+
+请提供总结："""
+
+    @staticmethod
+    def is_relevant(notes: str) -> bool:
+        """map结果是否包含相关内容"""
+        return bool(notes) and not notes.strip().startswith(IRRELEVANT_MARK)
+
+    @staticmethod
+    def enhance_context(user_message: str,
+                        character_name: str,
+                        search_results_summary: str) -> str:
         """
         生成增强的上下文信息
-        
+
         参数:
             user_message: 用户问题
             character_name: 角色名称
             search_results_summary: 搜索结果总结
-            
+
         返回:
             增强的上下文文本
         """
@@ -293,15 +439,823 @@ class MCPSearchEngine:
         return enhanced_context
 
 
-class MCPChatManager:
-    """整合MCP搜索的对话管理器"""
-    
-    def __init__(self, openai_client: OpenAI):
+class SummaryPipeline:
+    """
+    流水线总结的进度（调度由同步/异步引擎负责）
+    每个网页抓取完成后挑选相关文本块，决定提炼、直接作为要点或跳过；收集各网页要点并判断何时可以提前停止
+    """
+
+    def __init__(self, engine: SearchEngineBase, query: str, results: List[Dict], question: str = ""):
+        self.engine = engine
+        self.query = query
+        self.results = results
+        self.question = question
+        self.partials: Dict[int, str] = {}  # 结果序号 -> 要点
+        self.direct = set()  # 相关资料很短、直接作为要点的结果序号
+        self.mapped = 0  # 已提交提炼的网页数
+        self._seen_paragraphs = set()
+
+    def add_page(self, index: int, content: str) -> Optional[str]:
+        """
+        记录抓取到的网页（CPU计算：去重和BM25挑选）
+
+        返回:
+            需要提炼（map）的资料；直接作为要点或跳过时返回None
+        """
+        if not content:
+            return None
+        self.results[index]['full_content'] = content
+        # 跨网页增量去重，重复转载的内容不再提炼
+        content = dedupe_paragraphs([content], seen=self._seen_paragraphs)[0]
+        if self.map_budget_used or len(content.strip()) < MIN_MAP_CHARS:
+            return None
+        material, needs_map = self.engine.select_page_material(self.query, self.results[index], content,
+                                                               self.question)
+        if material is None:
+            return None
+        if not needs_map:
+            self.direct.add(index)
+            self.partials[index] = material
+            return None
+        self.mapped += 1
+        return material
+
+    def add_notes(self, index: int, notes: str):
+        if self.engine.is_relevant(notes):
+            self.partials[index] = notes
+
+    @property
+    def enough(self) -> bool:
+        """已获得足够多相关网页的要点"""
+        return len(self.partials) >= self.engine.enough_pages
+
+    @property
+    def map_budget_used(self) -> bool:
+        """提炼和直接使用的网页数已达上限"""
+        return self.mapped + len(self.direct) >= self.engine.max_map_pages
+
+    def reduce_inputs(self) -> Tuple[List[Dict], List[Dict]]:
+        """
+        返回:
+            (按结果顺序排列的要点, 未抓取到全文的其他来源（最多3个，只有搜索摘要）)
+        """
+        print(f"  ✅ 提炼 {self.mapped} 个网页，直接使用 {len(self.direct)} 个，{len(self.partials)} 个相关")
+        ordered = [{"title": self.results[i]['title'], "notes": self.partials[i]} for i in sorted(self.partials)]
+        snippets = [r for i, r in enumerate(self.results)
+                    if i not in self.partials and r['full_content'] == r['snippet']]
+        return ordered, snippets[:3]
+
+
+class MCPSearchEngine(SearchEngineBase):
+    """MCP搜索引擎 - 智能判断并执行网络搜索（线程池并发）"""
+
+    def __init__(self,
+                 client: OpenAI,
+                 fetch_workers: int = 6,
+                 fetch_deadline: float = 12.0,
+                 first_k: Optional[int] = None,
+                 fetcher: Optional[PooledFetcher] = None,
+                 page_cache: Optional[PageCache] = None,
+                 strategy_mode: Optional[str] = None,
+                 hedge_delay: float = 1.0,
+                 strategy_stats: Optional[StrategyStats] = None,
+                 summary_mode: str = "pipelined",
+                 map_workers: int = 4,
+                 enough_pages: int = 3,
+                 max_map_pages: int = 5):
+        """
+        参数:
+            client: OpenAI客户端
+            fetch_workers: 并发抓取网页的线程数
+            fetcher: 网页抓取器（默认使用进程级共享连接池）
+            map_workers: pipelined模式下并行提炼网页要点的线程数
+            其余参数见SearchEngineBase
+        """
+        super().__init__(client, fetch_deadline, first_k, page_cache, strategy_mode, hedge_delay,
+                         strategy_stats, summary_mode, enough_pages, max_map_pages)
+        self.ddgs = DDGS()
+        self.fetcher = fetcher if fetcher is not None else get_shared_fetcher()
+        self.fetch_workers = fetch_workers
+        self.map_workers = map_workers
+
+    def _complete(self, stage: str, request: Dict, usage: Optional[UsageTracker] = None, **attrs) -> str:
+        """调用小模型，记录阶段耗时和用量，返回回复文本"""
+        with span(stage, model=request["model"], **attrs) as span_attrs:
+            response = self.client.chat.completions.create(**request)
+            return self._read_reply(stage, request, response, usage, span_attrs)
+
+    def decide_search_with_llm(self, user_message: str, character: Dict,
+                               usage: Optional[UsageTracker] = None) -> Dict:
+        """调用GPT判断是否需要搜索（"source": "llm"）"""
+        return self._llm_decision(self.should_search(user_message, character['name'], usage))
+
+    def decide_search(self, user_message: str, character: Dict, usage: Optional[UsageTracker] = None) -> Dict:
+        """
+        判断是否需要搜索：先用本地规则快速判断，模棱两可时再调用GPT
+
+        参数:
+            user_message: 用户的问题
+            character: 角色信息字典
+
+        返回:
+            should_search的结果，额外包含 "source": "local" / "llm"
+        """
+        decision = self.decide_search_locally(user_message, character)
+        if decision is None:
+            decision = self.decide_search_with_llm(user_message, character, usage)
+        return decision
+
+    def should_search(self, user_message: str, character_name: str,
+                      usage: Optional[UsageTracker] = None) -> Dict:
+        """
+        使用GPT判断是否需要进行网络搜索
+
+        参数:
+            user_message: 用户的问题
+            character_name: 当前角色名称
+
+        返回:
+            {
+                "need_search": bool,
+                "search_query": str,
+                "reason": str
+            }
+        """
+        try:
+            return json.loads(self._complete("decision", self.decision_request(user_message, character_name), usage))
+        except Exception as e:
+            return self._decision_failed(e)
+
+    def fetch_webpage_content(self, url: str, max_length: int = 3000) -> str:
+        """
+        抓取网页全文内容（先查网页缓存；流式读取，有字节上限，提取到足够文本即停止）
+
+        参数:
+            url: 网页URL
+            max_length: 最大字符长度
+
+        返回:
+            网页文本内容
+        """
+        with span("fetch", url=url, hit=False, bytes=0) as attrs:
+            cached = self._cached_page(url, max_length)
+            if cached and cached["fresh"]:
+                attrs["hit"] = True
+                return cached["text"]
+
+            try:
+                headers = PageCache.conditional_headers(cached)
+                with self.fetcher.get(url, timeout=5, headers=headers or None, stream=True) as response:
+                    attrs["status"] = response.status_code
+                    if response.status_code == 304 and cached:
+                        self._mark_revalidated(url, cached)
+                        attrs["hit"] = True
+                        return cached["text"]
+
+                    stats = {}
+                    text = extract_text_from_response(response, max_length=max_length, stats=stats)
+                    attrs["bytes"] = stats.get('bytes_read', 0)
+                    self._store_page(url, text, max_length, response.status_code, response.headers,
+                                     stats.get('bytes_read', 0))
+                    return text
+
+            except Exception as e:
+                print(f"  ⚠️ 无法抓取网页 {url}: {e}")
+                attrs["error"] = type(e).__name__
+                # 重新验证失败时沿用过期的缓存
+                return cached["text"] if cached else ""
+
+    def fetch_pages(self,
+                    urls: List[str],
+                    first_k: Optional[int] = None,
+                    deadline: Optional[float] = None) -> List[str]:
+        """
+        并发抓取多个网页全文
+
+        参数:
+            urls: 网页URL列表
+            first_k: 抓取到K个有效网页后取消其余请求（None表示等待全部）
+            deadline: 总时限（秒），超时仍未完成的网页返回空字符串
+
+        返回:
+            与urls顺序一致的网页文本列表，失败或被取消的为空字符串
+        """
+        contents = [""] * len(urls)
+        if not urls:
+            return contents
+
+        deadline = self.fetch_deadline if deadline is None else deadline
+        end_time = time.monotonic() + deadline
+        executor = ThreadPoolExecutor(max_workers=min(self.fetch_workers, len(urls)))
+        futures = {
+            executor.submit(in_current_context(self.fetch_webpage_content), url): i
+            for i, url in enumerate(urls)
+        }
+        pending = set(futures)
+        good_pages = 0
+
+        try:
+            while pending:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    print(f"  ⏱️ 抓取超时（{deadline:.0f}秒），放弃剩余 {len(pending)} 个网页")
+                    break
+
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        contents[futures[future]] = future.result()
+                    except Exception as e:
+                        print(f"  ⚠️ 抓取任务异常: {e}")
+                    if contents[futures[future]]:
+                        good_pages += 1
+
+                if first_k and good_pages >= first_k and pending:
+                    print(f"  ⚡ 已获得 {good_pages} 个有效网页，取消剩余 {len(pending)} 个抓取")
+                    break
+        finally:
+            # 取消尚未开始的任务；已在执行的请求受单页超时约束，不阻塞本次搜索
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        return contents
+
+    def find_search_results(self, query: str, max_results: int = 8) -> Tuple[Optional[Dict], List[Dict]]:
+        """
+        按历史表现排序后执行搜索区域策略，取第一个非空结果
+
+        返回:
+            (成功的策略, 原始结果列表)，全部失败时返回 (None, [])
+        """
+        strategies = self.strategy_stats.ordered(SEARCH_STRATEGIES)
+
+        if self.strategy_mode == "sequential":
+            for i, strategy in enumerate(strategies):
+                try:
+                    self._log_strategy(i, strategy)
+                    search_results_list = self.run_strategy(strategy, query, max_results, ddgs=self.ddgs)
+                    if search_results_list:
+                        return strategy, search_results_list
+                    print(f"  ❌ 策略 {i+1} 返回空结果，尝试下一个策略")
+                except Exception as strategy_error:
+                    print(f"  ❌ 策略 {i+1} 失败: {strategy_error}")
+            return None, []
+
+        # concurrent：同时发起全部策略；hedged：错开发起，前一个失败/为空或超过hedge_delay才追加下一个
+        delay = 0.0 if self.strategy_mode == "concurrent" else self.hedge_delay
+        executor = ThreadPoolExecutor(max_workers=len(strategies))
+        futures = {}
+        next_index = 0
+        next_launch = time.monotonic()
+
+        try:
+            while True:
+                while next_index < len(strategies) and time.monotonic() >= next_launch:
+                    strategy = strategies[next_index]
+                    self._log_strategy(next_index, strategy)
+                    futures[executor.submit(in_current_context(self.run_strategy), strategy, query, max_results)] = strategy
+                    next_index += 1
+                    next_launch = time.monotonic() + delay
+
+                pending = [f for f in futures if not f.done()]
+                finished = [f for f in futures if f.done()]
+                for future in finished:
+                    strategy = futures.pop(future)
+                    try:
+                        search_results_list = future.result()
+                    except Exception as strategy_error:
+                        print(f"  ❌ 策略 {strategy['name']} 失败: {strategy_error}")
+                        next_launch = time.monotonic()
+                        continue
+                    if search_results_list:
+                        if pending:
+                            print(f"  ⚡ 策略 {strategy['name']} 先返回结果，放弃其余 {len(pending)} 个策略")
+                        return strategy, search_results_list
+                    print(f"  ❌ 策略 {strategy['name']} 返回空结果")
+                    next_launch = time.monotonic()
+
+                if not pending and next_index >= len(strategies):
+                    return None, []
+                if finished:
+                    continue
+
+                timeout = next_launch - time.monotonic() if next_index < len(strategies) else None
+                wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        finally:
+            # 取消尚未开始的策略；已在执行的请求在后台结束后只记录统计
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def search_web(self,
+                   query: str,
+                   max_results: int = 8,
+                   first_k: Optional[int] = None,
+                   deadline: Optional[float] = None) -> List[Dict]:
+        """
+        使用DuckDuckGo搜索网络内容并并发抓取网页全文
+
+        参数:
+            query: 搜索关键词
+            max_results: 最大结果数（增加到8）
+            first_k: 抓取到K个有效网页即返回（默认使用实例配置）
+            deadline: 网页抓取总时限（秒，默认使用实例配置）
+
+        返回:
+            搜索结果列表，顺序与搜索引擎返回一致
+        """
+        try:
+            results = []
+            print(f"🔍 开始搜索: {query}")
+
+            strategy, search_results_list = self.find_search_results(query, max_results)
+            if search_results_list:
+                # 并发抓取网页全文
+                print(f"  📄 并发抓取 {len(search_results_list)} 个网页...")
+                contents = self.fetch_pages(
+                    [r.get('href', '') for r in search_results_list],
+                    first_k=first_k if first_k is not None else self.first_k,
+                    deadline=deadline
+                )
+
+                results = self.build_results(search_results_list, contents)
+                print(f"  ✅ 成功！策略 {strategy['name']} 找到 {len(results)} 条结果，已抓取网页全文")
+
+            if not results:
+                print("⚠️ 所有搜索策略都未能找到结果")
+
+            return results
+
+        except Exception as e:
+            print(f"❌ 搜索失败: {e}")
+            import traceback
+            traceback.print_exc()
+            return []
+
+    def summarize_page(self, query: str, result: Dict, content: str,
+                       usage: Optional[UsageTracker] = None) -> str:
+        """提炼单个网页中与搜索词相关的要点（map），失败时返回空字符串"""
+        try:
+            return self._complete("map", self.page_request(query, result, content), usage, url=result['url']).strip()
+        except Exception as e:
+            print(f"  ⚠️ 网页要点提炼失败 {result['url']}: {e}")
+            return ""
+
+    def reduce_summaries(self, query: str, partials: List[Dict], snippets: List[Dict],
+                         usage: Optional[UsageTracker] = None) -> str:
+        """合并各网页要点为最终总结（reduce）；只有一个来源时直接使用其要点"""
+        shortcut = self._reduce_shortcut(partials, snippets)
+        if shortcut is not None:
+            return shortcut
+        try:
+            summary = self._complete("reduce", self.reduce_request(query, partials, snippets), usage,
+                                     sources=len(partials))
+        except Exception as e:
+            return self._reduce_failed(partials, e)
+        print(f"  📝 合并总结完成 ({len(summary)} 字，{len(partials)} 个来源)")
+        return summary
+
+    def search_and_summarize(self,
+                             query: str,
+                             max_results: int = 8,
+                             deadline: Optional[float] = None,
+                             question: str = "",
+                             usage: Optional[UsageTracker] = None) -> Tuple[str, List[Dict]]:
+        """
+        搜索并总结
+        pipelined模式下网页抓取和要点提炼流水线执行：每个网页抓取完成后立即挑选相关文本块并提交提炼，
+        获得enough_pages个相关网页的要点后取消其余抓取和提炼，再用一次小调用合并
+
+        参数:
+            query: 搜索关键词
+            max_results: 最大结果数
+            deadline: 抓取和提炼的总时限（秒，默认使用fetch_deadline）
+            question: 用户的原始问题，和搜索词一起用于挑选相关文本块
+            usage: 记录各阶段小模型调用用量的UsageTracker（可选）
+
+        返回:
+            (总结, 搜索结果列表)，无结果时为 ("未找到相关信息", [])
+        """
+        if self.summary_mode != "pipelined":
+            results = self.search_web(query, max_results=max_results)
+            if not results:
+                return NO_RESULTS, []
+            return self.summarize_search_results(query, results, question, usage), results
+
+        print(f"🔍 开始搜索: {query}")
+        strategy, search_results_list = self.find_search_results(query, max_results)
+        if not search_results_list:
+            print("⚠️ 所有搜索策略都未能找到结果")
+            return NO_RESULTS, []
+        results = self.build_results(search_results_list)
+        print(f"  📄 策略 {strategy['name']} 找到 {len(results)} 条结果，流水线抓取并提炼要点...")
+
+        deadline = self.fetch_deadline if deadline is None else deadline
+        end_time = time.monotonic() + deadline
+        pipeline = SummaryPipeline(self, query, results, question)
+        fetch_executor = ThreadPoolExecutor(max_workers=min(self.fetch_workers, len(results)))
+        map_executor = ThreadPoolExecutor(max_workers=self.map_workers)
+        fetches = {
+            fetch_executor.submit(in_current_context(self.fetch_webpage_content), r['url']): i
+            for i, r in enumerate(results)
+        }
+        maps = {}
+        pending = set(fetches)
+
+        try:
+            while pending:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    print(f"  ⏱️ 超时（{deadline:.0f}秒），放弃剩余 {len(pending)} 个任务")
+                    break
+
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in maps:
+                        pipeline.add_notes(maps[future], future.result())
+                        continue
+                    index = fetches[future]
+                    try:
+                        content = future.result()
+                    except Exception as e:
+                        print(f"  ⚠️ 抓取任务异常: {e}")
+                        content = ""
+                    material = pipeline.add_page(index, content)
+                    if material is not None:
+                        map_future = map_executor.submit(in_current_context(self.summarize_page), query,
+                                                         results[index], material, usage)
+                        maps[map_future] = index
+                        pending.add(map_future)
+
+                if pipeline.enough and pending:
+                    print(f"  ⚡ 已获得 {len(pipeline.partials)} 个相关网页的要点，取消剩余 {len(pending)} 个任务")
+                    break
+                if pipeline.map_budget_used and not any(f in maps for f in pending):
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            fetch_executor.shutdown(wait=False)
+            map_executor.shutdown(wait=False)
+
+        ordered, snippets = pipeline.reduce_inputs()
+        if not ordered:
+            # 没有提炼出相关要点（全部失败或无关），退回一次性总结
+            return self.summarize_search_results(query, results, question, usage), results
+        return self.reduce_summaries(query, ordered, snippets, usage), results
+
+    def summarize_search_results(self, query: str, results: List[Dict], question: str = "",
+                                 usage: Optional[UsageTracker] = None) -> str:
+        """
+        使用GPT总结搜索结果（使用网页全文中挑选出的相关文本块）
+
+        参数:
+            query: 搜索关键词
+            results: 搜索结果列表
+            question: 用户的原始问题，和搜索词一起用于挑选相关文本块
+            usage: 记录调用用量的UsageTracker（可选）
+
+        返回:
+            总结文本；相关资料很短时直接返回资料，不调用GPT
+        """
+        if not results:
+            return NO_RESULTS
+
+        material, skip_summary = self.select_summary_material(query, results, question)
+        if skip_summary:
+            print("  📎 相关资料较短，直接使用原文，跳过总结调用")
+            return material
+
+        try:
+            summary = self._complete("summary", self.summary_request(query, material), usage, sources=len(results))
+        except Exception as e:
+            return self._summary_failed(results, e)
+        print(f"  📝 总结完成 ({len(summary)} 字)")
+        return summary
+
+
+class SpeculativeCompletion:
+    """在后台线程中预先生成不带搜索增强的回复，可随时取消"""
+
+    def __init__(self, client: OpenAI, model: str, messages: List[Dict], **kwargs):
+        self.model = model
+        self.messages = messages
+        self.result = {"response": "", "tokens_used": 0, "cost": 0.0, "ttft": None, "latency": 0.0}
+        self._deltas = stream_chat_completion(client, self.result, model=model, messages=messages, **kwargs)
+        self._queue = queue.Queue()
+        self._received = []
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for delta in self._deltas:
+                if self._cancelled.is_set():
+                    break
+                self._received.append(delta)
+                self._queue.put(delta)
+        finally:
+            # 取消时关闭生成器，底层HTTP连接随之断开，停止继续生成
+            self._deltas.close()
+            self._queue.put(None)
+
+    def cancel(self) -> Dict:
+        """
+        取消推测请求
+
+        返回:
+            截至取消时已产生的花费估算 {"prompt_tokens", "completion_tokens", "tokens", "cost"}
+        """
+        self._cancelled.set()
+        return self.estimate_usage(self.model, self.messages, self._received)
+
+    @staticmethod
+    def estimate_usage(model: str, messages: List[Dict], received: List[str]) -> Dict:
+        """估算被取消的推测请求已产生的用量（同步/异步共用）"""
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = count_tokens("".join(received), model)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens": prompt_tokens + completion_tokens,
+            "cost": usage_cost(model, prompt_tokens, completion_tokens)
+        }
+
+    @staticmethod
+    def copy_reply(source: Dict, result: Dict):
+        """把推测回复的内容和用量写入本轮结果（同步/异步共用）"""
+        for key in ('response', 'tokens_used', 'prompt_tokens', 'cached_tokens', 'cost', 'ttft', 'latency', 'error'):
+            if key in source:
+                result[key] = source[key]
+
+    def wait(self, result: Dict):
+        """等待推测回复生成完毕，并把回复和用量写入result"""
+        self._thread.join()
+        self.copy_reply(self.result, result)
+
+    def relay(self, result: Dict):
+        """逐段转发推测回复（生成器），结束后把回复和用量写入result"""
+        while True:
+            delta = self._queue.get()
+            if delta is None:
+                break
+            yield delta
+        self._thread.join()
+        self.copy_reply(self.result, result)
+
+
+class ChatManagerBase:
+    """
+    同步/异步对话管理器共用的部分：结果字段、推测执行记账、知识库/缓存查询、单轮费用检查、回复用量
+    子类只负责按顺序调用各阶段（同步或await）
+    """
+
+    def __init__(self,
+                 openai_client,
+                 search_engine: SearchEngineBase,
+                 search_cache: Optional[SearchCache] = None,
+                 prompt_budget: Optional[int] = None,
+                 keep_last_turns: int = DEFAULT_KEEP_LAST_TURNS,
+                 knowledge_base: Optional[KnowledgeBase] = None,
+                 turn_budget: Optional[float] = None,
+                 budget_mode: Optional[str] = None,
+                 metrics: Optional[MetricsSink] = None):
+        """
+        参数:
+            openai_client: OpenAI / AsyncOpenAI客户端
+            search_engine: 搜索引擎
+            search_cache: 搜索缓存（默认使用进程级共享缓存）
+            prompt_budget: 提示词token预算（默认按模型配置）
+            keep_last_turns: 始终原样保留的最近对话轮数
+            knowledge_base: 角色本地知识库（默认使用进程级共享知识库）
+            turn_budget: 单轮费用上限（美元，默认读取环境变量 TURN_COST_BUDGET，未设置时不限制）
+            budget_mode: 超出上限时 "downgrade"（换用便宜模型）或 "block"（拦截），默认读取 TURN_BUDGET_MODE
+            metrics: 每轮时间线的指标输出（默认使用进程级共享输出）
+        """
         self.client = openai_client
-        self.search_engine = MCPSearchEngine(openai_client)
-        self.search_cache = {}  # 缓存搜索结果
-    
-    def chat_with_mcp(self, 
+        self.prompt_budget = prompt_budget
+        self.keep_last_turns = keep_last_turns
+        self.turn_budget = turn_budget if turn_budget is not None else get_turn_budget()
+        self.budget_mode = budget_mode or get_turn_budget_mode()
+        self.search_engine = search_engine
+        # 缓存搜索结果（默认使用进程级共享缓存，所有会话共用）
+        self.search_cache = search_cache if search_cache is not None else get_shared_cache()
+        # 角色本地知识库，可信命中时跳过网络搜索
+        self.knowledge_base = knowledge_base if knowledge_base is not None else get_shared_knowledge_base()
+        self.metrics = metrics if metrics is not None else get_shared_metrics()
+
+    @staticmethod
+    def _new_result(model: str, turn_usage: UsageTracker) -> Dict:
+        return {
+            "response": "",
+            "model": model,
+            "tokens_used": 0,
+            "cost": 0.0,
+            "usage": turn_usage,
+            "ttft": None,
+            "latency": 0.0,
+            "decision_source": "",
+            "search_performed": False,
+            "search_query": "",
+            "search_source": "",
+            "search_summary": "",
+            "search_results": []
+        }
+
+    def _finish_trace(self, result: Dict, trace: TurnTrace):
+        trace.finish(decision_source=result['decision_source'], search_source=result['search_source'],
+                     tokens=result['tokens_used'], cost=result['cost'])
+        if self.metrics is not None:
+            self.metrics.record_turn(trace)
+
+    def _build_messages(self,
+                        system_prompt: str,
+                        conversation_history: List[Dict],
+                        user_message: str,
+                        model: str,
+                        max_tokens: int,
+                        enhanced_context: str = "",
+                        memory_summary: str = "",
+                        result: Optional[Dict] = None) -> List[Dict]:
+        """在token预算内构建发送给GPT的消息列表，裁剪统计写入result['context']"""
+        messages, stats = fit_messages(
+            system_prompt,
+            conversation_history,
+            user_message,
+            model=model,
+            max_tokens=max_tokens,
+            budget=self.prompt_budget,
+            keep_last_turns=self.keep_last_turns,
+            volatile_context=enhanced_context,
+            memory_summary=memory_summary
+        )
+        if result is not None:
+            result['context'] = stats
+        return messages
+
+    # ---- 推测执行 ----
+
+    def _speculation_budget(self, model: str, messages: List[Dict], max_tokens: int,
+                            turn_usage: UsageTracker) -> Optional[Dict]:
+        """
+        推测回复可能被直接使用，发起前按单轮费用上限检查（计入本轮已花费，按budget_mode降级）
+
+        返回:
+            apply_turn_budget的结果（推测请求使用其中的model/max_tokens）；会被拦截时返回None，不推测
+        """
+        budget = apply_turn_budget(model, messages, max_tokens, turn_usage.total_cost,
+                                   self.turn_budget, self.budget_mode)
+        return None if budget['action'] == "block" else budget
+
+    def _speculation_affordable(self, budget: Dict, messages: List[Dict], turn_usage: UsageTracker) -> bool:
+        """判断无需搜索后，按实际已花费（含GPT判断）复查推测请求是否仍在单轮费用上限内"""
+        check = apply_turn_budget(budget['model'], messages, budget['max_tokens'], turn_usage.total_cost,
+                                  self.turn_budget, self.budget_mode)
+        if check['action'] != "send":
+            print("💸 GPT判断后本轮花费超出上限，放弃推测回复")
+            return False
+        return True
+
+    @staticmethod
+    def _speculation_cancelled(result: Dict, wasted: Dict, model: str, decision_latency: float,
+                               turn_usage: UsageTracker):
+        turn_usage.record("speculation", model, wasted['prompt_tokens'], wasted['completion_tokens'],
+                          cost=wasted['cost'])
+        result['speculation'] = {
+            "used": False,
+            "decision_latency": decision_latency,
+            "saved_latency": 0.0,
+            "wasted_tokens": wasted['tokens'],
+            "wasted_cost": wasted['cost']
+        }
+        print(f"⚡ 推测回复已取消（额外花费约 ${wasted['cost']:.6f}）")
+
+    @staticmethod
+    def _speculation_used(result: Dict, decision_latency: float, budget: Dict, spent: float):
+        """使用推测回复：写入推测请求的费用检查（已花费更新为判断后的实际值）和实际使用的模型"""
+        result['budget'] = dict(budget, spent=spent)
+        result['model'] = budget['model']
+        if budget['action'] == "downgrade":
+            print(f"💸 推测回复已按单轮费用上限降级为 {budget['model']}（回复上限 {budget['max_tokens']} tokens）")
+        result['speculation'] = {
+            "used": True,
+            "decision_latency": decision_latency,
+            "saved_latency": decision_latency,
+            "wasted_tokens": 0,
+            "wasted_cost": 0.0
+        }
+        print(f"⚡ 使用推测回复，节省约 {decision_latency:.2f} 秒")
+
+    # ---- 搜索资料 ----
+
+    @staticmethod
+    def _needs_search(decision: Dict) -> bool:
+        return bool(decision.get('need_search') and decision.get('search_query'))
+
+    def _lookup_knowledge(self, character: Optional[Dict], search_query: str,
+                          user_message: str) -> Optional[Tuple[str, List[Dict], str]]:
+        """查询角色本地知识库，命中时返回 (总结, 资料, "knowledge")"""
+        if self.knowledge_base is None or character is None:
+            return None
+        with span("knowledge") as attrs:
+            knowledge = self.knowledge_base.lookup(character, search_query, user_message)
+            attrs["hit"] = knowledge is not None
+        return (knowledge[0], knowledge[1], "knowledge") if knowledge is not None else None
+
+    def _lookup_cache(self, search_query: str) -> Optional[Tuple[str, List[Dict], str]]:
+        """查询搜索缓存，命中时返回 (总结, 搜索结果, "cache")"""
+        with span("search_cache") as attrs:
+            cached = self.search_cache.lookup(search_query)
+            attrs["hit"] = cached is not None
+        if cached is None:
+            return None
+        cached_query, cached_value, similarity = cached
+        if similarity < 1.0:
+            print(f"📦 使用相近搜索词的缓存结果: {cached_query} (相似度 {similarity:.2f})")
+        else:
+            print("📦 使用缓存的搜索结果")
+        return cached_value['summary'], cached_value['results'], "cache"
+
+    def _remember_search(self, search_query: str, search_summary: str, search_results: List[Dict]):
+        """缓存网络搜索的结果"""
+        if not search_results:
+            print("❌ 搜索无结果")
+            return
+        self.search_cache.set(search_query, {
+            'summary': search_summary,
+            'results': search_results
+        })
+        print(f"✅ 搜索完成，找到 {len(search_results)} 条结果")
+
+    def _apply_search(self, result: Dict, search_query: str, user_message: str, character: Dict,
+                      found: Tuple[str, List[Dict], str]) -> str:
+        """把搜索资料写入result，返回增强的上下文"""
+        search_summary, search_results, result['search_source'] = found
+        result['search_performed'] = True
+        result['search_query'] = search_query
+        result['search_summary'] = search_summary
+        result['search_results'] = search_results
+        return self.search_engine.enhance_context(user_message, character['name'], search_summary)
+
+    # ---- 主回复 ----
+
+    def _check_turn_budget(self, result: Dict, model: str, messages: List[Dict], max_tokens: int,
+                           turn_usage: UsageTracker) -> Optional[Tuple[str, int]]:
+        """
+        单轮费用检查：计入本轮辅助调用的花费，超出上限时降级或拦截
+
+        返回:
+            放行时返回实际使用的 (模型, 回复上限)；拦截时返回None，result['response']为提示语
+        """
+        budget = apply_turn_budget(model, messages, max_tokens, turn_usage.total_cost,
+                                   self.turn_budget, self.budget_mode)
+        result['budget'] = budget
+        if budget['action'] == "block":
+            print(f"🛑 超出单轮费用上限 ${budget['budget']:.4f}（已花费 ${budget['spent']:.4f}，"
+                  f"预估最多 ${budget['estimate']['max_cost']:.4f}），拦截本次回复")
+            result['response'] = BLOCKED_REPLY
+            return None
+        if budget['action'] == "downgrade":
+            print(f"💸 超出单轮费用上限，降级为 {budget['model']}（回复上限 {budget['max_tokens']} tokens）")
+            result['model'] = budget['model']
+        return budget['model'], budget['max_tokens']
+
+    @staticmethod
+    def _read_completion(result: Dict, model: str, response, start_time: float):
+        """把非流式主回复的内容、延迟和用量写入result"""
+        # 非流式模式下首字延迟即整体延迟
+        result['latency'] = result['ttft'] = time.perf_counter() - start_time
+        result['response'] = response.choices[0].message.content
+        result['tokens_used'] = response.usage.total_tokens
+        result['prompt_tokens'] = response.usage.prompt_tokens
+        result['cached_tokens'] = cached_prompt_tokens(response.usage)
+        # 按价格表计算费用（命中提示词缓存的输入按缓存价格）
+        result['cost'] = usage_cost(model, response.usage.prompt_tokens, response.usage.completion_tokens,
+                                    result['cached_tokens'])
+
+    @staticmethod
+    def _completion_failed(result: Dict, error: Exception):
+        print(f"GPT调用失败: {error}")
+        result['response'] = f"抱歉，回复生成失败：{str(error)}"
+
+
+class MCPChatManager(ChatManagerBase):
+    """整合MCP搜索的对话管理器"""
+
+    def __init__(self, openai_client: OpenAI, search_engine: Optional[MCPSearchEngine] = None, **kwargs):
+        """
+        参数:
+            openai_client: OpenAI客户端
+            search_engine: 搜索引擎（默认新建MCPSearchEngine）
+            其余参数见ChatManagerBase
+        """
+        super().__init__(openai_client,
+                         search_engine if search_engine is not None else MCPSearchEngine(openai_client),
+                         **kwargs)
+
+    def chat_with_mcp(self,
                       user_message: str,
                       character: Dict,
                       system_prompt: str,
@@ -309,121 +1263,190 @@ class MCPChatManager:
                       enable_search: bool = True,
                       model: str = "gpt-4o-ca",
                       temperature: float = 0.8,
-                      max_tokens: int = 2000) -> Dict:
+                      max_tokens: int = 2000,
+                      stream: bool = False,
+                      speculative: bool = False,
+                      memory_summary: str = "") -> Dict:
         """
         带MCP搜索增强的对话
-        
+
         参数:
             user_message: 用户消息
             character: 角色信息字典
             system_prompt: 系统提示词
-            conversation_history: 对话历史
+            conversation_history: 对话历史（已压缩进记忆摘要的部分不必再传）
             enable_search: 是否启用搜索
             model: 使用的模型
             temperature: 温度参数
             max_tokens: 最大token数
-            
+            stream: 是否流式输出；为True时回复通过result["stream"]生成器逐段产出，
+                    生成器耗尽后response/tokens_used/cost/ttft才会被填充
+            speculative: 推测执行；需要GPT判断是否搜索时，同时开始生成不带搜索增强的回复，
+                         判断无需搜索则直接使用该回复，需要搜索则取消它；设置了单轮费用上限时推测请求同样按预算降级，
+                         会被拦截时不推测，判断后计入实际花费仍超出上限则取消并按正常流程处理
+            memory_summary: 早期对话的滚动摘要，代替被压缩的对话原文发送
+
         返回:
             {
                 "response": str,
+                "model": str,  # 实际使用的模型（超出单轮费用上限时可能已降级）
                 "tokens_used": int,
-                "cost": float,
+                "prompt_tokens": int,
+                "cached_tokens": int,  # 命中服务端提示词前缀缓存的输入token数
+                "cost": float,  # 主回复的费用
+                "usage": UsageTracker,  # 本轮搜索决策/网页提炼/总结/被取消的推测回复等辅助调用的用量
+                "budget": Dict,  # 单轮费用检查：action(send/downgrade/block)/model/max_tokens/estimate/budget/spent
+                "ttft": float,
+                "latency": float,
+                "decision_source": str,  # "local" / "llm"，未判断时为空
                 "search_performed": bool,
                 "search_query": str,
+                "search_source": str,  # "knowledge"（本地知识库）/ "cache" / "web"，未搜索时为空
                 "search_summary": str,
-                "search_results": List[Dict]
+                "search_results": List[Dict],
+                "context": Dict,  # 上下文裁剪统计：prompt_tokens/budget/dropped_messages/truncated
+                "speculation": Dict,  # 仅发生推测执行时存在：used/decision_latency/saved_latency/wasted_tokens/wasted_cost
+                "trace": TurnTrace,  # 本轮各阶段的耗时时间线（流式模式下生成器耗尽后才完整）
+                "stream": Iterator[str]  # 仅stream=True时存在
             }
         """
-        result = {
-            "response": "",
-            "tokens_used": 0,
-            "cost": 0.0,
-            "search_performed": False,
-            "search_query": "",
-            "search_summary": "",
-            "search_results": []
-        }
-        
+        trace = TurnTrace("chat_with_mcp")
+        token = activate(trace)
+        try:
+            result = self._chat_with_mcp(user_message, character, system_prompt, conversation_history,
+                                         enable_search, model, temperature, max_tokens, stream,
+                                         speculative, memory_summary)
+        finally:
+            deactivate(token)
+        result['trace'] = trace
+        if 'stream' in result:
+            result['stream'] = self._traced_stream(result, result['stream'], trace)
+        else:
+            self._finish_trace(result, trace)
+        return result
+
+    def _traced_stream(self, result: Dict, deltas, trace: TurnTrace):
+        """透传流式片段，流结束（或中途关闭）后补记主回复阶段并输出本轮指标"""
+        start = time.perf_counter()
+        try:
+            yield from deltas
+        finally:
+            trace.add_span("completion", start, time.perf_counter(), model=result['model'], stream=True,
+                           ttft=result.get('ttft'), tokens=result.get('tokens_used', 0))
+            self._finish_trace(result, trace)
+
+    def _chat_with_mcp(self,
+                       user_message: str,
+                       character: Dict,
+                       system_prompt: str,
+                       conversation_history: List[Dict],
+                       enable_search: bool = True,
+                       model: str = "gpt-4o-ca",
+                       temperature: float = 0.8,
+                       max_tokens: int = 2000,
+                       stream: bool = False,
+                       speculative: bool = False,
+                       memory_summary: str = "") -> Dict:
+        """带MCP搜索增强的对话（在本轮时间线已激活时执行），参数和返回值见chat_with_mcp"""
+        turn_usage = UsageTracker()
+        result = self._new_result(model, turn_usage)
+        speculation = None
+        enhanced_context = ""
+
         # 1. MCP决策：是否需要搜索
         if enable_search:
-            decision = self.search_engine.should_search(
-                user_message, 
-                character['name']
-            )
-            
-            if decision['need_search']:
+            decision = self.search_engine.decide_search_locally(user_message, character)
+            if decision is None:
+                if speculative:
+                    speculation_messages = self._build_messages(system_prompt, conversation_history, user_message,
+                                                                model, max_tokens, memory_summary=memory_summary,
+                                                                result=result)
+                    speculation_budget = self._speculation_budget(model, speculation_messages, max_tokens,
+                                                                  turn_usage)
+                    if speculation_budget is not None:
+                        # 推测执行：GPT判断期间先生成不带搜索增强的回复
+                        speculation = SpeculativeCompletion(self.client, speculation_budget['model'],
+                                                            speculation_messages, temperature=temperature,
+                                                            max_tokens=speculation_budget['max_tokens'])
+                decision_start = time.perf_counter()
+                decision = self.search_engine.decide_search_with_llm(user_message, character, turn_usage)
+                decision_latency = time.perf_counter() - decision_start
+            result['decision_source'] = decision['source']
+
+            if self._needs_search(decision):
                 search_query = decision['search_query']
                 print(f"🔍 MCP触发搜索: {search_query}")
-                
-                # 检查缓存
-                if search_query in self.search_cache:
-                    search_summary = self.search_cache[search_query]['summary']
-                    search_results = self.search_cache[search_query]['results']
-                    print("📦 使用缓存的搜索结果")
-                else:
-                    # 2. 执行搜索（增加搜索结果数量）
-                    search_results = self.search_engine.search_web(search_query, max_results=8)
-                    
-                    if search_results:
-                        # 3. 总结搜索结果
-                        search_summary = self.search_engine.summarize_search_results(
-                            search_query, 
-                            search_results
-                        )
-                        
-                        # 缓存结果
-                        self.search_cache[search_query] = {
-                            'summary': search_summary,
-                            'results': search_results
-                        }
-                        print(f"✅ 搜索完成，找到 {len(search_results)} 条结果")
-                    else:
-                        search_summary = "未找到相关信息"
-                        search_results = []
-                        print("❌ 搜索无结果")
-                
-                # 4. 增强系统提示词
-                enhanced_context = self.search_engine.enhance_context(
-                    user_message,
-                    character['name'],
-                    search_summary
-                )
-                
-                system_prompt = f"{system_prompt}\n\n{enhanced_context}"
-                
-                result['search_performed'] = True
-                result['search_query'] = search_query
-                result['search_summary'] = search_summary
-                result['search_results'] = search_results
-        
-        # 5. 构建消息列表
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
-        messages.extend(conversation_history)
-        messages.append({"role": "user", "content": user_message})
-        
+                if speculation is not None:
+                    self._speculation_cancelled(result, speculation.cancel(), speculation.model, decision_latency,
+                                                turn_usage)
+                    speculation = None
+
+                # 2. 先查角色本地知识库，再检查缓存，都未命中时搜索并总结
+                found = self._search(search_query, user_message, character, turn_usage)
+                # 3. 增强系统提示词
+                enhanced_context = self._apply_search(result, search_query, user_message, character, found)
+
+        # GPT判断的花费使推测请求超出上限时取消它，按正常流程检查预算
+        if speculation is not None and not self._speculation_affordable(speculation_budget, speculation.messages,
+                                                                        turn_usage):
+            self._speculation_cancelled(result, speculation.cancel(), speculation.model, decision_latency,
+                                        turn_usage)
+            speculation = None
+
+        # 推测回复命中：无需搜索，直接使用已在生成中的回复
+        if speculation is not None:
+            self._speculation_used(result, decision_latency, speculation_budget, turn_usage.total_cost)
+            if stream:
+                result['stream'] = speculation.relay(result)
+            else:
+                with span("completion", model=speculation.model, speculative=True) as attrs:
+                    speculation.wait(result)
+                    attrs["tokens"] = result['tokens_used']
+            return result
+
+        # 4. 构建消息列表
+        with span("context"):
+            messages = self._build_messages(system_prompt, conversation_history, user_message,
+                                            model, max_tokens, enhanced_context, memory_summary, result)
+
+        # 5. 单轮费用检查：超出上限时降级或拦截
+        limits = self._check_turn_budget(result, model, messages, max_tokens, turn_usage)
+        if limits is None:
+            if stream:
+                result['stream'] = iter([result['response']])
+            return result
+        model, max_tokens = limits
+
         # 6. 调用GPT生成回复
+        if stream:
+            result['stream'] = stream_chat_completion(self.client, result, model=model, messages=messages,
+                                                      temperature=temperature, max_tokens=max_tokens)
+            return result
+
         try:
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            
-            result['response'] = response.choices[0].message.content
-            result['tokens_used'] = response.usage.total_tokens
-            
-            # 计算费用（gpt-4o-ca定价）
-            prompt_tokens = response.usage.prompt_tokens
-            completion_tokens = response.usage.completion_tokens
-            result['cost'] = (prompt_tokens * 0.000005 + 
-                            completion_tokens * 0.000015)
-            
+            start_time = time.perf_counter()
+            with span("completion", model=model) as attrs:
+                response = self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                attrs["tokens"] = response.usage.total_tokens
+            self._read_completion(result, model, response, start_time)
         except Exception as e:
-            print(f"GPT调用失败: {e}")
-            result['response'] = f"抱歉，回复生成失败：{str(e)}"
-        
+            self._completion_failed(result, e)
+
         return result
 
+    def _search(self, search_query: str, user_message: str, character: Dict,
+                usage: UsageTracker) -> Tuple[str, List[Dict], str]:
+        """先查角色本地知识库和缓存，都未命中时搜索并总结，返回 (总结, 搜索结果, 来源)"""
+        found = self._lookup_knowledge(character, search_query, user_message) or self._lookup_cache(search_query)
+        if found is not None:
+            return found
+        # 默认流水线：网页边抓取边提炼要点
+        search_summary, search_results = self.search_engine.search_and_summarize(
+            search_query, max_results=8, question=user_message, usage=usage)
+        self._remember_search(search_query, search_summary, search_results)
+        return search_summary, search_results, "web"
@@ -0,0 +1,173 @@
+"""
+长对话的滚动摘要记忆
+把超出最近N轮的早期对话逐步压缩为角色视角的摘要，代替原文发送给模型
+摘要在回复显示后由后台线程用gpt-4o-mini增量更新，不占用对话请求的时间
+"""
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from openai import OpenAI
+
+from context_budget import DEFAULT_KEEP_LAST_TURNS
+from pricing import UsageTracker
+
+
+class ConversationMemory:
+    """单个会话的滚动摘要记忆"""
+
+    def __init__(self,
+                 keep_last_turns: int = DEFAULT_KEEP_LAST_TURNS,
+                 min_fold_turns: int = 2,
+                 model: str = "gpt-4o-mini"):
+        """
+        参数:
+            keep_last_turns: 始终以原文发送的最近对话轮数，更早的对话会被压缩进摘要
+            min_fold_turns: 至少积累多少轮过期对话才触发一次摘要更新
+            model: 生成摘要使用的模型
+        """
+        self.keep_last_turns = keep_last_turns
+        self.min_fold_turns = min_fold_turns
+        self.model = model
+
+        self.summary = ""
+        self.summarized_count = 0  # 已压缩进摘要的消息条数（从对话开头算起）
+        self._unbilled = UsageTracker()  # 摘要调用尚未计入会话统计的用量
+        self._lock = threading.Lock()
+        self._thread = None
+        self._folding = False  # 后台更新进行中（结果尚未写回）
+        self._dropped_during_fold = 0  # 更新进行中被强制丢弃、超出已压缩部分的消息条数
+
+    def snapshot(self) -> Tuple[str, int]:
+        """返回 (摘要, 已压缩消息条数) 的一致快照"""
+        with self._lock:
+            return self.summary, self.summarized_count
+
+    def recent_history(self, messages: List[Dict]) -> Tuple[str, List[Dict]]:
+        """
+        返回发送给模型的记忆内容
+
+        返回:
+            (摘要, 尚未压缩的对话原文)
+        """
+        summary, count = self.snapshot()
+        return summary, messages[count:]
+
+    def _aged_out(self, messages: List[Dict]) -> List[Dict]:
+        """已超出最近N轮、尚未压缩的消息（按整轮对齐）"""
+        end = len(messages) - self.keep_last_turns * 2
+        end -= (end - self.summarized_count) % 2
+        return messages[self.summarized_count:end] if end > self.summarized_count else []
+
+    def update_async(self, client: OpenAI, messages: List[Dict], character: Dict) -> bool:
+        """
+        在后台线程中把新过期的对话折叠进摘要
+
+        返回:
+            是否启动了后台更新
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            aged_out = self._aged_out(messages)
+            if len(aged_out) < self.min_fold_turns * 2:
+                return False
+            previous_summary = self.summary
+            self._folding = True
+            self._thread = threading.Thread(
+                target=self._fold,
+                args=(client, previous_summary, list(aged_out), character),
+                daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _fold(self, client: OpenAI, previous_summary: str, aged_out: List[Dict], character: Dict):
+        dialogue = "\n".join(
+            f"{'用户' if m['role'] == 'user' else character['name']}：{m['content']}"
+            for m in aged_out
+        )
+        prompt = f"""你负责为一段角色扮演对话维护长期记忆。角色是{character['name']}（{character.get('source', '')}）。
+
+【已有的对话摘要】
+{previous_summary or '（暂无）'}
+
+【新增的早期对话】
+{dialogue}
+
+请把新增对话合并进已有摘要，输出更新后的完整摘要：
+1. 以{character['name']}的视角记录：用户透露的个人信息和偏好、讨论过的话题和结论、角色做出的承诺或讲述过的经历、尚未结束的话题
+2. 保留具体的人名、数字和约定，省略寒暄和重复内容
+3. 使用中文，不超过400字，只输出摘要本身"""
+
+        try:
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3,
+                max_tokens=800
+            )
+            new_summary = response.choices[0].message.content.strip()
+
+            with self._lock:
+                self.summary = new_summary
+                # aged_out是更新开始时的切片，期间被强制丢弃的部分已不在消息列表中
+                self.summarized_count = max(0, self.summarized_count + len(aged_out) - self._dropped_during_fold)
+                self._unbilled.record_usage("memory", self.model, response.usage)
+            print(f"🧠 记忆摘要已更新：折叠 {len(aged_out)} 条消息（共 {self.summarized_count} 条），"
+                  f"摘要 {len(new_summary)} 字")
+        except Exception as e:
+            print(f"⚠️ 记忆摘要更新失败: {e}")
+        finally:
+            with self._lock:
+                self._folding = False
+                self._dropped_during_fold = 0
+
+    def release_summarized(self, max_count: int) -> int:
+        """
+        调用方要丢弃最早的消息原文时调用：只允许丢弃已压缩进摘要的部分（按整轮对齐），并相应下调已压缩条数
+
+        参数:
+            max_count: 最多丢弃的消息条数
+
+        返回:
+            实际可以丢弃的条数（调用方需从消息列表开头删除这么多条）
+        """
+        with self._lock:
+            count = min(max_count, self.summarized_count)
+            count -= count % 2
+            self.summarized_count -= count
+            return count
+
+    def forget_oldest(self, count: int):
+        """
+        调用方强制丢弃了最早的count条消息原文（包括尚未压缩的部分）时调用，相应下调已压缩条数
+        尚未压缩就被丢弃的消息不会进入摘要；后台更新进行中时，超出已压缩部分的条数留到更新写回时扣除
+        """
+        with self._lock:
+            if self._folding:
+                self._dropped_during_fold += max(0, count - self.summarized_count)
+            self.summarized_count = max(0, self.summarized_count - count)
+
+    def wait(self, timeout: Optional[float] = None):
+        """等待正在进行的后台更新完成（用于测试和批处理）"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def pop_unbilled_usage(self) -> UsageTracker:
+        """取出摘要调用尚未计入会话统计的用量"""
+        with self._lock:
+            usage = self._unbilled
+            self._unbilled = UsageTracker()
+            return usage
+
+    def to_dict(self) -> Dict:
+        summary, count = self.snapshot()
+        return {"summary": summary, "summarized_count": count}
+
+    @classmethod
+    def from_dict(cls, data: Dict, **kwargs) -> "ConversationMemory":
+        memory = cls(**kwargs)
+        memory.summary = data.get("summary", "")
+        memory.summarized_count = data.get("summarized_count", 0)
+        return memory
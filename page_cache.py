@@ -0,0 +1,234 @@
+"""
+网页正文的磁盘缓存
+按URL保存提取后的正文以及 ETag / Last-Modified，跨会话、跨重启复用：
+新鲜期内直接返回，不发请求；过期后用 If-None-Match / If-Modified-Since 条件请求重新验证，
+服务器返回304时沿用缓存正文。总大小超出上限时淘汰最久未访问的网页
+"""
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+
+DEFAULT_DB_PATH = str(Path(__file__).parent / ".cache" / "page_cache.sqlite3")
+
+
+class PageCache:
+    """线程安全的SQLite网页正文缓存"""
+
+    def __init__(self,
+                 db_path: str = DEFAULT_DB_PATH,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 fresh_ttl: float = 24 * 3600):
+        """
+        参数:
+            db_path: SQLite文件路径
+            max_bytes: 缓存正文的总大小上限（字节），超出后淘汰最久未访问的网页
+            fresh_ttl: 新鲜期（秒），期内命中不发请求，过期后做条件请求重新验证
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.fresh_ttl = fresh_ttl
+        self._lock = threading.Lock()
+        self._db = None
+        self.total_bytes = 0
+
+        self.hits = 0  # 新鲜命中，未发请求
+        self.revalidated = 0  # 条件请求返回304
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0  # 命中和304省下的下载字节数
+
+        self._open_db()
+
+    def _open_db(self):
+        try:
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "url TEXT PRIMARY KEY, text TEXT NOT NULL, max_length INTEGER NOT NULL, "
+                "etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL, size INTEGER NOT NULL, download_bytes INTEGER NOT NULL)"
+            )
+            self._db.commit()
+            row = self._db.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM pages").fetchone()
+            self.total_bytes = row[0]
+            self._evict()  # 上限调小后先淘汰多出的部分
+            if row[1]:
+                print(f"📦 网页缓存已载入 {row[1]} 个网页（{self.total_bytes / 1024:.0f} KB）")
+        except Exception as e:
+            print(f"⚠️ 网页缓存不可用: {e}")
+            self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def lookup(self, url: str, max_length: int) -> Optional[Dict]:
+        """
+        查询缓存
+
+        参数:
+            url: 网页URL
+            max_length: 本次需要的最大字符长度（缓存的正文比它短时视为未命中）
+
+        返回:
+            {"text", "etag", "last_modified", "fresh", "download_bytes"}，未命中返回None
+        """
+        if self._db is None:
+            return None
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT text, max_length, etag, last_modified, fetched_at, download_bytes "
+                    "FROM pages WHERE url = ?", (url,)
+                ).fetchone()
+            except Exception as e:
+                print(f"⚠️ 网页缓存读取失败: {e}")
+                return None
+            if row is None or row[1] < max_length:
+                self.misses += 1
+                return None
+
+            text, _, etag, last_modified, fetched_at, download_bytes = row
+            if len(text) > max_length:
+                text = text[:max_length] + "..."
+            fresh = time.time() - fetched_at < self.fresh_ttl
+            if fresh:
+                self.hits += 1
+                self.bytes_saved += download_bytes
+                self._execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            elif not (etag or last_modified):
+                # 过期且无法条件请求，只能重新下载
+                self.misses += 1
+                return None
+            return {
+                "text": text,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fresh": fresh,
+                "download_bytes": download_bytes
+            }
+
+    @staticmethod
+    def conditional_headers(entry: Optional[Dict]) -> Dict:
+        """根据缓存条目生成条件请求头"""
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def mark_revalidated(self, url: str, entry: Dict):
+        """服务器返回304：刷新新鲜期"""
+        if self._db is None:
+            return
+        now = time.time()
+        with self._lock:
+            self.revalidated += 1
+            self.bytes_saved += entry["download_bytes"]
+            self._execute("UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+
+    def store(self,
+              url: str,
+              text: str,
+              max_length: int,
+              etag: Optional[str] = None,
+              last_modified: Optional[str] = None,
+              download_bytes: int = 0):
+        """写入网页正文，超出总大小上限时淘汰最久未访问的网页"""
+        if self._db is None or not text:
+            return
+        size = len(text.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self._execute(
+                "INSERT OR REPLACE INTO pages (url, text, max_length, etag, last_modified, "
+                "fetched_at, accessed_at, size, download_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, text, max_length, etag, last_modified, now, now, size, download_bytes)
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未访问的网页直到不超过大小上限（调用方持有锁）"""
+        while self.total_bytes > self.max_bytes:
+            row = self._db.execute(
+                "SELECT url, size FROM pages ORDER BY accessed_at ASC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self.total_bytes = 0
+                break
+            self._execute("DELETE FROM pages WHERE url = ?", (row[0],))
+            self.total_bytes -= row[1]
+            self.evictions += 1
+
+    def _execute(self, sql: str, params: tuple):
+        try:
+            self._db.execute(sql, params)
+            self._db.commit()
+        except Exception as e:
+            print(f"⚠️ 网页缓存写入失败: {e}")
+
+    def clear(self):
+        """清空缓存"""
+        if self._db is None:
+            return
+        with self._lock:
+            self._execute("DELETE FROM pages", ())
+            self.total_bytes = 0
+
+    def stats(self) -> Dict:
+        """返回缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.revalidated + self.misses
+            entries = 0
+            if self._db is not None:
+                entries = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            return {
+                "entries": entries,
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "enabled": self._db is not None
+            }
+
+
+_shared_page_cache = None
+_shared_page_cache_lock = threading.Lock()
+
+
+def get_shared_page_cache() -> Optional[PageCache]:
+    """
+    获取进程级共享的网页缓存（所有会话共用）
+    可通过环境变量配置：
+        MCP_PAGE_CACHE_DB      SQLite文件路径（默认 .cache/page_cache.sqlite3，设为空字符串关闭）
+        MCP_PAGE_CACHE_MAX_MB  缓存总大小上限（MB，默认64）
+        MCP_PAGE_CACHE_FRESH   新鲜期秒数（默认86400），过期后条件请求重新验证
+
+    返回:
+        PageCache，关闭时返回None
+    """
+    global _shared_page_cache
+    db_path = os.getenv('MCP_PAGE_CACHE_DB', DEFAULT_DB_PATH)
+    if not db_path:
+        return None
+    with _shared_page_cache_lock:
+        if _shared_page_cache is None:
+            _shared_page_cache = PageCache(
+                db_path=db_path,
+                max_bytes=int(float(os.getenv('MCP_PAGE_CACHE_MAX_MB', 64)) * 1024 * 1024),
+                fresh_ttl=float(os.getenv('MCP_PAGE_CACHE_FRESH', 24 * 3600))
+            )
+        return _shared_page_cache
@@ -0,0 +1,240 @@
+"""
+模型定价与用量统计
+- 可配置的模型价格表（环境变量 MODEL_PRICES_FILE 指定JSON文件覆盖或补充）
+- UsageTracker：按阶段（搜索决策、网页提炼、总结、记忆摘要、主回复等）汇总每次API调用的用量和费用
+- 发送前预估请求费用，并按单轮费用上限放行、降级或拦截主回复请求
+"""
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+from token_counter import count_message_tokens
+
+
+# 模型价格（美元 / 百万token）；cached_input为命中服务端提示词缓存的输入价格
+MODEL_PRICES = {
+    "gpt-4o-ca": {"input": 5.0, "cached_input": 2.5, "output": 15.0},
+    "gpt-4o": {"input": 5.0, "cached_input": 2.5, "output": 15.0},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.6},
+}
+DEFAULT_MODEL = "gpt-4o-ca"  # 价格表中没有的模型按此模型计价
+
+# 超出单轮预算时的降级模型
+DOWNGRADE_MODELS = {
+    "gpt-4o-ca": "gpt-4o-mini",
+    "gpt-4o": "gpt-4o-mini",
+}
+# 用量统计阶段的显示名称
+USAGE_STAGE_LABELS = {
+    "main": "主回复",
+    "decision": "搜索决策",
+    "map": "网页提炼",
+    "reduce": "合并总结",
+    "summary": "搜索总结",
+    "speculation": "推测回复",
+    "memory": "记忆摘要",
+}
+
+EXPECTED_COMPLETION_TOKENS = 400  # 预估费用时假设的典型回复长度
+MIN_REPLY_TOKENS = 300  # 降级时回复长度上限不低于此值，否则拦截
+
+_prices = None
+_prices_lock = threading.Lock()
+
+
+def get_prices() -> Dict[str, Dict[str, float]]:
+    """价格表：内置价格，加上 MODEL_PRICES_FILE（JSON，格式同MODEL_PRICES）中的覆盖"""
+    global _prices
+    with _prices_lock:
+        if _prices is None:
+            prices = {model: dict(price) for model, price in MODEL_PRICES.items()}
+            path = os.getenv('MODEL_PRICES_FILE')
+            if path:
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        for model, price in json.load(f).items():
+                            prices.setdefault(model, {}).update(price)
+                except (OSError, ValueError) as e:
+                    print(f"⚠️ 价格表 {path} 读取失败，使用内置价格: {e}")
+            _prices = prices
+        return _prices
+
+
+def get_model_price(model: str) -> Dict[str, float]:
+    prices = get_prices()
+    price = prices.get(model, prices[DEFAULT_MODEL])
+    return {
+        "input": price["input"],
+        "cached_input": price.get("cached_input", price["input"]),
+        "output": price["output"],
+    }
+
+
+def cached_prompt_tokens(usage) -> int:
+    """usage中命中服务端提示词前缀缓存的输入token数（不返回该字段的代理记为0）"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(details, 'cached_tokens', None) or 0
+
+
+def usage_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    """
+    按价格表计算一次调用的费用（美元）
+
+    参数:
+        model: 模型名称
+        prompt_tokens: 输入token数（包含cached_tokens）
+        completion_tokens: 输出token数
+        cached_tokens: 其中命中提示词缓存的输入token数
+    """
+    price = get_model_price(model)
+    return ((prompt_tokens - cached_tokens) * price["input"] +
+            cached_tokens * price["cached_input"] +
+            completion_tokens * price["output"]) / 1_000_000
+
+
+def estimate_request(model: str, messages: List[Dict], max_tokens: int) -> Dict:
+    """
+    发送前预估一次请求的token数和费用
+
+    返回:
+        {"model", "prompt_tokens", "max_tokens",
+         "expected_cost": 按典型回复长度估算, "max_cost": 按回复写满max_tokens估算}
+    """
+    prompt_tokens = count_message_tokens(messages, model)
+    return {
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "max_tokens": max_tokens,
+        "expected_cost": usage_cost(model, prompt_tokens, min(max_tokens, EXPECTED_COMPLETION_TOKENS)),
+        "max_cost": usage_cost(model, prompt_tokens, max_tokens)
+    }
+
+
+def get_turn_budget() -> Optional[float]:
+    """单轮费用上限（美元），环境变量 TURN_COST_BUDGET，未设置时不限制"""
+    budget = os.getenv('TURN_COST_BUDGET')
+    return float(budget) if budget else None
+
+
+def get_turn_budget_mode() -> str:
+    """超出单轮费用上限时的处理，环境变量 TURN_BUDGET_MODE：downgrade（默认）或 block"""
+    return os.getenv('TURN_BUDGET_MODE', 'downgrade')
+
+
+def apply_turn_budget(model: str,
+                      messages: List[Dict],
+                      max_tokens: int,
+                      spent: float = 0.0,
+                      budget: Optional[float] = None,
+                      mode: str = "downgrade") -> Dict:
+    """
+    按单轮费用上限检查主回复请求
+
+    参数:
+        model: 计划使用的模型
+        messages: 将要发送的消息
+        max_tokens: 回复长度上限
+        spent: 本轮已花费（搜索决策、总结等）
+        budget: 单轮费用上限，None表示不限制
+        mode: 超出上限时的处理，"downgrade"（换用便宜模型、必要时缩短回复上限）或 "block"（直接拦截）
+
+    返回:
+        {"action": "send" / "downgrade" / "block", "model", "max_tokens", "estimate", "budget", "spent"}，
+        estimate为最终放行请求（或被拦截请求）的预估
+    """
+    estimate = estimate_request(model, messages, max_tokens)
+    decision = {"action": "send", "model": model, "max_tokens": max_tokens,
+                "estimate": estimate, "budget": budget, "spent": spent}
+    if budget is None or spent + estimate["max_cost"] <= budget:
+        return decision
+
+    decision["action"] = "block"
+    cheaper = DOWNGRADE_MODELS.get(model)
+    if mode != "downgrade" or cheaper is None:
+        return decision
+
+    remaining = budget - spent
+    cheaper_estimate = estimate_request(cheaper, messages, max_tokens)
+    if cheaper_estimate["max_cost"] > remaining:
+        # 缩短回复上限，使最坏情况的费用落在预算内
+        price = get_model_price(cheaper)
+        prompt_cost = usage_cost(cheaper, cheaper_estimate["prompt_tokens"], 0)
+        affordable = int((remaining - prompt_cost) * 1_000_000 / price["output"])
+        if affordable < MIN_REPLY_TOKENS:
+            return decision
+        cheaper_estimate = estimate_request(cheaper, messages, min(max_tokens, affordable))
+    decision.update(action="downgrade", model=cheaper, max_tokens=cheaper_estimate["max_tokens"],
+                    estimate=cheaper_estimate)
+    return decision
+
+
+class UsageTracker:
+    """按阶段汇总API调用的用量和费用（线程安全）"""
+
+    def __init__(self):
+        self._stages: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self,
+               stage: str,
+               model: str,
+               prompt_tokens: int,
+               completion_tokens: int,
+               cached_tokens: int = 0,
+               cost: Optional[float] = None) -> float:
+        """
+        记录一次调用
+
+        参数:
+            stage: 调用阶段，如 "decision" / "map" / "reduce" / "summary" / "speculation" / "memory" / "main"
+            model: 模型名称
+            prompt_tokens: 输入token数
+            completion_tokens: 输出token数
+            cached_tokens: 命中提示词缓存的输入token数
+            cost: 已计算好的费用（默认按价格表计算）
+
+        返回:
+            本次调用的费用
+        """
+        if cost is None:
+            cost = usage_cost(model, prompt_tokens, completion_tokens, cached_tokens)
+        with self._lock:
+            stats = self._stages.setdefault(stage, {
+                "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "cost": 0.0
+            })
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cached_tokens"] += cached_tokens
+            stats["cost"] += cost
+        return cost
+
+    def record_usage(self, stage: str, model: str, usage) -> float:
+        """记录OpenAI响应中的usage对象（为None时不记录）"""
+        if usage is None:
+            return 0.0
+        return self.record(stage, model, usage.prompt_tokens, usage.completion_tokens, cached_prompt_tokens(usage))
+
+    def merge(self, other: "UsageTracker"):
+        """把另一个统计的各阶段用量累加进来"""
+        for stage, stats in other.stages().items():
+            with self._lock:
+                target = self._stages.setdefault(stage, {key: 0 for key in stats})
+                for key, value in stats.items():
+                    target[key] += value
+
+    def stages(self) -> Dict[str, Dict]:
+        """各阶段用量的副本"""
+        with self._lock:
+            return {stage: dict(stats) for stage, stats in self._stages.items()}
+
+    @property
+    def total_cost(self) -> float:
+        with self._lock:
+            return sum(stats["cost"] for stats in self._stages.values())
+
+    @property
+    def total_tokens(self) -> int:
+        with self._lock:
+            return sum(stats["prompt_tokens"] + stats["completion_tokens"] for stats in self._stages.values())
@@ -0,0 +1,286 @@
+"""
+MCP搜索结果缓存
+进程内所有Streamlit会话共享，支持LRU容量淘汰、TTL过期、命中统计和可选的SQLite持久化
+对措辞略有不同的相近搜索词，通过字符二元组相似度复用已有结果
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, FrozenSet, Optional, Tuple
+
+
+def normalize_query(query: str) -> str:
+    """
+    规范化搜索词，作为缓存键
+    全角转半角、英文小写，再按词去重排序（"孙悟空 齐天大圣" 与 "齐天大圣 孙悟空" 视为相同）
+    """
+    query = unicodedata.normalize('NFKC', query or '').lower()
+    return ' '.join(sorted(set(query.split())))
+
+
+def query_features(key: str) -> FrozenSet[str]:
+    """
+    提取搜索词的相似度特征
+    英文/数字词整体作为特征，中文词拆为字符二元组，使"称号由来"与"称号 由来"高度重合
+    """
+    features = set()
+    for token in key.split():
+        if token.isascii() or len(token) == 1:
+            features.add(token)
+        else:
+            features.update(token[i:i + 2] for i in range(len(token) - 1))
+    return frozenset(features)
+
+
+def query_similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """两个特征集合的Jaccard相似度"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SearchCache:
+    """线程安全的LRU + TTL搜索缓存"""
+
+    def __init__(self,
+                 max_entries: int = 256,
+                 ttl: float = 24 * 3600,
+                 db_path: Optional[str] = None,
+                 similarity_threshold: Optional[float] = 0.75):
+        """
+        参数:
+            max_entries: 最多缓存的搜索词数量，超出后淘汰最久未使用的条目
+            ttl: 缓存有效期（秒）
+            db_path: SQLite文件路径，设置后缓存会持久化到磁盘并在重启后恢复
+            similarity_threshold: 相近搜索词复用阈值（0~1），None表示只做精确匹配
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._features = {}  # key -> 相似度特征
+        self._index = {}  # 特征 -> 包含该特征的key集合（倒排索引）
+        self._lock = threading.RLock()
+        self._db = None
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str):
+        """打开SQLite持久化存储并载入未过期的条目"""
+        try:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            now = time.time()
+            self._db.execute("DELETE FROM search_cache WHERE expires_at <= ?", (now,))
+            self._db.commit()
+
+            rows = self._db.execute(
+                "SELECT key, value, expires_at FROM search_cache "
+                "ORDER BY accessed_at DESC LIMIT ?",
+                (self.max_entries,)
+            ).fetchall()
+            # 按最近访问时间从旧到新插入，保持LRU顺序
+            for key, value, expires_at in reversed(rows):
+                self._entries[key] = (expires_at, json.loads(value))
+                self._index_add(key)
+            print(f"📦 搜索缓存已从磁盘载入 {len(rows)} 条记录")
+        except Exception as e:
+            print(f"⚠️ 搜索缓存持久化不可用: {e}")
+            self._db = None
+
+    def _db_execute(self, sql: str, params: tuple):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(sql, params)
+            self._db.commit()
+        except Exception as e:
+            print(f"⚠️ 搜索缓存写入磁盘失败: {e}")
+
+    def _index_add(self, key: str):
+        features = query_features(key)
+        self._features[key] = features
+        for feature in features:
+            self._index.setdefault(feature, set()).add(key)
+
+    def _remove(self, key: str):
+        """从内存、倒排索引和磁盘中删除条目（调用方持有锁）"""
+        self._entries.pop(key, None)
+        for feature in self._features.pop(key, ()):
+            keys = self._index.get(feature)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[feature]
+        self._db_execute("DELETE FROM search_cache WHERE key = ?", (key,))
+
+    def _find_similar(self, key: str, threshold: float) -> Tuple[Optional[str], float]:
+        """在倒排索引中查找与key最相近且未过期的条目"""
+        features = query_features(key)
+        candidates = set()
+        for feature in features:
+            candidates.update(self._index.get(feature, ()))
+
+        best_key, best_score = None, 0.0
+        now = time.time()
+        for candidate in candidates:
+            if self._entries[candidate][0] <= now:
+                continue
+            score = query_similarity(features, self._features[candidate])
+            if score > best_score:
+                best_key, best_score = candidate, score
+
+        if best_score >= threshold:
+            return best_key, best_score
+        return None, best_score
+
+    def lookup(self,
+               query: str,
+               similarity_threshold: Optional[float] = None) -> Optional[Tuple[str, Dict, float]]:
+        """
+        查询缓存，精确未命中时尝试相近搜索词
+
+        参数:
+            query: 搜索词
+            similarity_threshold: 本次查询的相似度阈值（默认使用实例配置）
+
+        返回:
+            (命中的缓存键, 缓存值, 相似度)，未命中返回None
+        """
+        key = normalize_query(query)
+        threshold = self.similarity_threshold if similarity_threshold is None else similarity_threshold
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                # 已过期
+                self._remove(key)
+                entry = None
+
+            matched_key, score = (key, 1.0) if entry is not None else (None, 0.0)
+            if matched_key is None and threshold is not None:
+                matched_key, score = self._find_similar(key, threshold)
+
+            if matched_key is None:
+                self.misses += 1
+                return None
+
+            if matched_key == key:
+                self.hits += 1
+            else:
+                self.near_hits += 1
+            self._entries.move_to_end(matched_key)
+            self._db_execute(
+                "UPDATE search_cache SET accessed_at = ? WHERE key = ?",
+                (time.time(), matched_key)
+            )
+            return matched_key, self._entries[matched_key][1], score
+
+    def get(self, query: str, similarity_threshold: Optional[float] = None) -> Optional[Dict]:
+        """
+        查询缓存
+
+        返回:
+            缓存的 {"summary": str, "results": List[Dict]}，未命中或已过期返回None
+        """
+        found = self.lookup(query, similarity_threshold)
+        return found[1] if found is not None else None
+
+    def set(self, query: str, value: Dict):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        key = normalize_query(query)
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            if key not in self._entries:
+                self._index_add(key)
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            self._db_execute(
+                "INSERT OR REPLACE INTO search_cache (key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, now)
+            )
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        """清空缓存（包括磁盘）"""
+        with self._lock:
+            self._entries.clear()
+            self._features.clear()
+            self._index.clear()
+            self._db_execute("DELETE FROM search_cache", ())
+
+    def peek(self, query: str) -> Optional[Dict]:
+        """按搜索词精确读取缓存值，不计入命中统计、不影响淘汰顺序（用于展示历史记录）"""
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None and entry[0] > time.time() else None
+
+    def __contains__(self, query: str) -> bool:
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.time()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict:
+        """返回缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+                "persistent": self._db is not None
+            }
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache() -> SearchCache:
+    """
+    获取进程级共享的搜索缓存（所有会话共用）
+    可通过环境变量配置：
+        MCP_CACHE_MAX_ENTRIES  最大条目数（默认256）
+        MCP_CACHE_TTL          有效期秒数（默认86400）
+        MCP_CACHE_DB           SQLite文件路径，设置后启用持久化
+        MCP_CACHE_SIMILARITY   相近搜索词复用阈值（默认0.75，设为1关闭相近匹配）
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = SearchCache(
+                max_entries=int(os.getenv('MCP_CACHE_MAX_ENTRIES', 256)),
+                ttl=float(os.getenv('MCP_CACHE_TTL', 24 * 3600)),
+                db_path=os.getenv('MCP_CACHE_DB') or None,
+                similarity_threshold=float(os.getenv('MCP_CACHE_SIMILARITY', 0.75))
+            )
+        return _shared_cache
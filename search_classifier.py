@@ -0,0 +1,117 @@
+"""
+MCP搜索决策的本地快速判断
+对明显不需要搜索（闲聊、问候、观点类）和明显需要搜索（原著细节、数字、由来类）的问题
+直接在本地给出结论，只有模棱两可的问题才交给GPT判断
+"""
+import re
+from typing import Dict, List, Optional
+
+
+# 整条消息只是问候、致谢、应答等语气词 —— 基于角色性格即可回答
+# 必须整条匹配（标点已去掉），"对于大闹天宫…"、"可以讲讲…" 这类以语气词开头的问题不算闲聊
+INTERJECTION_PATTERN = re.compile(
+    r'(你好|您好|嗨|哈喽|hi|hello|hey|在吗|在不在|'
+    r'早上好|中午好|下午好|晚上好|早安|午安|晚安|'
+    r'谢谢|多谢|感谢|再见|拜拜|回头见|辛苦了|'
+    r'哈哈|嘿嘿|呵呵|嗯|哦|好的|好吧|行|可以|是的|对|没错|真的吗)+'
+    r'(你|您|啊|呀|啦|了|哈|哦)*'
+)
+
+# 日常闲聊、情感表达类话题 —— 基于角色性格即可回答
+SMALL_TALK_PATTERNS = [
+    r'(你是谁|介绍一下你自己|你叫什么)',
+    r'(心情|开心|难过|累不累|无聊|想你|喜欢我|你觉得我)',
+]
+
+# 观点、假设类问题 —— 依靠角色立场即可回答
+OPINION_PATTERNS = [
+    r'(如果|假如|假设|要是)',
+    r'(你觉得|你认为|你怎么看|你喜欢|你最喜欢|你害怕|你讨厌)',
+    r'(建议|安慰|鼓励|陪我)',
+]
+
+# 需要原著细节、事实数据的问题
+FACT_PATTERNS = [
+    r'(原著|原文|原话|台词|出处|第几回|哪一回|哪一章|第几章|哪一集|第几集|哪一部|第几部)',
+    r'(多少|几次|几个|几年|哪一年|哪年|什么时候|何时|年代|日期)',
+    r'(由来|来历|为什么叫|名字的含义|怎么来的|起源)',
+    r'(具体经过|详细经过|来龙去脉|具体情节|详细讲讲)',
+]
+
+# 问的是角色本人的近况，虽含数字类词语但不一定需要搜索，交给GPT判断
+PERSONAL_PATTERNS = [
+    r'(多少岁|几岁|你今年|你现在)',
+]
+
+# 生成搜索词时保留的疑问词（先于口语化成分匹配，"为什么"中的"什么"不会被单独去掉）
+QUESTION_WORDS = r'为什么|什么时候|什么样|怎么样|怎么|哪里|哪些|哪个|多少'
+
+# 生成搜索词时去掉的口语化成分；语气助词只在句末或标点前去掉，不拆开词语中间的字
+FILLER_PATTERN = re.compile(
+    rf'({QUESTION_WORDS})|'
+    r'(?:请问|请你|能不能|可不可以|可以|告诉我|给我|讲讲|说说|讲一下|说一下|介绍一下|'
+    r'一下|是什么|是怎么|是怎样|是谁|是在|你的|你们|你|我想知道|我想问|我|到底|究竟|的是|'
+    r'(?:吗|呢|吧|啊|呀)(?=[\s,.!?;:，。！？；：、…~～]|$))'
+)
+PUNCTUATION_PATTERN = re.compile(r'[\s,.!?;:，。！？；：、…~～“”"\'‘’（）()【】\[\]]+')
+
+
+def get_source_titles(character: Dict) -> List[str]:
+    """从角色来源字段中提取作品名，如 "《西游记》" -> ["西游记"]"""
+    return re.findall(r'《(.+?)》', character.get('source', ''))
+
+
+def build_local_query(user_message: str, character: Dict) -> str:
+    """基于作品名、角色名（问题中的"你"指角色本人）和问题关键内容拼出搜索词"""
+    core = FILLER_PATTERN.sub(lambda m: m.group(1) or ' ', user_message)
+    core = ' '.join(PUNCTUATION_PATTERN.sub(' ', core).split())
+    prefix = []
+    titles = get_source_titles(character)
+    if titles and titles[0] not in core:
+        prefix.append(titles[0])
+    name = character.get('name', '')
+    if name and '你' in user_message and name not in core:
+        prefix.append(name)
+    return ' '.join(prefix + [core]).strip()
+
+
+def classify_search_need(user_message: str, character: Dict) -> Optional[Dict]:
+    """
+    本地判断是否需要搜索
+
+    参数:
+        user_message: 用户的问题
+        character: 角色信息字典
+
+    返回:
+        明确时返回 {"need_search": bool, "search_query": str, "reason": str}，
+        模棱两可时返回None（交给GPT判断）
+    """
+    text = user_message.strip().lower()
+    compact = PUNCTUATION_PATTERN.sub('', text)
+
+    has_fact = any(re.search(p, compact) for p in FACT_PATTERNS)
+    mentions_work = any(title.lower() in compact for title in get_source_titles(character))
+
+    if not compact:
+        return {"need_search": False, "search_query": "", "reason": "空消息"}
+
+    if not has_fact:
+        if INTERJECTION_PATTERN.fullmatch(compact):
+            return {"need_search": False, "search_query": "", "reason": "日常闲聊/问候"}
+        if len(compact) <= 20 and any(re.search(p, compact) for p in SMALL_TALK_PATTERNS):
+            return {"need_search": False, "search_query": "", "reason": "日常闲聊/问候"}
+        if any(re.search(p, compact) for p in OPINION_PATTERNS) and not mentions_work:
+            return {"need_search": False, "search_query": "", "reason": "观点或假设类问题"}
+        return None
+
+    if any(re.search(p, compact) for p in PERSONAL_PATTERNS):
+        return None
+
+    # 询问具体事实且足够具体
+    if len(compact) >= 6:
+        query = build_local_query(user_message, character)
+        if query:
+            return {"need_search": True, "search_query": query, "reason": "询问原著细节或具体事实"}
+
+    return None
@@ -0,0 +1,105 @@
+"""
+DuckDuckGo搜索区域策略的统计与自适应排序
+记录每个策略的成功率和耗时，按"预期拿到结果的耗时"从小到大排序，历史表现最好的区域优先发起：
+预期耗时 = 平均耗时 + 失败率 × 失败后改用其他策略的耗时，快速失败的策略不会因为"失败得快"排到前面
+"""
+import os
+import threading
+from typing import Dict, List
+
+
+# 搜索区域策略（默认顺序即冷启动时的顺序）
+SEARCH_STRATEGIES = [
+    {'name': 'default', 'region': None, 'safesearch': 'moderate'},  # 先不指定region
+    {'name': 'wt-wt', 'region': 'wt-wt', 'safesearch': 'moderate'},  # 全球
+    {'name': 'cn-zh', 'region': 'cn-zh', 'safesearch': 'off'},  # 中国区，关闭安全搜索
+]
+
+LATENCY_SMOOTHING = 0.3  # 耗时的指数移动平均系数
+DEFAULT_LATENCY = 2.0  # 没有历史数据时假设的耗时（秒）
+FAILURE_PENALTY = 2 * DEFAULT_LATENCY  # 策略失败后改用其他策略的最低估计耗时（秒）
+STRATEGY_MODES = ("sequential", "concurrent", "hedged")
+DEFAULT_STRATEGY_MODE = "sequential"
+
+
+def get_strategy_mode() -> str:
+    """
+    搜索区域策略的执行方式，环境变量 MCP_STRATEGY_MODE（默认sequential，
+    可选concurrent / hedged，会同时发起多个搜索请求）
+    """
+    mode = os.getenv('MCP_STRATEGY_MODE', DEFAULT_STRATEGY_MODE)
+    return mode if mode in STRATEGY_MODES else DEFAULT_STRATEGY_MODE
+
+
+class StrategyStats:
+    """各搜索策略的成功率与耗时统计（线程安全）"""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, success: bool, latency: float, error: bool = False):
+        """
+        记录一次策略执行结果（被取消的策略在后台完成后也会记录）
+
+        参数:
+            name: 策略名称
+            success: 是否返回了非空结果
+            latency: 耗时（秒）
+            error: 是否抛出异常
+        """
+        with self._lock:
+            stats = self._stats.setdefault(name, {
+                "attempts": 0, "successes": 0, "empty": 0, "errors": 0,
+                "avg_latency": latency
+            })
+            stats["attempts"] += 1
+            if success:
+                stats["successes"] += 1
+            elif error:
+                stats["errors"] += 1
+            else:
+                stats["empty"] += 1
+            stats["avg_latency"] += LATENCY_SMOOTHING * (latency - stats["avg_latency"])
+
+    def expected_cost(self, name: str, fallback_latency: float = FAILURE_PENALTY) -> float:
+        """
+        预期拿到结果的耗时：平均耗时 + 失败率 × 失败后改用其他策略的耗时（成功率做拉普拉斯平滑）
+
+        参数:
+            name: 策略名称
+            fallback_latency: 本策略失败（或返回空结果）后改用其他策略的耗时
+        """
+        stats = self._stats.get(name)
+        if stats is None:
+            return DEFAULT_LATENCY + 0.5 * fallback_latency
+        success_rate = (stats["successes"] + 1) / (stats["attempts"] + 2)
+        return stats["avg_latency"] + (1 - success_rate) * fallback_latency
+
+    def ordered(self, strategies: List[Dict]) -> List[Dict]:
+        """按历史表现排序策略，表现相同时保持原顺序"""
+        with self._lock:
+            # 失败后的代价按已知最慢的策略估算（至少FAILURE_PENALTY）
+            fallback = max([FAILURE_PENALTY] + [stats["avg_latency"] for stats in self._stats.values()])
+            return sorted(strategies, key=lambda s: self.expected_cost(s['name'], fallback))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """返回各策略统计的副本"""
+        with self._lock:
+            return {
+                name: dict(stats, success_rate=stats["successes"] / stats["attempts"])
+                for name, stats in self._stats.items()
+            }
+
+
+_shared_stats = None
+_shared_stats_lock = threading.Lock()
+
+
+def get_shared_strategy_stats() -> StrategyStats:
+    """获取进程级共享的策略统计（所有搜索引擎实例共用）"""
+    global _shared_stats
+    with _shared_stats_lock:
+        if _shared_stats is None:
+            _shared_stats = StrategyStats()
+        return _shared_stats
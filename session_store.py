@@ -0,0 +1,197 @@
+"""
+会话内的对话记录存储
+- MessageLog：消息的角色编码存在array中，正文单独存放，不为每条消息保留一个dict；
+  按下标、切片或迭代读取时返回普通的 {"role", "content"} 字典，调用方无需改动
+- SearchRecord：搜索历史只保存界面展示所需的精简字段，完整搜索结果（含网页全文）按搜索词引用进程级共享缓存，
+  不在每个会话中复制一份
+- SessionStore：每个会话的消息和搜索历史，带条数上限，并报告占用的内存
+"""
+import os
+import sys
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from search_cache import SearchCache, get_shared_cache
+
+
+ROLES = ("user", "assistant", "system")
+_ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+DEFAULT_MAX_MESSAGES = 200  # 每个会话保留的消息条数上限
+DEFAULT_MAX_SEARCHES = 20  # 每个会话保留的搜索历史条数上限
+RECORD_SOURCES = 3  # 每条搜索历史保留的来源数（界面只展示前3个）
+
+
+def get_max_messages() -> int:
+    """每个会话保留的消息条数上限，环境变量 SESSION_MAX_MESSAGES"""
+    return int(os.getenv('SESSION_MAX_MESSAGES', DEFAULT_MAX_MESSAGES))
+
+
+def get_max_searches() -> int:
+    """每个会话保留的搜索历史条数上限，环境变量 SESSION_MAX_SEARCHES"""
+    return int(os.getenv('SESSION_MAX_SEARCHES', DEFAULT_MAX_SEARCHES))
+
+
+class MessageLog(Sequence):
+    """按时间顺序的消息列表（角色编码存在array('B')中，正文为字符串列表）"""
+
+    def __init__(self, messages: Iterable[Dict] = ()):
+        self._roles = array('B')
+        self._contents: List[str] = []
+        for message in messages:
+            self.append(message["role"], message["content"])
+
+    def append(self, role: str, content: str):
+        self._roles.append(_ROLE_CODES[role])
+        self._contents.append(content)
+
+    def drop_oldest(self, count: int):
+        """丢弃最早的count条消息"""
+        del self._roles[:count]
+        del self._contents[:count]
+
+    def clear(self):
+        self.drop_oldest(len(self))
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [{"role": ROLES[role], "content": content}
+                    for role, content in zip(self._roles[index], self._contents[index])]
+        return {"role": ROLES[self._roles[index]], "content": self._contents[index]}
+
+    def __iter__(self):
+        for role, content in zip(self._roles, self._contents):
+            yield {"role": ROLES[role], "content": content}
+
+    def count_role(self, role: str) -> int:
+        return self._roles.count(_ROLE_CODES[role])
+
+    def to_list(self) -> List[Dict]:
+        """转换为字典列表（用于保存为JSON）"""
+        return self[:]
+
+    def nbytes(self) -> int:
+        """占用的内存（字节）：角色数组、正文列表和各条正文"""
+        return (sys.getsizeof(self._roles) + sys.getsizeof(self._contents) +
+                sum(sys.getsizeof(content) for content in self._contents))
+
+
+class SearchRecord:
+    """一条搜索历史；完整搜索结果不在这里保存，需要时按搜索词从共享缓存读取"""
+    __slots__ = ("query", "user_question", "summary", "source", "sources")
+
+    def __init__(self, query: str, user_question: str, summary: str, source: str, results: List[Dict]):
+        """
+        参数:
+            query: 搜索词（也是共享缓存中的键）
+            user_question: 触发搜索的用户问题
+            summary: 搜索总结
+            source: 结果来源 "knowledge" / "cache" / "web"
+            results: 本次的搜索结果，只保留前RECORD_SOURCES个的 (标题, URL)
+        """
+        self.query = query
+        self.user_question = user_question
+        self.summary = summary
+        self.source = source
+        self.sources: Tuple[Tuple[str, str], ...] = tuple(
+            (result['title'], result['url']) for result in results[:RECORD_SOURCES]
+        )
+
+    def results(self, cache: Optional[SearchCache] = None) -> List[Dict]:
+        """
+        完整搜索结果
+
+        返回:
+            共享缓存中仍保留时返回缓存的结果列表（与缓存共用同一份对象），
+            已被淘汰或来自本地知识库时只返回精简的 [{"title", "url"}]
+        """
+        cache = cache if cache is not None else get_shared_cache()
+        cached = cache.peek(self.query)
+        if cached is not None:
+            return cached['results']
+        return [{"title": title, "url": url} for title, url in self.sources]
+
+    def nbytes(self) -> int:
+        return (sys.getsizeof(self) + sys.getsizeof(self.query) + sys.getsizeof(self.user_question) +
+                sys.getsizeof(self.summary) + sys.getsizeof(self.sources) +
+                sum(sys.getsizeof(title) + sys.getsizeof(url) for title, url in self.sources))
+
+
+class SessionStore:
+    """
+    单个会话的对话记录：消息和搜索历史都有条数上限
+    超出消息上限时优先丢弃已压缩进记忆摘要的最早消息，发送给模型的上下文（摘要 + 未压缩的原文）不受影响；
+    消息上限是硬上限，记忆摘要跟不上（或没有记忆）时也会丢弃最早的整轮对话
+    """
+
+    def __init__(self, max_messages: Optional[int] = None, max_searches: Optional[int] = None):
+        """
+        参数:
+            max_messages: 消息条数上限（默认读取环境变量 SESSION_MAX_MESSAGES）
+            max_searches: 搜索历史条数上限（默认读取环境变量 SESSION_MAX_SEARCHES）
+        """
+        self.max_messages = max_messages if max_messages is not None else get_max_messages()
+        self.max_searches = max_searches if max_searches is not None else get_max_searches()
+        self.messages = MessageLog()
+        self.search_history = deque(maxlen=self.max_searches)
+        self.archived_messages = 0  # 超出上限后丢弃的消息条数
+        self.total_searches = 0
+
+    def add_turn(self, user_message: str, response: str, memory=None):
+        """
+        记录一轮对话，超出消息上限时丢弃最早的消息：先丢弃已压缩进记忆摘要的部分，
+        仍超出时按整轮丢弃尚未压缩的消息，并相应下调记忆的已压缩条数
+
+        参数:
+            user_message: 用户消息
+            response: 角色回复
+            memory: 会话的ConversationMemory（为None时直接按整轮丢弃最早的消息）
+        """
+        self.messages.append("user", user_message)
+        self.messages.append("assistant", response)
+        overflow = len(self.messages) - self.max_messages
+        if overflow <= 0:
+            return
+        dropped = memory.release_summarized(overflow) if memory is not None else 0
+        # 硬上限：记忆摘要跟不上时仍丢弃最早的整轮对话，未压缩的内容随之丢失
+        forced = overflow - dropped
+        forced += forced % 2
+        if forced > 0 and memory is not None:
+            memory.forget_oldest(forced)
+        dropped += forced
+        self.messages.drop_oldest(dropped)
+        self.archived_messages += dropped
+
+    def add_search(self, query: str, user_question: str, summary: str, source: str, results: List[Dict]):
+        """记录一次搜索，超出上限时淘汰最早的记录"""
+        self.search_history.append(SearchRecord(query, user_question, summary, source, results))
+        self.total_searches += 1
+
+    def clear_messages(self):
+        """清空对话（切换角色、清空对话时调用），搜索历史保留"""
+        self.messages.clear()
+        self.archived_messages = 0
+
+    def memory_report(self) -> Dict:
+        """
+        返回:
+            {"messages", "archived_messages", "message_bytes", "searches", "search_bytes",
+             "total_bytes", "max_messages", "max_searches"}
+        """
+        message_bytes = self.messages.nbytes()
+        search_bytes = sys.getsizeof(self.search_history) + sum(r.nbytes() for r in self.search_history)
+        return {
+            "messages": len(self.messages),
+            "archived_messages": self.archived_messages,
+            "message_bytes": message_bytes,
+            "searches": len(self.search_history),
+            "search_bytes": search_bytes,
+            "total_bytes": message_bytes + search_bytes,
+            "max_messages": self.max_messages,
+            "max_searches": self.max_searches
+        }
@@ -0,0 +1,279 @@
+"""
+对话管线的分阶段耗时统计
+- TurnTrace：一轮对话的时间线，span() 记录各阶段（搜索决策、搜索、网页抓取、提炼、总结、主回复等）的
+  起止时间和属性（缓存命中、抓取字节数、token数等）；当前轮次通过contextvars传递，未开启时span几乎没有开销
+- StageLatency：按阶段汇总多轮的耗时，计算p50/p95
+- MetricsSink：进程级指标输出，每轮追加一行JSONL，并可写出Prometheus文本格式
+"""
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, List, Optional
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("mcp_turn_trace", default=None)
+
+DEFAULT_LATENCY_WINDOW = 1000  # 每个阶段保留最近多少次耗时用于计算分位数
+
+
+class TurnTrace:
+    """一轮对话的时间线（线程安全，抓取线程池中的span也写入同一条时间线）"""
+
+    def __init__(self, name: str = "turn"):
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attrs: Dict = {}
+        self._spans: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, start: float, end: float, **attrs):
+        """
+        记录一个阶段
+
+        参数:
+            stage: 阶段名称，如 "decision" / "search" / "fetch" / "map" / "summary" / "completion"
+            start: 开始时间（time.perf_counter()）
+            end: 结束时间（time.perf_counter()）
+            attrs: 附加属性，如 hit / bytes / tokens / url
+        """
+        span = {"stage": stage, "start": start - self.start, "duration": end - start}
+        span.update(attrs)
+        with self._lock:
+            self._spans.append(span)
+
+    def finish(self, **attrs):
+        """结束本轮计时（重复调用只保留第一次的结束时间）"""
+        self.attrs.update(attrs)
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def timeline(self) -> List[Dict]:
+        """按开始时间排序的各阶段（start为相对本轮开始的秒数）"""
+        with self._lock:
+            return sorted((dict(span) for span in self._spans), key=lambda span: span["start"])
+
+    def stage_totals(self) -> Dict[str, Dict]:
+        """各阶段的次数和累计耗时（并发的阶段耗时会重叠，总和可能超过整轮耗时）"""
+        totals: Dict[str, Dict] = {}
+        for span in self.timeline():
+            stats = totals.setdefault(span["stage"], {"count": 0, "duration": 0.0})
+            stats["count"] += 1
+            stats["duration"] += span["duration"]
+        return totals
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "attrs": dict(self.attrs),
+            "spans": self.timeline()
+        }
+
+
+def current_trace() -> Optional[TurnTrace]:
+    return _current_trace.get()
+
+
+def activate(trace: Optional[TurnTrace]) -> contextvars.Token:
+    """把trace设为当前轮次，返回用于deactivate的token"""
+    return _current_trace.set(trace)
+
+
+def deactivate(token: contextvars.Token):
+    _current_trace.reset(token)
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """
+    记录一个阶段的耗时；with块内可以往yield出的字典中补充属性（如命中情况、字节数）
+
+    用法:
+        with span("fetch", url=url) as attrs:
+            ...
+            attrs["bytes"] = n
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        trace.add_span(stage, start, time.perf_counter(), **attrs)
+
+
+def in_current_context(fn: Callable) -> Callable:
+    """让提交到线程池的函数沿用当前轮次（线程池不会自动继承contextvars）"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """最近秩法分位数，q取0~1"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(len(ordered) * q) - 1))]
+
+
+class StageLatency:
+    """按阶段汇总多轮的耗时（每个阶段保留最近window次），计算p50/p95"""
+
+    def __init__(self, window: int = DEFAULT_LATENCY_WINDOW):
+        self.window = window
+        self._durations: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._sums: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, duration: float):
+        with self._lock:
+            self._durations.setdefault(stage, deque(maxlen=self.window)).append(duration)
+            self._counts[stage] = self._counts.get(stage, 0) + 1
+            self._sums[stage] = self._sums.get(stage, 0.0) + duration
+
+    def add_trace(self, trace: TurnTrace):
+        """把一轮的各阶段和整轮耗时（阶段名 "turn"）计入统计"""
+        for span in trace.timeline():
+            self.add(span["stage"], span["duration"])
+        self.add("turn", trace.duration)
+
+    def summary(self) -> Dict[str, Dict]:
+        """
+        返回:
+            {阶段: {"count": 累计次数, "sum": 累计耗时, "p50", "p95", "max"}}，分位数按最近window次计算
+        """
+        with self._lock:
+            snapshot = {stage: list(durations) for stage, durations in self._durations.items()}
+            counts, sums = dict(self._counts), dict(self._sums)
+        return {
+            stage: {
+                "count": counts[stage],
+                "sum": sums[stage],
+                "p50": percentile(durations, 0.5),
+                "p95": percentile(durations, 0.95),
+                "max": max(durations)
+            }
+            for stage, durations in snapshot.items()
+        }
+
+
+class MetricsSink:
+    """进程级指标输出：每轮追加一行JSONL，并按需重写Prometheus文本格式文件"""
+
+    def __init__(self,
+                 jsonl_path: Optional[str] = None,
+                 prometheus_path: Optional[str] = None,
+                 window: int = DEFAULT_LATENCY_WINDOW):
+        """
+        参数:
+            jsonl_path: 每轮时间线追加写入的JSONL文件（None表示不写）
+            prometheus_path: Prometheus文本格式文件（textfile collector，None表示不写）
+            window: 每个阶段保留最近多少次耗时用于计算分位数
+        """
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.latency = StageLatency(window)
+        self._cache_events: Dict[tuple, int] = {}
+        self._fetch_bytes = 0
+        self._turns = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        for path in (jsonl_path, prometheus_path):
+            if path and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def record_turn(self, trace: TurnTrace):
+        """记录一轮：更新分阶段统计和缓存命中计数，写出JSONL和Prometheus文件"""
+        trace.finish()
+        self.latency.add_trace(trace)
+        spans = trace.timeline()
+        with self._lock:
+            self._turns += 1
+            for span in spans:
+                if "hit" in span:
+                    key = (span["stage"], "hit" if span["hit"] else "miss")
+                    self._cache_events[key] = self._cache_events.get(key, 0) + 1
+                self._fetch_bytes += span.get("bytes", 0) if span["stage"] == "fetch" else 0
+
+        try:
+            if self.jsonl_path:
+                line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+                with self._write_lock, open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                    f.write(line + "\n")
+            if self.prometheus_path:
+                self.write_prometheus(self.prometheus_path)
+        except OSError as e:
+            print(f"⚠️ 指标写出失败: {e}")
+
+    def prometheus_text(self) -> str:
+        """Prometheus文本格式（各阶段耗时summary、缓存命中计数、抓取字节数）"""
+        lines = [
+            "# HELP mcp_stage_duration_seconds MCP pipeline stage latency",
+            "# TYPE mcp_stage_duration_seconds summary",
+        ]
+        for stage, stats in sorted(self.latency.summary().items()):
+            lines.append(f'mcp_stage_duration_seconds{{stage="{stage}",quantile="0.5"}} {stats["p50"]:.6f}')
+            lines.append(f'mcp_stage_duration_seconds{{stage="{stage}",quantile="0.95"}} {stats["p95"]:.6f}')
+            lines.append(f'mcp_stage_duration_seconds_sum{{stage="{stage}"}} {stats["sum"]:.6f}')
+            lines.append(f'mcp_stage_duration_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        with self._lock:
+            cache_events = dict(self._cache_events)
+            fetch_bytes, turns = self._fetch_bytes, self._turns
+        lines.append("# HELP mcp_cache_lookups_total Cache lookups by stage and result")
+        lines.append("# TYPE mcp_cache_lookups_total counter")
+        for (stage, result), count in sorted(cache_events.items()):
+            lines.append(f'mcp_cache_lookups_total{{stage="{stage}",result="{result}"}} {count}')
+        lines.append("# HELP mcp_fetch_bytes_total Bytes downloaded by page fetches")
+        lines.append("# TYPE mcp_fetch_bytes_total counter")
+        lines.append(f"mcp_fetch_bytes_total {fetch_bytes}")
+        lines.append("# HELP mcp_turns_total Chat turns recorded")
+        lines.append("# TYPE mcp_turns_total counter")
+        lines.append(f"mcp_turns_total {turns}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """先写临时文件再替换，采集端不会读到写了一半的文件"""
+        text = self.prometheus_text()
+        tmp_path = f"{path}.tmp"
+        with self._write_lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+
+
+_shared_metrics = None
+_shared_metrics_lock = threading.Lock()
+
+
+def get_shared_metrics() -> MetricsSink:
+    """
+    获取进程级共享的指标输出（所有会话共用）
+    可通过环境变量配置：
+        MCP_METRICS_JSONL  每轮时间线追加写入的JSONL文件（默认不写）
+        MCP_METRICS_PROM   Prometheus文本格式文件（默认不写）
+    """
+    global _shared_metrics
+    with _shared_metrics_lock:
+        if _shared_metrics is None:
+            _shared_metrics = MetricsSink(
+                jsonl_path=os.getenv('MCP_METRICS_JSONL') or None,
+                prometheus_path=os.getenv('MCP_METRICS_PROM') or None
+            )
+        return _shared_metrics
@@ -0,0 +1,47 @@
+from chunk_select import format_chunks, select_chunks, split_chunks, tokenize
+
+
+def result(title, content):
+    return {"title": title, "url": f"http://example.com/{title}", "snippet": "", "full_content": content}
+
+
+def test_tokenize_uses_cjk_bigrams_and_ascii_words():
+    assert tokenize("齐天大圣 MCP") == ["齐天", "天大", "大圣", "mcp"]
+
+
+def test_short_paragraphs_merge_and_long_ones_split_on_sentences():
+    text = "短段一\n短段二\n" + "很长的句子。" * 30
+    chunks = split_chunks(text, chunk_chars=50)
+    assert chunks[0].startswith("短段一\n短段二\n")
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+
+
+def test_relevant_chunks_are_selected_in_source_order():
+    filler = "这里讲的是唐僧师徒一路上的风景和路途。" * 20
+    results = [
+        result("无关", filler),
+        result("相关", f"{filler}\n孙悟空被玉帝封为齐天大圣，掌管蟠桃园。"),
+    ]
+    chunks = select_chunks("齐天大圣", results, question="孙悟空的称号", token_budget=200)
+    assert chunks and all(chunk["score"] > 0 for chunk in chunks)
+    assert any("齐天大圣" in chunk["text"] for chunk in chunks)
+    assert sum(chunk["tokens"] for chunk in chunks) <= 200
+    assert [c["source"] for c in chunks] == sorted(c["source"] for c in chunks)
+
+
+def test_falls_back_to_leading_chunks_when_nothing_matches():
+    results = [result("甲", "第一段。\n" * 3), result("乙", "第二段。\n" * 3)]
+    chunks = select_chunks("unrelated", results, token_budget=1000)
+    assert {chunk["source"] for chunk in chunks} == {0, 1}
+    assert all(chunk["score"] == 0 for chunk in chunks)
+
+
+def test_format_groups_chunks_by_source():
+    chunks = [{"source": 0, "title": "甲", "url": "u0", "text": "一"},
+              {"source": 0, "title": "甲", "url": "u0", "text": "二"},
+              {"source": 2, "title": "丙", "url": "u2", "text": "三"}]
+    text = format_chunks(chunks)
+    assert text.count("【来源") == 2
+    assert "【来源 2】丙" in text and "一\n二" in text
@@ -0,0 +1,62 @@
+from context_budget import SAFETY_MARGIN_TOKENS, fit_messages, get_context_limit
+from token_counter import count_message_tokens
+
+MODEL = "gpt-4"  # 8192上下文，便于构造超窗口的情况
+
+
+def make_history(turns, words=20):
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"第{i}个问题 " + "西游 " * words})
+        history.append({"role": "assistant", "content": f"第{i}个回答 " + "取经 " * words})
+    return history
+
+
+def test_short_history_is_kept_in_order():
+    history = make_history(2)
+    messages, stats = fit_messages("你是孙悟空", history, "你好", MODEL, budget=5000)
+    assert messages[0] == {"role": "system", "content": "你是孙悟空"}
+    assert messages[1:-1] == history
+    assert messages[-1] == {"role": "user", "content": "你好"}
+    assert stats["dropped_messages"] == 0 and not stats["truncated"]
+    assert stats["prompt_tokens"] == count_message_tokens(messages, MODEL)
+
+
+def test_old_turns_are_dropped_to_fit_budget_but_recent_turns_kept():
+    history = make_history(20)
+    messages, stats = fit_messages("你是孙悟空", history, "你好", MODEL, budget=600, keep_last_turns=2)
+    kept = messages[1:-1]
+    assert stats["dropped_messages"] > 0
+    assert kept == history[stats["dropped_messages"]:]
+    assert kept[0]["role"] == "user"
+    assert len(kept) >= 4
+    assert stats["prompt_tokens"] <= 600
+
+
+def test_recent_turns_are_trimmed_when_over_context_window():
+    history = make_history(8, words=400)
+    max_tokens = 2000
+    messages, stats = fit_messages("你是孙悟空", history, "你好", MODEL, max_tokens=max_tokens,
+                                   keep_last_turns=8)
+    assert stats["dropped_messages"] > 0
+    assert messages[1]["role"] == "user"
+    assert stats["prompt_tokens"] <= get_context_limit(MODEL) - max_tokens - SAFETY_MARGIN_TOKENS
+
+
+def test_volatile_context_goes_last_and_is_truncated_first():
+    context = "资料 " * 20000
+    messages, stats = fit_messages("你是孙悟空", make_history(1), "你好", MODEL,
+                                   volatile_context=context, memory_summary="之前聊过花果山")
+    assert messages[1]["content"].startswith("【此前对话摘要】")
+    assert messages[-2]["role"] == "system" and context.startswith(messages[-2]["content"])
+    assert len(messages[-2]["content"]) < len(context)
+    assert messages[-1] == {"role": "user", "content": "你好"}
+    assert stats["truncated"]
+    assert stats["prompt_tokens"] <= get_context_limit(MODEL) - 2000 - SAFETY_MARGIN_TOKENS
+
+
+def test_prefix_is_stable_across_turns():
+    history = make_history(3)
+    first, _ = fit_messages("你是孙悟空", history, "问题A", MODEL, volatile_context="资料A")
+    second, _ = fit_messages("你是孙悟空", history, "问题B", MODEL, volatile_context="资料B")
+    assert first[:-2] == second[:-2]
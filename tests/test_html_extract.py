@@ -0,0 +1,73 @@
+from html_extract import PageTextReader, declared_encoding, dedupe_paragraphs
+
+ARTICLE = ("<article><h1>齐天大圣的由来</h1>"
+           "<p>孙悟空在花果山自封齐天大圣，后来玉帝为了安抚他，正式封他为齐天大圣，管理蟠桃园。</p>"
+           "<p>这一称号体现了他不服天庭管束的性格，也是西游记中最有名的称号之一。</p></article>")
+
+
+def page(body, head=""):
+    return f"<html><head>{head}<title>孙悟空</title></head><body>{body}</body></html>"
+
+
+def read(data, content_type="text/html", chunk_size=7, **kwargs):
+    reader = PageTextReader(content_type, **kwargs)
+    for i in range(0, len(data), chunk_size):
+        if reader.feed(data[i:i + chunk_size]):
+            break
+    return reader.finish()
+
+
+def test_declared_charset_is_decoded_incrementally():
+    html = page(ARTICLE, head='<meta charset="gbk">')
+    text = read(html.encode("gbk"))
+    assert "孙悟空在花果山自封齐天大圣" in text
+
+
+def test_undeclared_charset_is_detected():
+    text = read(page(ARTICLE).encode("utf-8"))
+    assert "管理蟠桃园" in text
+
+
+def test_charset_header_wins_and_gbk_maps_to_gb18030():
+    assert declared_encoding("text/html; charset=GBK", b'<meta charset="utf-8">') == "gb18030"
+    assert declared_encoding("text/html", b'<meta charset="utf-8">') == "utf-8"
+    assert declared_encoding("text/html", b"<p>") is None
+
+
+def test_non_text_responses_are_skipped():
+    reader = PageTextReader("image/png")
+    assert reader.feed(b"\x89PNG")
+    assert reader.finish() == ""
+
+
+def test_reading_stops_at_byte_cap():
+    reader = PageTextReader("text/html", max_bytes=100)
+    assert reader.feed(b"<p>" + b"a" * 200)
+    assert reader.bytes_read == 100
+
+
+def test_long_text_is_truncated():
+    text = read(page(ARTICLE).encode("utf-8"), max_length=20)
+    assert len(text) == 23 and text.endswith("...")
+
+
+def test_navigation_links_and_boilerplate_are_dropped():
+    body = ('<nav><a href="/">首页</a><a href="/x">导航</a></nav>'
+            '<div><a href="/1">相关链接一二三四五六</a> <a href="/2">相关链接七八九十</a></div>'
+            f'{ARTICLE}<footer>版权所有 备案号</footer><script>var x = 1;</script>')
+    text = read(page(body).encode("utf-8"))
+    assert "齐天大圣的由来" in text and "管理蟠桃园" in text
+    for noise in ("首页", "相关链接", "版权所有", "var x"):
+        assert noise not in text
+
+
+def test_repeated_paragraphs_are_kept_only_once():
+    first = "孙悟空是花果山的美猴王，拜师菩提祖师\n只在第一页"
+    mirror = "孙悟空是花果山的美猴王，拜师菩提祖师！\n只在第二页"
+    assert dedupe_paragraphs([first, mirror]) == [first, "只在第二页"]
+
+
+def test_incremental_dedupe_shares_seen_paragraphs():
+    seen = set()
+    dedupe_paragraphs(["孙悟空是花果山的美猴王，拜师菩提祖师"], seen=seen)
+    assert dedupe_paragraphs(["孙悟空是花果山的美猴王，拜师菩提祖师\n短句"], seen=seen) == ["短句"]
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import pytest
+
+from http_fetcher import (AsyncPooledFetcher, HostBusyError, PooledFetcher, close_shared_async_fetcher,
+                          get_shared_async_fetcher)
+
+
+def test_busy_host_fails_fast_instead_of_waiting_past_timeout():
+    fetcher = PooledFetcher(per_host_limit=1)
+    semaphore = fetcher._host_semaphore("http://busy.example/a")
+    semaphore.acquire()
+    try:
+        start = time.monotonic()
+        with pytest.raises(HostBusyError):
+            with fetcher.get("http://busy.example/b", timeout=0.2):
+                pass
+        assert time.monotonic() - start < 1.0
+    finally:
+        semaphore.release()
+
+
+def test_host_slot_is_released_when_request_fails():
+    fetcher = PooledFetcher(per_host_limit=1)
+    with pytest.raises(Exception):
+        with fetcher.get("http://127.0.0.1:9/unreachable", timeout=0.5):
+            pass
+    semaphore = fetcher._host_semaphore("http://127.0.0.1:9/unreachable")
+    assert semaphore.acquire(timeout=0)
+    semaphore.release()
+
+
+def test_hosts_are_limited_independently():
+    fetcher = PooledFetcher(per_host_limit=1)
+    busy = fetcher._host_semaphore("http://a.example/")
+    busy.acquire()
+    try:
+        other = fetcher._host_semaphore("http://b.example/")
+        assert other.acquire(timeout=0)
+        other.release()
+    finally:
+        busy.release()
+
+
+def test_async_busy_host_fails_fast():
+    async def run():
+        fetcher = AsyncPooledFetcher(per_host_limit=1)
+        semaphore = fetcher._host_semaphore("http://busy.example/a")
+        await semaphore.acquire()
+        try:
+            with pytest.raises(HostBusyError):
+                async with fetcher.stream("http://busy.example/b", timeout=0.1):
+                    pass
+        finally:
+            semaphore.release()
+            await fetcher.aclose()
+
+    asyncio.run(run())
+
+
+def test_async_fetcher_is_shared_within_one_event_loop():
+    async def run():
+        try:
+            return get_shared_async_fetcher() is get_shared_async_fetcher()
+        finally:
+            await close_shared_async_fetcher()
+
+    assert asyncio.run(run())
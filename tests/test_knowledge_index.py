@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from knowledge_index import MIN_COVERAGE, KnowledgeBase
+from mcp_search import MCPChatManager
+from pricing import UsageTracker
+from search_cache import SearchCache
+from telemetry import MetricsSink
+
+WUKONG = {"id": "wukong", "name": "孙悟空", "source": "《西游记》"}
+LORE = ("孙悟空在花果山自封齐天大圣。\n"
+        "玉帝为了安抚他，正式封他为齐天大圣，让他管理蟠桃园。\n"
+        "后来他偷吃蟠桃、大闹天宫，被如来佛祖压在五行山下。")
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    directory = tmp_path / "wukong"
+    directory.mkdir()
+    path = directory / "称号.txt"
+    path.write_text(LORE, encoding="utf-8")
+    return tmp_path, path
+
+
+def touch(path):
+    """只推后修改时间（同一秒内的写入在部分文件系统上mtime不变）"""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+class FakeEngine:
+    def __init__(self):
+        self.queries = []
+
+    def search_and_summarize(self, query, max_results=8, question="", usage=None):
+        self.queries.append(query)
+        return "网络总结", [{"title": "网页", "url": "http://example.com", "snippet": "", "full_content": ""}]
+
+
+def make_manager(knowledge_base):
+    engine = FakeEngine()
+    manager = MCPChatManager(None, search_engine=engine, search_cache=SearchCache(),
+                             knowledge_base=knowledge_base, metrics=MetricsSink())
+    return manager, engine
+
+
+def test_confident_hit_skips_web_search(corpus):
+    root, _ = corpus
+    knowledge_base = KnowledgeBase(root=str(root))
+    summary, results = knowledge_base.lookup(WUKONG, "孙悟空 齐天大圣 蟠桃园")
+    assert "管理蟠桃园" in summary
+    assert results[0]["url"] == "knowledge/wukong/称号.txt"
+    assert knowledge_base.stats()["hits"] == 1
+
+    manager, engine = make_manager(knowledge_base)
+    _, _, source = manager._search("孙悟空 齐天大圣 蟠桃园", "你为什么叫齐天大圣", WUKONG, UsageTracker())
+    assert source == "knowledge"
+    assert engine.queries == []
+
+
+def test_low_coverage_falls_through_to_web_search(corpus):
+    root, _ = corpus
+    knowledge_base = KnowledgeBase(root=str(root))
+    index = knowledge_base.get_index("wukong")
+    query = "齐天大圣 金箍棒 重量 来历"
+    hits, coverage = index.search(query, exclude_terms=["孙悟"])
+    assert hits and coverage < MIN_COVERAGE
+    assert knowledge_base.lookup(WUKONG, query) is None
+    assert knowledge_base.stats()["misses"] == 1
+
+    manager, engine = make_manager(knowledge_base)
+    summary, _, source = manager._search(query, "你的金箍棒有多重", WUKONG, UsageTracker())
+    assert (summary, source) == ("网络总结", "web")
+    assert engine.queries == [query]
+
+
+def test_index_is_rebuilt_when_a_file_changes(corpus):
+    root, path = corpus
+    knowledge_base = KnowledgeBase(root=str(root))
+    first = knowledge_base.get_index("wukong")
+    assert knowledge_base.get_index("wukong") is first
+    touch(path)
+    second = knowledge_base.get_index("wukong")
+    assert second is not first
+    assert knowledge_base.lookup(WUKONG, "紧箍咒 观音菩萨") is None
+
+    path.write_text(LORE + "\n观音菩萨给了唐僧紧箍咒，用来约束孙悟空。", encoding="utf-8")
+    touch(path)
+    assert knowledge_base.get_index("wukong") is not second
+    summary, _ = knowledge_base.lookup(WUKONG, "紧箍咒 观音菩萨")
+    assert "紧箍咒" in summary
+
+
+def test_missing_corpus_returns_none(tmp_path):
+    knowledge_base = KnowledgeBase(root=str(tmp_path))
+    assert knowledge_base.get_index("wukong") is None
+    assert knowledge_base.lookup(WUKONG, "齐天大圣") is None
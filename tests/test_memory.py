@@ -0,0 +1,72 @@
+from types import SimpleNamespace as NS
+
+from memory import ConversationMemory
+
+CHARACTER = {"name": "孙悟空", "source": "西游记"}
+
+
+class FakeClient:
+    def __init__(self, reply="用户喜欢花果山", fail=False):
+        self.reply = reply
+        self.fail = fail
+        self.prompts = []
+        self.chat = NS(completions=self)
+
+    def create(self, **kwargs):
+        self.prompts.append(kwargs["messages"][0]["content"])
+        if self.fail:
+            raise RuntimeError("boom")
+        usage = NS(prompt_tokens=200, completion_tokens=50, prompt_tokens_details=None)
+        return NS(choices=[NS(message=NS(content=f" {self.reply} "))], usage=usage)
+
+
+def dialogue(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"问题{i}"})
+        messages.append({"role": "assistant", "content": f"回答{i}"})
+    return messages
+
+
+def test_recent_turns_are_not_folded():
+    memory = ConversationMemory(keep_last_turns=2, min_fold_turns=2)
+    assert not memory.update_async(FakeClient(), dialogue(3), CHARACTER)
+    assert memory.recent_history(dialogue(3)) == ("", dialogue(3))
+
+
+def test_aged_out_turns_are_folded_in_the_background():
+    memory = ConversationMemory(keep_last_turns=2, min_fold_turns=2)
+    client = FakeClient()
+    messages = dialogue(5)
+    assert memory.update_async(client, messages, CHARACTER)
+    memory.wait(5)
+    assert memory.snapshot() == ("用户喜欢花果山", 6)
+    assert "问题2" in client.prompts[0] and "问题3" not in client.prompts[0]
+    assert memory.recent_history(messages) == ("用户喜欢花果山", messages[6:])
+    assert memory.pop_unbilled_usage().stages()["memory"]["calls"] == 1
+    assert memory.pop_unbilled_usage().total_cost == 0
+
+
+def test_failed_update_keeps_previous_state():
+    memory = ConversationMemory(keep_last_turns=1, min_fold_turns=1)
+    assert memory.update_async(FakeClient(fail=True), dialogue(3), CHARACTER)
+    memory.wait(5)
+    assert memory.snapshot() == ("", 0)
+
+
+def test_release_only_gives_back_whole_summarized_turns():
+    memory = ConversationMemory()
+    memory.summarized_count = 5
+    assert memory.release_summarized(4) == 4
+    assert memory.release_summarized(4) == 0
+    assert memory.summarized_count == 1
+    memory.forget_oldest(4)
+    assert memory.summarized_count == 0
+
+
+def test_round_trips_through_dict():
+    memory = ConversationMemory()
+    memory.summary, memory.summarized_count = "摘要", 4
+    restored = ConversationMemory.from_dict(memory.to_dict(), keep_last_turns=3)
+    assert restored.snapshot() == ("摘要", 4)
+    assert restored.keep_last_turns == 3
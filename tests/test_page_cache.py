@@ -0,0 +1,64 @@
+import pytest
+
+import page_cache
+from page_cache import PageCache
+
+URL = "http://example.com/wukong"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(page_cache.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return PageCache(db_path=str(tmp_path / "pages.sqlite3"), fresh_ttl=60)
+
+
+def test_fresh_hit_skips_the_request(cache):
+    cache.store(URL, "齐天大圣" * 10, max_length=100, etag='"v1"', download_bytes=5000)
+    entry = cache.lookup(URL, max_length=100)
+    assert entry["fresh"] and entry["text"] == "齐天大圣" * 10
+    assert cache.stats()["bytes_saved"] == 5000
+
+
+def test_shorter_request_truncates_and_longer_request_misses(cache):
+    cache.store(URL, "齐天大圣" * 10, max_length=40)
+    assert cache.lookup(URL, max_length=8)["text"] == "齐天大圣齐天大圣..."
+    assert cache.lookup(URL, max_length=3000) is None
+
+
+def test_stale_entry_is_revalidated_with_conditional_headers(cache, clock):
+    cache.store(URL, "正文", max_length=100, etag='"v1"', last_modified="Mon, 01 Jan 2024 00:00:00 GMT",
+                download_bytes=100)
+    clock[0] += 61
+    entry = cache.lookup(URL, max_length=100)
+    assert not entry["fresh"]
+    assert PageCache.conditional_headers(entry) == {
+        "If-None-Match": '"v1"', "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"}
+    cache.mark_revalidated(URL, entry)
+    assert cache.lookup(URL, max_length=100)["fresh"]
+    assert cache.stats()["revalidated"] == 1
+
+
+def test_stale_entry_without_validators_is_a_miss(cache, clock):
+    cache.store(URL, "正文", max_length=100)
+    clock[0] += 61
+    assert cache.lookup(URL, max_length=100) is None
+
+
+def test_least_recently_accessed_pages_are_evicted(tmp_path, clock):
+    cache = PageCache(db_path=str(tmp_path / "pages.sqlite3"), max_bytes=25)
+    cache.store("http://a", "a" * 10, max_length=100)
+    clock[0] += 1
+    cache.store("http://b", "b" * 10, max_length=100)
+    clock[0] += 1
+    cache.lookup("http://a", max_length=100)
+    clock[0] += 1
+    cache.store("http://c", "c" * 10, max_length=100)
+    assert cache.lookup("http://b", max_length=100) is None
+    assert cache.lookup("http://a", max_length=100) is not None
+    assert cache.stats()["evictions"] == 1 and cache.total_bytes == 20
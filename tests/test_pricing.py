@@ -0,0 +1,77 @@
+from types import SimpleNamespace as NS
+
+import pytest
+
+from pricing import MIN_REPLY_TOKENS, UsageTracker, apply_turn_budget, estimate_request, usage_cost
+
+MESSAGES = [{"role": "system", "content": "你是孙悟空"}, {"role": "user", "content": "说说花果山"}]
+
+
+def max_cost(model, max_tokens=2000):
+    return estimate_request(model, MESSAGES, max_tokens)["max_cost"]
+
+
+def test_cached_input_is_billed_at_the_cached_price():
+    assert usage_cost("gpt-4o", 1_000_000, 0) == pytest.approx(5.0)
+    assert usage_cost("gpt-4o", 1_000_000, 0, cached_tokens=1_000_000) == pytest.approx(2.5)
+    assert usage_cost("unknown-model", 0, 1_000_000) == pytest.approx(15.0)
+
+
+def test_no_budget_or_enough_budget_sends_unchanged():
+    assert apply_turn_budget("gpt-4o-ca", MESSAGES, 2000)["action"] == "send"
+    decision = apply_turn_budget("gpt-4o-ca", MESSAGES, 2000, spent=0.001, budget=max_cost("gpt-4o-ca") + 0.001)
+    assert decision["action"] == "send"
+    assert decision["model"] == "gpt-4o-ca" and decision["max_tokens"] == 2000
+
+
+def test_over_budget_downgrades_to_cheaper_model():
+    budget = (max_cost("gpt-4o-ca") + max_cost("gpt-4o-mini")) / 2
+    decision = apply_turn_budget("gpt-4o-ca", MESSAGES, 2000, budget=budget)
+    assert decision["action"] == "downgrade"
+    assert decision["model"] == "gpt-4o-mini"
+    assert decision["max_tokens"] == 2000
+    assert decision["estimate"]["max_cost"] <= budget
+
+
+def test_downgrade_shortens_reply_to_fit_remaining_budget():
+    budget = max_cost("gpt-4o-mini", 1000)
+    decision = apply_turn_budget("gpt-4o-ca", MESSAGES, 2000, budget=budget)
+    assert decision["action"] == "downgrade"
+    assert MIN_REPLY_TOKENS <= decision["max_tokens"] < 2000
+    assert decision["estimate"]["max_cost"] <= budget
+
+
+def test_blocks_when_even_a_short_cheap_reply_does_not_fit():
+    budget = max_cost("gpt-4o-mini", MIN_REPLY_TOKENS) / 2
+    assert apply_turn_budget("gpt-4o-ca", MESSAGES, 2000, budget=budget)["action"] == "block"
+
+
+def test_block_mode_and_models_without_downgrade_are_blocked():
+    budget = max_cost("gpt-4o-mini")
+    assert apply_turn_budget("gpt-4o-ca", MESSAGES, 2000, budget=budget, mode="block")["action"] == "block"
+    assert apply_turn_budget("gpt-4o-mini", MESSAGES, 2000, budget=budget / 2)["action"] == "block"
+
+
+def test_spent_counts_against_the_budget():
+    budget = max_cost("gpt-4o-ca") * 1.1
+    assert apply_turn_budget("gpt-4o-ca", MESSAGES, 2000, budget=budget)["action"] == "send"
+    decision = apply_turn_budget("gpt-4o-ca", MESSAGES, 2000, spent=budget / 2, budget=budget, mode="block")
+    assert decision["action"] == "block"
+    assert decision["spent"] == budget / 2
+
+
+def test_usage_tracker_sums_stages_and_merges():
+    tracker = UsageTracker()
+    tracker.record("decision", "gpt-4o-mini", 100, 20)
+    usage = NS(prompt_tokens=1000, completion_tokens=200, prompt_tokens_details=NS(cached_tokens=800))
+    tracker.record_usage("main", "gpt-4o-ca", usage)
+    assert tracker.record_usage("main", "gpt-4o-ca", None) == 0.0
+    assert tracker.total_tokens == 1320
+    assert tracker.stages()["main"]["cached_tokens"] == 800
+
+    other = UsageTracker()
+    other.record("main", "gpt-4o-ca", 10, 10)
+    expected = tracker.total_cost + other.total_cost
+    tracker.merge(other)
+    assert tracker.stages()["main"]["calls"] == 2
+    assert tracker.total_cost == pytest.approx(expected)
@@ -0,0 +1,91 @@
+import pytest
+
+import search_cache
+from search_cache import SearchCache, normalize_query
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(search_cache.time, "time", clock)
+    return clock
+
+
+def value(summary):
+    return {"summary": summary, "results": []}
+
+
+def test_normalize_query_ignores_width_case_and_word_order():
+    assert normalize_query("孙悟空 ＭＣＰ") == normalize_query("mcp  孙悟空")
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = SearchCache(ttl=60, similarity_threshold=None)
+    cache.set("孙悟空 称号", value("齐天大圣"))
+    clock.now += 59
+    assert cache.get("孙悟空 称号") == value("齐天大圣")
+    clock.now += 2
+    assert cache.get("孙悟空 称号") is None
+    assert "孙悟空 称号" not in cache
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = SearchCache(max_entries=2, similarity_threshold=None)
+    cache.set("唐僧", value("a"))
+    cache.set("八戒", value("b"))
+    cache.get("唐僧")
+    cache.set("沙僧", value("c"))
+    assert cache.peek("八戒") is None
+    assert cache.peek("唐僧") == value("a")
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_survive_a_restart(tmp_path, clock):
+    db_path = str(tmp_path / "cache.db")
+    SearchCache(db_path=db_path).set("孙悟空 称号", value("齐天大圣"))
+    restored = SearchCache(db_path=db_path)
+    assert restored.stats()["persistent"]
+    assert restored.get("孙悟空 称号") == value("齐天大圣")
+
+
+def test_reworded_query_reuses_cached_result(clock):
+    cache = SearchCache()
+    cache.set("孙悟空 称号由来", value("齐天大圣"))
+    key, cached, score = cache.lookup("孙悟空 称号 由来")
+    assert key == normalize_query("孙悟空 称号由来")
+    assert cached == value("齐天大圣")
+    assert 0.75 <= score < 1.0
+    assert cache.stats()["near_hits"] == 1
+
+
+def test_unrelated_query_is_a_miss(clock):
+    cache = SearchCache()
+    cache.set("孙悟空 称号由来", value("齐天大圣"))
+    assert cache.get("诸葛亮 出师表") is None
+    assert cache.get("孙悟空 称号 由来", similarity_threshold=1.0) is None
+
+
+def test_expired_entry_is_not_a_near_match(clock):
+    cache = SearchCache(ttl=60)
+    cache.set("孙悟空 称号由来", value("齐天大圣"))
+    clock.now += 61
+    assert cache.lookup("孙悟空 称号 由来") is None
+
+
+def test_evicted_entry_leaves_the_similarity_index(clock):
+    cache = SearchCache(max_entries=1)
+    cache.set("孙悟空 称号由来", value("齐天大圣"))
+    cache.set("诸葛亮 出师表", value("前出师表"))
+    assert cache.lookup("孙悟空 称号 由来") is None
+    assert cache._index and all(normalize_query("孙悟空 称号由来") not in keys
+                                for keys in cache._index.values())
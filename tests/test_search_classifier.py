@@ -0,0 +1,65 @@
+import pytest
+
+from characters import CHARACTERS
+from search_classifier import build_local_query, classify_search_need
+
+WUKONG = next(c for c in CHARACTERS.values() if c['name'] == '孙悟空')
+ZHUGE = next(c for c in CHARACTERS.values() if c['name'] == '诸葛亮')
+HARRY = next(c for c in CHARACTERS.values() if c['name'] == '哈利·波特')
+SHERLOCK = next(c for c in CHARACTERS.values() if c['name'] == '夏洛克·福尔摩斯')
+
+
+@pytest.mark.parametrize("message", ["你好！", "哈哈哈哈", "谢谢你！", "好的好的", "嗯", "晚安啦~", "好的，谢谢你啦"])
+def test_interjections_skip_search(message):
+    decision = classify_search_need(message, WUKONG)
+    assert decision is not None and decision["need_search"] is False
+
+
+@pytest.mark.parametrize("character, message", [
+    (WUKONG, "对于大闹天宫，天庭派了哪些神仙来抓你"),
+    (WUKONG, "可以讲讲你被压在五行山下的事吗"),
+    (ZHUGE, "对赤壁之战中借东风的细节还记得吗"),
+    (WUKONG, "好的，那你被压在五行山下多久"),
+    (WUKONG, "hello，你的金箍棒是从哪里得来的"),
+])
+def test_questions_starting_with_interjection_are_not_small_talk(character, message):
+    decision = classify_search_need(message, character)
+    assert decision is None or decision["need_search"] is True
+
+
+@pytest.mark.parametrize("character, message", [
+    (ZHUGE, "草船借箭"),
+    (ZHUGE, "空城计？"),
+    (HARRY, "魂器"),
+    (SHERLOCK, "莫里亚蒂"),
+])
+def test_short_lore_topics_are_left_to_gpt(character, message):
+    assert classify_search_need(message, character) is None
+
+
+def test_short_small_talk_still_skips_search():
+    decision = classify_search_need("开心", WUKONG)
+    assert decision is not None and decision["need_search"] is False
+
+
+def test_fact_question_searches_locally():
+    decision = classify_search_need("你在原著第几回大闹天宫的", WUKONG)
+    assert decision["need_search"] is True
+    assert decision["search_query"].startswith("西游记")
+
+
+def test_opinion_question_skips_search():
+    decision = classify_search_need("如果你是人类会怎样", WUKONG)
+    assert decision == {"need_search": False, "search_query": "", "reason": "观点或假设类问题"}
+
+
+def test_local_query_keeps_question_words():
+    query = build_local_query("你为什么叫齐天大圣", WUKONG)
+    assert query == "西游记 孙悟空 为什么叫齐天大圣"
+
+
+def test_local_query_strips_fillers_only_at_phrase_boundaries():
+    query = build_local_query("请问你到底是在哪一年学会七十二变的呢？", WUKONG)
+    assert "请问" not in query and "呢" not in query
+    assert "哪一年学会七十二变" in query
+    assert build_local_query("酒吧是什么", WUKONG).endswith("酒吧")
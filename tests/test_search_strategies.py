@@ -0,0 +1,43 @@
+from search_strategies import SEARCH_STRATEGIES, StrategyStats, get_strategy_mode
+
+
+def names(strategies):
+    return [s['name'] for s in strategies]
+
+
+def test_cold_start_keeps_default_order():
+    assert names(StrategyStats().ordered(SEARCH_STRATEGIES)) == ['default', 'wt-wt', 'cn-zh']
+
+
+def test_fast_failing_strategy_is_not_ranked_first():
+    stats = StrategyStats()
+    for _ in range(5):
+        stats.record('default', False, 0.05, error=True)
+        stats.record('wt-wt', True, 1.5)
+    assert names(stats.ordered(SEARCH_STRATEGIES))[0] == 'wt-wt'
+
+
+def test_empty_results_count_as_failures():
+    stats = StrategyStats()
+    for _ in range(5):
+        stats.record('default', False, 0.2)
+        stats.record('cn-zh', True, 0.8)
+    ordered = names(stats.ordered(SEARCH_STRATEGIES))
+    assert ordered.index('cn-zh') < ordered.index('default')
+
+
+def test_faster_of_two_reliable_strategies_wins():
+    stats = StrategyStats()
+    for _ in range(5):
+        stats.record('default', True, 2.0)
+        stats.record('cn-zh', True, 0.5)
+    assert names(stats.ordered(SEARCH_STRATEGIES))[0] == 'cn-zh'
+
+
+def test_strategy_mode_defaults_to_sequential(monkeypatch):
+    monkeypatch.delenv('MCP_STRATEGY_MODE', raising=False)
+    assert get_strategy_mode() == 'sequential'
+    monkeypatch.setenv('MCP_STRATEGY_MODE', 'hedged')
+    assert get_strategy_mode() == 'hedged'
+    monkeypatch.setenv('MCP_STRATEGY_MODE', 'bogus')
+    assert get_strategy_mode() == 'sequential'
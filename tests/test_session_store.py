@@ -0,0 +1,111 @@
+import threading
+from types import SimpleNamespace as NS
+
+from memory import ConversationMemory
+from search_cache import SearchCache
+from session_store import MessageLog, SessionStore
+
+
+def fill(store, turns, memory=None, start=0):
+    for i in range(start, start + turns):
+        store.add_turn(f"问题{i}", f"回答{i}", memory)
+
+
+def test_message_log_reads_back_plain_dicts():
+    log = MessageLog([{"role": "user", "content": "你好"}, {"role": "assistant", "content": "俺老孙来也"}])
+    assert log[0] == {"role": "user", "content": "你好"}
+    assert log[-1:] == [{"role": "assistant", "content": "俺老孙来也"}]
+    assert list(log) == log.to_list()
+    assert log.count_role("user") == 1
+
+
+def test_summarized_messages_are_dropped_first():
+    store = SessionStore(max_messages=6, max_searches=5)
+    memory = ConversationMemory()
+    fill(store, 3, memory)
+    memory.summarized_count = 4
+    store.add_turn("问题3", "回答3", memory)
+    assert len(store.messages) == 6
+    assert store.messages[0]["content"] == "问题1"
+    assert memory.summarized_count == 2
+    assert store.archived_messages == 2
+
+
+def test_hard_cap_holds_when_memory_lags():
+    store = SessionStore(max_messages=6, max_searches=5)
+    memory = ConversationMemory()
+    fill(store, 3, memory)
+    memory.summarized_count = 2
+    fill(store, 5, memory, start=3)
+    assert len(store.messages) == 6
+    assert store.messages[0] == {"role": "user", "content": "问题5"}
+    assert memory.summarized_count == 0
+    assert store.archived_messages == 10
+
+
+def test_hard_cap_without_memory_drops_whole_turns():
+    store = SessionStore(max_messages=5, max_searches=5)
+    fill(store, 4)
+    assert len(store.messages) <= 5
+    assert store.messages[0]["role"] == "user"
+
+
+def test_recent_history_stays_aligned_after_forced_drop():
+    store = SessionStore(max_messages=4, max_searches=5)
+    memory = ConversationMemory()
+    fill(store, 2, memory)
+    memory.summarized_count = 2
+    fill(store, 2, memory, start=2)
+    summary, history = memory.recent_history(store.messages)
+    assert history == store.messages[memory.summarized_count:]
+    assert history[-1]["content"] == "回答3"
+
+
+class BlockingClient:
+    """摘要请求在release之前一直阻塞，模拟进行中的后台更新"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.chat = NS(completions=self)
+
+    def create(self, **kwargs):
+        self.started.set()
+        self.release.wait(5)
+        usage = NS(prompt_tokens=100, completion_tokens=20, prompt_tokens_details=None)
+        return NS(choices=[NS(message=NS(content="摘要"))], usage=usage)
+
+
+def test_forced_drop_during_fold_keeps_unsummarized_messages():
+    store = SessionStore(max_messages=12, max_searches=5)
+    memory = ConversationMemory(keep_last_turns=1, min_fold_turns=1)
+    fill(store, 6, memory)
+    client = BlockingClient()
+    assert memory.update_async(client, store.messages.to_list(), {"name": "孙悟空"})  # 折叠前10条
+    assert client.started.wait(5)
+
+    fill(store, 2, memory, start=6)  # 记忆跟不上，强制丢弃最早的4条
+    client.release.set()
+    memory.wait(5)
+
+    assert len(store.messages) == 12
+    assert memory.summarized_count == 6
+    summary, history = memory.recent_history(store.messages)
+    assert summary == "摘要"
+    assert history[0] == {"role": "user", "content": "问题5"}
+
+
+def test_search_history_is_capped_and_references_shared_cache():
+    cache = SearchCache()
+    results = [{"title": f"标题{i}", "url": f"http://x/{i}", "snippet": "", "full_content": "正文"}
+               for i in range(5)]
+    cache.set("孙悟空 称号", {"summary": "总结", "results": results})
+    store = SessionStore(max_messages=10, max_searches=2)
+    for i in range(3):
+        store.add_search("孙悟空 称号", f"问题{i}", "总结", "web", results)
+    assert len(store.search_history) == 2
+    assert store.total_searches == 3
+    record = store.search_history[-1]
+    assert len(record.sources) == 3
+    assert record.results(cache) is results
+    assert record.results(SearchCache()) == [{"title": t, "url": u} for t, u in record.sources]
@@ -0,0 +1,111 @@
+import json
+from types import SimpleNamespace as NS
+
+import pytest
+
+from mcp_search import BLOCKED_REPLY, MCPChatManager, MCPSearchEngine
+from pricing import estimate_request
+from search_cache import SearchCache
+from telemetry import MetricsSink
+
+
+CHARACTER = {"name": "孙悟空", "source": "西游记"}
+QUESTION = "说说你对取经这件事的看法吧"  # 本地规则无法判断，交给GPT
+SYSTEM_PROMPT = "你是孙悟空"
+
+
+def usage(prompt_tokens, completion_tokens):
+    return NS(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+              total_tokens=prompt_tokens + completion_tokens, prompt_tokens_details=None)
+
+
+class FakeStream:
+    def __init__(self, text):
+        self.text = text
+
+    def __iter__(self):
+        yield NS(choices=[NS(delta=NS(content=self.text))], usage=None)
+        yield NS(choices=[], usage=usage(20, 5))
+
+    def close(self):
+        pass
+
+
+class FakeCompletions:
+    """判断无需搜索；decision_tokens控制GPT判断的花费"""
+
+    def __init__(self, decision_tokens=100):
+        self.decision_tokens = decision_tokens
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("stream"):
+            return FakeStream("推测回复")
+        if kwargs.get("response_format"):
+            content = json.dumps({"need_search": False, "search_query": "", "reason": "闲聊"})
+            return NS(choices=[NS(message=NS(content=content))], usage=usage(self.decision_tokens, 20))
+        return NS(choices=[NS(message=NS(content="正常回复"))], usage=usage(30, 10))
+
+
+@pytest.fixture
+def make_manager(monkeypatch):
+    monkeypatch.setenv("MCP_PAGE_CACHE_DB", "")
+    monkeypatch.setenv("MCP_KNOWLEDGE_DIR", "")
+
+    def make(turn_budget=None, budget_mode="downgrade", decision_tokens=100):
+        completions = FakeCompletions(decision_tokens)
+        client = NS(chat=NS(completions=completions))
+        manager = MCPChatManager(client, search_engine=MCPSearchEngine(client), search_cache=SearchCache(),
+                                 turn_budget=turn_budget, budget_mode=budget_mode, metrics=MetricsSink())
+        return manager, completions
+    return make
+
+
+def speculation_cost(model="gpt-4o-ca", max_tokens=2000):
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": QUESTION}]
+    return estimate_request(model, messages, max_tokens)["max_cost"]
+
+
+def chat(manager):
+    return manager.chat_with_mcp(QUESTION, CHARACTER, SYSTEM_PROMPT, [], speculative=True)
+
+
+def test_used_speculation_fills_context_and_budget(make_manager):
+    manager, completions = make_manager()
+    result = chat(manager)
+    assert result["speculation"]["used"]
+    assert result["response"] == "推测回复"
+    assert "context" in result
+    assert result["budget"]["action"] == "send"
+    assert result["budget"]["spent"] == pytest.approx(result["usage"].total_cost)
+    assert result["budget"]["spent"] > 0  # 计入了GPT判断的花费
+
+
+def test_speculation_is_downgraded_by_budget_mode(make_manager):
+    budget = (speculation_cost() + speculation_cost("gpt-4o-mini")) / 2
+    manager, completions = make_manager(turn_budget=budget)
+    result = chat(manager)
+    streamed = [c for c in completions.calls if c.get("stream")]
+    assert streamed[0]["model"] == "gpt-4o-mini"
+    assert result["speculation"]["used"]
+    assert result["model"] == "gpt-4o-mini"
+    assert result["budget"]["action"] == "downgrade"
+
+
+def test_speculation_is_skipped_when_it_would_be_blocked(make_manager):
+    manager, completions = make_manager(turn_budget=speculation_cost() / 2, budget_mode="block")
+    result = chat(manager)
+    assert not any(c.get("stream") for c in completions.calls)
+    assert "speculation" not in result
+    assert result["response"] == BLOCKED_REPLY
+
+
+def test_speculation_is_cancelled_when_decision_spend_exceeds_budget(make_manager):
+    # 推测请求本身在上限内，加上GPT判断（约$0.15）的花费后超出
+    manager, completions = make_manager(turn_budget=speculation_cost() * 1.5, budget_mode="block",
+                                        decision_tokens=1_000_000)
+    result = chat(manager)
+    assert result["speculation"]["used"] is False
+    assert result["budget"]["action"] == "block"
+    assert result["response"] == BLOCKED_REPLY
@@ -0,0 +1,84 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from telemetry import (MetricsSink, StageLatency, TurnTrace, activate, deactivate, in_current_context,
+                       percentile, span)
+
+
+def traced(fn):
+    trace = TurnTrace()
+    token = activate(trace)
+    try:
+        fn()
+    finally:
+        deactivate(token)
+    return trace
+
+
+def test_span_is_a_no_op_without_a_trace():
+    with span("fetch", url="u") as attrs:
+        attrs["bytes"] = 10
+    assert attrs == {"url": "u", "bytes": 10}
+
+
+def test_spans_record_attrs_and_errors():
+    def run():
+        with span("search", hit=False) as attrs:
+            attrs["results"] = 3
+        with pytest.raises(ValueError):
+            with span("fetch"):
+                raise ValueError("boom")
+
+    timeline = traced(run).timeline()
+    assert [s["stage"] for s in timeline] == ["search", "fetch"]
+    assert timeline[0]["hit"] is False and timeline[0]["results"] == 3
+    assert timeline[1]["error"] == "ValueError"
+
+
+def test_thread_pool_spans_join_the_current_trace():
+    def fetch(i):
+        with span("fetch", index=i):
+            pass
+
+    def run():
+        with ThreadPoolExecutor(2) as pool:
+            list(pool.map(in_current_context(fetch), range(3)))
+
+    assert traced(run).stage_totals()["fetch"]["count"] == 3
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile([], 0.5) == 0.0
+
+
+def test_stage_latency_keeps_counts_beyond_the_window():
+    latency = StageLatency(window=2)
+    for duration in (1.0, 2.0, 3.0):
+        latency.add("fetch", duration)
+    stats = latency.summary()["fetch"]
+    assert stats["count"] == 3 and stats["sum"] == 6.0
+    assert stats["max"] == 3.0 and stats["p50"] == 2.0
+
+
+def test_metrics_sink_writes_jsonl_and_prometheus(tmp_path):
+    jsonl, prom = tmp_path / "turns.jsonl", tmp_path / "metrics.prom"
+    sink = MetricsSink(jsonl_path=str(jsonl), prometheus_path=str(prom))
+
+    def run():
+        with span("search", hit=True):
+            pass
+        with span("fetch", bytes=1024):
+            pass
+
+    sink.record_turn(traced(run))
+    record = json.loads(jsonl.read_text(encoding="utf-8"))
+    assert [s["stage"] for s in record["spans"]] == ["search", "fetch"]
+    text = prom.read_text(encoding="utf-8")
+    assert 'mcp_cache_lookups_total{stage="search",result="hit"} 1' in text
+    assert "mcp_fetch_bytes_total 1024" in text
+    assert "mcp_turns_total 1" in text
@@ -0,0 +1,34 @@
+import token_counter
+from token_counter import (MESSAGE_OVERHEAD_TOKENS, REPLY_PRIMING_TOKENS, cache_stats, count_message_tokens,
+                           count_tokens, encoding_name_for_model, estimate_tokens, message_tokens)
+
+
+def test_proxy_aliases_share_the_model_encoding():
+    assert encoding_name_for_model("gpt-4o-ca") == encoding_name_for_model("gpt-4o")
+    assert encoding_name_for_model("some-new-model") == token_counter.DEFAULT_ENCODING
+
+
+def test_estimate_counts_cjk_characters_individually():
+    assert estimate_tokens("齐天大圣") == 4
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("") == 0
+
+
+def test_special_tokens_are_counted_as_text():
+    assert count_tokens("<|endoftext|>", "gpt-4o") > 0
+    assert count_tokens("", "gpt-4o") == 0
+
+
+def test_message_list_includes_per_message_and_priming_overhead():
+    messages = [{"role": "system", "content": "你是孙悟空"}, {"role": "user", "content": "你好"}]
+    expected = sum(count_tokens(m["content"], "gpt-4o") for m in messages)
+    expected += MESSAGE_OVERHEAD_TOKENS * 2 + REPLY_PRIMING_TOKENS
+    assert count_message_tokens(messages, "gpt-4o") == expected
+
+
+def test_repeated_messages_hit_the_count_cache():
+    message = {"role": "user", "content": "这条消息只用于测试计数缓存"}
+    message_tokens(message, "gpt-4o")
+    hits = cache_stats()["hits"]
+    message_tokens(dict(message), "gpt-4o-ca")
+    assert cache_stats()["hits"] == hits + 1
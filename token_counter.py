@@ -0,0 +1,125 @@
+"""
+Token计数
+按模型缓存tiktoken编码器（代理模型名映射到对应编码），整段消息列表一次计数并计入每条消息的开销，
+单条消息的计数按内容缓存，对话历史不会每轮重新分词；编码器不可用时退回区分中英文的估算
+"""
+import math
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色/分隔符开销
+REPLY_PRIMING_TOKENS = 3  # 回复起始的固定开销
+MESSAGE_CACHE_SIZE = 4096  # 缓存计数的消息条数
+
+# 模型名（含代理别名）对应的编码；未列出的模型按前缀匹配
+MODEL_ENCODINGS = {
+    "gpt-4o-ca": "o200k_base",
+    "gpt-4o": "o200k_base",
+    "gpt-4o-mini": "o200k_base",
+    "gpt-4-turbo": "cl100k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+}
+MODEL_PREFIX_ENCODINGS = [
+    ("gpt-4o", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+]
+DEFAULT_ENCODING = "o200k_base"
+
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+_encoders: Dict[str, Optional[object]] = {}
+_encoders_lock = threading.Lock()
+
+
+def encoding_name_for_model(model: str) -> str:
+    """模型名对应的编码名称"""
+    if model in MODEL_ENCODINGS:
+        return MODEL_ENCODINGS[model]
+    for prefix, name in MODEL_PREFIX_ENCODINGS:
+        if model.startswith(prefix):
+            return name
+    return DEFAULT_ENCODING
+
+
+def get_encoder(model: str):
+    """
+    获取模型的编码器（按编码名称缓存，进程内只加载一次）
+
+    返回:
+        tiktoken编码器；tiktoken未安装或编码文件无法加载（如离线）时返回None，且不再重复尝试
+    """
+    return _get_encoding(encoding_name_for_model(model))
+
+
+def _get_encoding(name: str):
+    encoder = _encoders.get(name, False)
+    if encoder is not False:
+        return encoder
+    with _encoders_lock:
+        if name not in _encoders:
+            try:
+                _encoders[name] = tiktoken.get_encoding(name) if tiktoken is not None else None
+            except Exception as e:
+                print(f"⚠️ 无法加载token编码 {name}，改用估算: {e}")
+                _encoders[name] = None
+        return _encoders[name]
+
+
+def estimate_tokens(text: str) -> int:
+    """没有编码器时的估算：中日韩字符约1个token，其余约4个字符1个token"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _encode_count(text: str, encoding_name: str) -> int:
+    if not text:
+        return 0
+    encoder = _get_encoding(encoding_name)
+    if encoder is None:
+        return estimate_tokens(text)
+    # 文本中的特殊标记（如<|endoftext|>）按普通文本计数
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """文本的token数"""
+    return _encode_count(text, encoding_name_for_model(model))
+
+
+# 按编码而不是模型名缓存，代理别名和同编码的模型共用
+_content_tokens = lru_cache(maxsize=MESSAGE_CACHE_SIZE)(_encode_count)
+
+
+def message_tokens(message: Dict, model: str) -> int:
+    """单条消息的token数（含消息开销），按内容缓存"""
+    return _content_tokens(message['content'], encoding_name_for_model(model)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def count_message_tokens(messages: List[Dict], model: str) -> int:
+    """整个消息列表作为提示词发送时的token数（含每条消息的开销和回复起始开销）"""
+    return sum(message_tokens(m, model) for m in messages) + REPLY_PRIMING_TOKENS
+
+
+def cache_stats() -> Dict:
+    """单条消息计数缓存的命中情况"""
+    info = _content_tokens.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "entries": info.currsize,
+        "max_entries": info.maxsize,
+        "hit_rate": info.hits / lookups if lookups else 0.0
+    }
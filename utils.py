@@ -1,26 +1,131 @@
-import tiktoken
 import json
 from datetime import datetime
 import os
 from pathlib import Path
 import base64
-from PIL import Image
+from PIL import Image, ImageOps, features
 import io
+import time
+import threading
+
+import token_counter
+from pricing import cached_prompt_tokens, usage_cost
 
 def count_tokens(text, model="gpt-4"):
+    """文本的token数（编码器按模型缓存，见token_counter）"""
+    return token_counter.count_tokens(text, model)
+
+def _finish_stream_result(result, model, messages, chunks, usage, start_time, finished):
+    """流式调用结束（或被取消）后填充result中的回复、延迟和用量"""
+    result['cancelled'] = not finished
+    result['model'] = model
+    result['response'] = "".join(chunks)
+    result['latency'] = time.perf_counter() - start_time
+    
+    if usage:
+        prompt_tokens = usage.prompt_tokens
+        completion_tokens = usage.completion_tokens
+        result['cached_tokens'] = cached_prompt_tokens(usage)
+    else:
+        # 部分代理不返回流式usage，被取消时也拿不到usage，退回本地估算
+        prompt_tokens = token_counter.count_message_tokens(messages, model)
+        completion_tokens = count_tokens(result['response'], model)
+        result['cached_tokens'] = 0
+    
+    result['prompt_tokens'] = prompt_tokens
+    result['tokens_used'] = prompt_tokens + completion_tokens
+    result['cost'] = usage_cost(model, prompt_tokens, completion_tokens, result['cached_tokens'])
+
+def stream_chat_completion(client, result, model, messages, **kwargs):
+    """
+    流式调用Chat Completions，逐段产出回复文本
+    生成器耗尽（或被提前关闭）后，result中的response/tokens_used/cost/ttft会被填充
+    提前关闭时连接随之断开，result['cancelled']为True
+    """
+    start_time = time.perf_counter()
+    result['ttft'] = None
+    chunks = []
+    usage = None
+    stream = None
+    finished = False
+    try:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},  # 最后一个chunk携带usage
+            **kwargs
+        )
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if result['ttft'] is None:
+                    result['ttft'] = time.perf_counter() - start_time
+                chunks.append(delta)
+                yield delta
+        finished = True
+    except Exception as e:
+        print(f"GPT流式调用失败: {e}")
+        result['error'] = str(e)
+        finished = True
+        if not chunks:
+            error_message = f"抱歉，回复生成失败：{str(e)}"
+            chunks.append(error_message)
+            yield error_message
+    finally:
+        if stream is not None:
+            stream.close()
+        _finish_stream_result(result, model, messages, chunks, usage, start_time, finished)
+
+async def astream_chat_completion(client, result, model, messages, **kwargs):
+    """
+    stream_chat_completion的异步版本（client为AsyncOpenAI），逐段产出回复文本
+    生成器耗尽、被关闭或所在任务被取消后，result会被同样填充
+    """
+    start_time = time.perf_counter()
+    result['ttft'] = None
+    chunks = []
+    usage = None
+    stream = None
+    finished = False
     try:
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
-    except:
-        return len(text) // 4
-
-def format_cost(tokens, input_cost_per_1k=0.03, output_cost_per_1k=0.06):
-    input_tokens = tokens * 0.7
-    output_tokens = tokens * 0.3
-    cost = (input_tokens / 1000) * input_cost_per_1k + (output_tokens / 1000) * output_cost_per_1k
-    return cost
-
-def save_chat_history(character_name, messages):
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},  # 最后一个chunk携带usage
+            **kwargs
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if result['ttft'] is None:
+                    result['ttft'] = time.perf_counter() - start_time
+                chunks.append(delta)
+                yield delta
+        finished = True
+    except Exception as e:
+        print(f"GPT流式调用失败: {e}")
+        result['error'] = str(e)
+        finished = True
+        if not chunks:
+            error_message = f"抱歉，回复生成失败：{str(e)}"
+            chunks.append(error_message)
+            yield error_message
+    finally:
+        if stream is not None:
+            await stream.close()
+        _finish_stream_result(result, model, messages, chunks, usage, start_time, finished)
+
+def save_chat_history(character_name, messages, memory=None):
     if not os.path.exists("chat_history"):
         os.makedirs("chat_history")
     
@@ -32,6 +137,8 @@ def save_chat_history(character_name, messages):
         "timestamp": timestamp,
         "messages": messages
     }
+    if memory:
+        data["memory"] = memory
     
     with open(filename, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
@@ -43,24 +150,26 @@ def load_chat_history(filename):
         data = json.load(f)
     return data
 
+def _to_rgb(img):
+    """转换为RGB模式（如果是RGBA或其他模式），透明部分填充白色背景"""
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # 创建白色背景
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
 def optimize_image(img_data, max_size=300, quality=85):
     """
     优化图片：调整大小并压缩
     """
     try:
         # 打开图片
-        img = Image.open(io.BytesIO(img_data))
-        
-        # 转换为RGB模式（如果是RGBA或其他模式）
-        if img.mode in ('RGBA', 'LA', 'P'):
-            # 创建白色背景
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
+        img = _to_rgb(Image.open(io.BytesIO(img_data)))
         
         # 调整大小（保持宽高比，限制最大边长）
         if max(img.size) > max_size:
@@ -74,46 +183,78 @@ def optimize_image(img_data, max_size=300, quality=85):
         print(f"Error optimizing image: {e}")
         return img_data
 
+# 头像缓存：(路径, 修改时间, 文件大小) -> data URL，每个进程只处理一次
+_avatar_cache = {}
+_avatar_cache_lock = threading.Lock()
+_avatar_stats = {"hits": 0, "misses": 0, "load_time": 0.0}
+
+def _encode_avatar_file(local_path, character_id):
+    """读取、按需压缩并编码头像文件为data URL（结果按路径和修改时间缓存）"""
+    stat = local_path.stat()
+    cache_key = (str(local_path.resolve()), stat.st_mtime_ns, stat.st_size)
+    with _avatar_cache_lock:
+        if cache_key in _avatar_cache:
+            _avatar_stats["hits"] += 1
+            return _avatar_cache[cache_key]
+    
+    start_time = time.perf_counter()
+    ext = local_path.suffix.lower()
+    
+    # 读取图片
+    with open(local_path, "rb") as img_file:
+        img_data = img_file.read()
+    
+    # SVG和GIF不需要优化，直接使用
+    if ext in ['.svg', '.gif']:
+        base64_img = base64.b64encode(img_data).decode()
+        mime_type = 'image/svg+xml' if ext == '.svg' else 'image/gif'
+        data_url = f"data:{mime_type};base64,{base64_img}"
+    else:
+        # 检查文件大小，如果超过200KB则优化
+        file_size_kb = len(img_data) / 1024
+        if file_size_kb > 200:
+            print(f"优化 {character_id} 头像 ({file_size_kb:.1f}KB -> ", end="")
+            img_data = optimize_image(img_data, max_size=300, quality=85)
+            optimized_size_kb = len(img_data) / 1024
+            print(f"{optimized_size_kb:.1f}KB)")
+        
+        # 转换为base64
+        base64_img = base64.b64encode(img_data).decode()
+        
+        # 使用JPEG格式（优化后都是JPEG）
+        mime_type = 'image/jpeg' if file_size_kb > 200 else 'image/png'
+        
+        # 返回base64格式的data URL
+        data_url = f"data:{mime_type};base64,{base64_img}"
+    
+    with _avatar_cache_lock:
+        _avatar_cache[cache_key] = data_url
+        _avatar_stats["misses"] += 1
+        _avatar_stats["load_time"] += time.perf_counter() - start_time
+    return data_url
+
+def get_avatar_cache_stats():
+    """
+    头像缓存统计
+    time_saved按未命中时的平均处理耗时估算命中节省的时间（秒）
+    """
+    with _avatar_cache_lock:
+        stats = dict(_avatar_stats)
+    stats["avg_load_time"] = stats["load_time"] / stats["misses"] if stats["misses"] else 0.0
+    stats["time_saved"] = stats["hits"] * stats["avg_load_time"]
+    return stats
+
 def get_character_avatar(character_id, character_info):
     """
     获取角色头像，优先使用本地图片
-    如果本地图片存在，自动优化并转换为base64编码
+    如果本地图片存在，自动优化并转换为base64编码（每个文件只处理一次，修改后自动失效）
     """
     # 优先使用配置中的avatar_local路径
     if 'avatar_local' in character_info:
-        avatar_local = character_info['avatar_local']
-        local_path = Path(avatar_local)
+        local_path = Path(character_info['avatar_local'])
         if local_path.exists():
             try:
-                # 获取文件扩展名
-                ext = local_path.suffix.lower()
-                
-                # 读取图片
-                with open(local_path, "rb") as img_file:
-                    img_data = img_file.read()
-                
-                # SVG和GIF不需要优化，直接使用
-                if ext in ['.svg', '.gif']:
-                    base64_img = base64.b64encode(img_data).decode()
-                    mime_type = 'image/svg+xml' if ext == '.svg' else 'image/gif'
-                    return f"data:{mime_type};base64,{base64_img}"
-                
-                # 检查文件大小，如果超过200KB则优化
-                file_size_kb = len(img_data) / 1024
-                if file_size_kb > 200:
-                    print(f"优化 {character_id} 头像 ({file_size_kb:.1f}KB -> ", end="")
-                    img_data = optimize_image(img_data, max_size=300, quality=85)
-                    optimized_size_kb = len(img_data) / 1024
-                    print(f"{optimized_size_kb:.1f}KB)")
-                
-                # 转换为base64
-                base64_img = base64.b64encode(img_data).decode()
-                
-                # 使用JPEG格式（优化后都是JPEG）
-                mime_type = 'image/jpeg' if file_size_kb > 200 else 'image/png'
-                
-                # 返回base64格式的data URL
-                return f"data:{mime_type};base64,{base64_img}"
+                return _encode_avatar_file(local_path, character_id)
             except Exception as e:
                 print(f"Error loading avatar_local {local_path}: {e}")
     
@@ -122,32 +263,7 @@ def get_character_avatar(character_id, character_info):
         local_path = Path(f"./assets/{character_id}{ext}")
         if local_path.exists():
             try:
-                # 读取图片
-                with open(local_path, "rb") as img_file:
-                    img_data = img_file.read()
-                
-                # SVG和GIF不需要优化，直接使用
-                if ext in ['.svg', '.gif']:
-                    base64_img = base64.b64encode(img_data).decode()
-                    mime_type = 'image/svg+xml' if ext == '.svg' else 'image/gif'
-                    return f"data:{mime_type};base64,{base64_img}"
-                
-                # 检查文件大小，如果超过200KB则优化
-                file_size_kb = len(img_data) / 1024
-                if file_size_kb > 200:
-                    print(f"优化 {character_id} 头像 ({file_size_kb:.1f}KB -> ", end="")
-                    img_data = optimize_image(img_data, max_size=300, quality=85)
-                    optimized_size_kb = len(img_data) / 1024
-                    print(f"{optimized_size_kb:.1f}KB)")
-                
-                # 转换为base64
-                base64_img = base64.b64encode(img_data).decode()
-                
-                # 使用JPEG格式（优化后都是JPEG）
-                mime_type = 'image/jpeg' if file_size_kb > 200 else 'image/png'
-                
-                # 返回base64格式的data URL
-                return f"data:{mime_type};base64,{base64_img}"
+                return _encode_avatar_file(local_path, character_id)
             except Exception as e:
                 print(f"Error loading local image {local_path}: {e}")
                 continue
@@ -155,3 +271,83 @@ def get_character_avatar(character_id, character_info):
     # 如果本地不存在或加载失败，使用在线URL
     return character_info.get('avatar', character_info.get('emoji', '👤'))
 
+# 静态头像缩略图：写入 static/avatars，由Streamlit静态文件服务按URL提供，避免在页面中内嵌base64
+STATIC_AVATAR_DIR = Path(__file__).parent / "static" / "avatars"
+STATIC_AVATAR_URL = "app/static/avatars"
+AVATAR_THUMBNAIL_SIZES = {
+    "sidebar": 80,   # 侧边栏 40px，按2倍像素密度生成
+    "header": 120,   # 标题栏 60px
+    "chat": 80,      # 聊天消息 40px
+}
+_thumbnail_cache = {}  # (源文件路径, 修改时间, 尺寸) -> 缩略图路径
+
+def _find_local_avatar(character_id, character_info):
+    """查找角色的本地头像文件"""
+    if 'avatar_local' in character_info:
+        local_path = Path(character_info['avatar_local'])
+        if local_path.exists():
+            return local_path
+    for ext in ['.png', '.jpg', '.jpeg', '.svg', '.gif']:
+        local_path = Path(f"./assets/{character_id}{ext}")
+        if local_path.exists():
+            return local_path
+    return None
+
+def build_avatar_thumbnail(local_path, character_id, size):
+    """
+    生成正方形头像缩略图（WebP，不支持时用JPEG）
+    缩略图比源文件新时直接复用，每个进程对同一源文件和尺寸只检查一次
+    """
+    stat = local_path.stat()
+    cache_key = (str(local_path.resolve()), stat.st_mtime_ns, size)
+    with _avatar_cache_lock:
+        if cache_key in _thumbnail_cache:
+            return _thumbnail_cache[cache_key]
+    
+    ext, img_format = ('.webp', 'WEBP') if features.check('webp') else ('.jpg', 'JPEG')
+    out_path = STATIC_AVATAR_DIR / f"{character_id}_{size}{ext}"
+    if not out_path.exists() or out_path.stat().st_mtime < stat.st_mtime:
+        STATIC_AVATAR_DIR.mkdir(parents=True, exist_ok=True)
+        img = _to_rgb(Image.open(local_path))
+        img = ImageOps.fit(img, (size, size), Image.Resampling.LANCZOS)
+        img.save(out_path, format=img_format, quality=85)
+        print(f"生成 {character_id} 头像缩略图 {out_path.name} ({out_path.stat().st_size / 1024:.1f}KB)")
+    
+    with _avatar_cache_lock:
+        _thumbnail_cache[cache_key] = out_path
+    return out_path
+
+def get_avatar_thumbnail(character_id, character_info, variant="chat"):
+    """
+    获取指定用途的头像缩略图文件路径
+    SVG/GIF或没有本地图片时返回None
+    """
+    local_path = _find_local_avatar(character_id, character_info)
+    if local_path is None or local_path.suffix.lower() in ['.svg', '.gif']:
+        return None
+    try:
+        return build_avatar_thumbnail(local_path, character_id, AVATAR_THUMBNAIL_SIZES[variant])
+    except Exception as e:
+        print(f"Error building avatar thumbnail {local_path}: {e}")
+        return None
+
+def get_avatar_src(character_id, character_info, variant="sidebar", static_serving=True):
+    """
+    获取用于HTML <img src> 的头像地址
+    启用静态文件服务时返回缩略图URL，否则退回base64 data URL
+    """
+    if static_serving:
+        thumbnail = get_avatar_thumbnail(character_id, character_info, variant)
+        if thumbnail is not None:
+            return f"{STATIC_AVATAR_URL}/{thumbnail.name}?v={int(thumbnail.stat().st_mtime)}"
+    return get_character_avatar(character_id, character_info)
+
+def get_chat_avatar(character_id, character_info):
+    """
+    获取 st.chat_message 使用的头像
+    优先返回缩略图文件路径（由Streamlit按URL提供），否则退回base64 data URL
+    """
+    thumbnail = get_avatar_thumbnail(character_id, character_info, "chat")
+    if thumbnail is not None:
+        return str(thumbnail)
+    return get_character_avatar(character_id, character_info)